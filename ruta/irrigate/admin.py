@@ -1,7 +1,24 @@
+from datetime import timedelta
+
 from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import Q, Sum
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from irrigate.models import Actuator, ActuatorRunLog, Device, ScheduleTime
+from irrigate.gpio import GPIOWriteError
+from irrigate.models import (
+    Actuator,
+    ActuatorRunLog,
+    Device,
+    ScheduleTime,
+    WeatherDay,
+    plan_durations,
+    seconds_to_minutes,
+)
+from irrigate.weather import WeatherSnapshot
+
+RECENT_WATER_WINDOWS_IN_DAYS = (1, 3, 7)
 
 
 @admin.action(description="Start actuator")
@@ -14,8 +31,23 @@ def start(modeladmin, request, queryset):
 
 @admin.action(description="Stop actuator")
 def stop(modeladmin, request, queryset):
-    for actuator in queryset:
-        actuator.stop()
+    try:
+        Actuator.stop_many(queryset)
+    except GPIOWriteError as e:
+        messages.error(request, str(e))
+
+
+class ActuatorChangeList(ChangeList):
+    def get_results(self, request):
+        """
+        Plan every actuator on the page together, sharing one weather lookup.
+        """
+        super().get_results(request)
+        snapshot = WeatherSnapshot()
+        summaries = plan_durations(self.result_list, snapshot=snapshot)
+        for actuator in self.result_list:
+            actuator.weather_snapshot = snapshot
+            actuator.duration_summary = summaries[actuator.id]
 
 
 class ActuatorAdmin(admin.ModelAdmin):
@@ -38,45 +70,93 @@ class ActuatorAdmin(admin.ModelAdmin):
 
     actions = [start, stop]
 
+    def get_queryset(self, request):
+        """
+        Total up recent sprinkler time for every row in the same query as the
+        changelist, instead of one query per row and column.
+        """
+        queryset = super().get_queryset(request)
+        now = timezone.now()
+        return queryset.annotate(
+            **{
+                f"recent_water_seconds_{days_ago}": Sum(
+                    "actuatorrunlog__duration_seconds",
+                    filter=Q(
+                        actuatorrunlog__start_datetime__gt=now
+                        - timedelta(days=days_ago)
+                    ),
+                )
+                for days_ago in RECENT_WATER_WINDOWS_IN_DAYS
+            }
+        )
+
+    def get_changelist(self, request, **kwargs):
+        return ActuatorChangeList
+
+    def _snapshot(self, actuator):
+        return getattr(actuator, "weather_snapshot", None)
+
+    def _duration_summary(self, actuator):
+        if not hasattr(actuator, "duration_summary"):
+            return actuator.get_duration_summary()
+        return actuator.duration_summary
+
+    def _recent_sprinkler_inches(self, actuator, days_ago):
+        annotation = f"recent_water_seconds_{days_ago}"
+        if not hasattr(actuator, annotation):
+            return actuator.get_recent_water_amount_in_inches(days_ago=days_ago)
+        minutes = seconds_to_minutes(getattr(actuator, annotation))
+        return minutes * actuator.flow_rate_per_minute
+
     def next_3_days_precipitation(self, actuator):
         days = 3
-        from_rain = actuator.get_forecasted_precipitation_from_rain_in_inches(days=days)
+        from_rain = actuator.get_forecasted_precipitation_from_rain_in_inches(
+            days=days, snapshot=self._snapshot(actuator)
+        )
         return f"{from_rain:.2f}"
 
     def next_1_days_precipitation(self, actuator):
         days = 1
-        from_rain = actuator.get_forecasted_precipitation_from_rain_in_inches(days=days)
+        from_rain = actuator.get_forecasted_precipitation_from_rain_in_inches(
+            days=days, snapshot=self._snapshot(actuator)
+        )
         return f"{from_rain:.2f}"
 
     def last_1_days_precipitation(self, actuator):
         days_ago = 1
-        from_rain = actuator.get_precipitation_from_rain_in_inches(days_ago=days_ago)
-        from_sprinklers = actuator.get_recent_water_amount_in_inches(days_ago=days_ago)
+        from_rain = actuator.get_precipitation_from_rain_in_inches(
+            days_ago=days_ago, snapshot=self._snapshot(actuator)
+        )
+        from_sprinklers = self._recent_sprinkler_inches(actuator, days_ago)
         return f"Rain: {from_rain:.2f} -- Sprinklers: {from_sprinklers:.2f}"
 
     def last_3_days_precipitation(self, actuator):
         days_ago = 3
-        from_rain = actuator.get_precipitation_from_rain_in_inches(days_ago=days_ago)
-        from_sprinklers = actuator.get_recent_water_amount_in_inches(days_ago=days_ago)
+        from_rain = actuator.get_precipitation_from_rain_in_inches(
+            days_ago=days_ago, snapshot=self._snapshot(actuator)
+        )
+        from_sprinklers = self._recent_sprinkler_inches(actuator, days_ago)
         return f"Rain: {from_rain:.2f} -- Sprinklers: {from_sprinklers:.2f}"
 
     def last_7_days_precipitation(self, actuator):
         days_ago = 7
-        from_rain = actuator.get_precipitation_from_rain_in_inches(days_ago=days_ago)
-        from_sprinklers = actuator.get_recent_water_amount_in_inches(days_ago=days_ago)
+        from_rain = actuator.get_precipitation_from_rain_in_inches(
+            days_ago=days_ago, snapshot=self._snapshot(actuator)
+        )
+        from_sprinklers = self._recent_sprinkler_inches(actuator, days_ago)
         return f"Rain: {from_rain:.2f} -- Sprinklers: {from_sprinklers:.2f}"
 
     def calculated_duration_in_minutes(self, actuator):
-        return round(actuator._get_base_duration_in_seconds() / 60, 2)
+        return round(self._duration_summary(actuator).base_duration_seconds / 60, 2)
 
     def next_run_duration_in_minutes(self, actuator):
-        return round(actuator.get_duration_in_seconds() / 60, 2)
+        return round(self._duration_summary(actuator).final_duration_seconds / 60, 2)
 
     def todays_high_temperature(self, actuator):
-        return actuator.get_todays_high_temperature()
+        return actuator.get_todays_high_temperature(snapshot=self._snapshot(actuator))
 
     def temperature_multiplier(self, actuator):
-        return actuator.get_temperature_watering_adjustment_multiplier()
+        return self._duration_summary(actuator).temperature_multiplier
 
 
 class RunTypeListFilter(admin.SimpleListFilter):
@@ -115,6 +195,44 @@ class RunTypeListFilter(admin.SimpleListFilter):
         return queryset
 
 
+class RunStatusListFilter(admin.SimpleListFilter):
+    title = _("Status")
+    parameter_name = "status"
+
+    def lookups(self, request, model_admin):
+        return (
+            (ActuatorRunLog.RUNNING, _("Running")),
+            (ActuatorRunLog.FINISHED, _("Finished")),
+            (ActuatorRunLog.SKIPPED, _("Skipped")),
+        )
+
+    def queryset(self, request, queryset):
+        """
+        Filter on the stored duration so the database does the work.
+        """
+        value = self.value()
+        skipped_below = ActuatorRunLog.SKIPPED_BELOW_SECONDS
+        if value == ActuatorRunLog.RUNNING:
+            return queryset.filter(end_datetime__isnull=True)
+        if value == ActuatorRunLog.FINISHED:
+            return queryset.filter(duration_seconds__gte=skipped_below)
+        if value == ActuatorRunLog.SKIPPED:
+            return queryset.filter(duration_seconds__lt=skipped_below)
+        return queryset
+
+
+class ActuatorRunLogAdmin(admin.ModelAdmin):
+    list_display = [
+        "actuator",
+        "start_datetime",
+        "end_datetime",
+        "duration_seconds",
+    ]
+    list_filter = (RunStatusListFilter, "actuator")
+    list_select_related = ("actuator",)
+    readonly_fields = ("duration_seconds",)
+
+
 @admin.action(description="Enable schedule time")
 def enable(modeladmin, request, queryset):
     for schedule_time in queryset:
@@ -135,6 +253,7 @@ class ScheduleTimeAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Actuator, ActuatorAdmin)
-admin.site.register(ActuatorRunLog)
+admin.site.register(ActuatorRunLog, ActuatorRunLogAdmin)
 admin.site.register(Device)
 admin.site.register(ScheduleTime, ScheduleTimeAdmin)
+admin.site.register(WeatherDay)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class IrrigateConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "irrigate"
+
+    def ready(self):
+        from irrigate import signals  # noqa: F401
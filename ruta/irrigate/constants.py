@@ -1,2 +1,5 @@
 MINIMUM_WATER_DURATION_IN_SECONDS = 12 * 60
 SKIP_WATERING_THRESHOLD_IN_SECONDS = 8 * 60
+# how far back and ahead the watering calculation looks
+RECENT_WATER_WINDOW_IN_DAYS = 3
+FORECAST_WINDOW_CONSIDERED_IN_DAYS = 2
@@ -0,0 +1,40 @@
+import fcntl
+import logging
+import os
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class LockHeld(Exception):
+    pass
+
+
+@contextmanager
+def singleton_lock(name: str):
+    """
+    Hold an exclusive lock named `name` across every process on the device.
+
+    Raises `LockHeld` straight away if another process has it. The lock is an
+    flock, so the kernel releases it when the holder exits or crashes and
+    there is never a stale lock to clean up.
+    """
+    os.makedirs(settings.CACHE_DIR, exist_ok=True)
+    path = os.path.join(settings.CACHE_DIR, f"{name}.lock")
+    with open(path, "a+") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.seek(0)
+            raise LockHeld(f"{name} is locked by pid {lock_file.read().strip()}")
+
+        # the holder's pid is only there to help whoever finds the lock held
+        lock_file.truncate(0)
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
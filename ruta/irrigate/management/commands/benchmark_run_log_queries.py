@@ -0,0 +1,153 @@
+import logging
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from irrigate.models import Actuator, ActuatorRunLog, Device, ScheduleTime
+from irrigate.schedule import has_run, has_run_recently
+
+logger = logging.getLogger(__name__)
+
+NUMBER_OF_ACTUATORS = 20
+BATCH_SIZE = 10000
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the scheduler's hot ActuatorRunLog queries as the table grows. "
+        "Runs against a throwaway test database, never the real one."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            nargs="+",
+            type=int,
+            default=[10_000, 100_000, 1_000_000],
+            help="Run log table sizes to measure at",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=50,
+            help="Times to run each query. The median is reported",
+        )
+        parser.add_argument(
+            "--explain",
+            action="store_true",
+            help="Print the query plan for each query at the largest size",
+        )
+
+    def handle(self, sizes, repeat, explain, *args, **kwargs):
+        old_name = connection.creation.create_test_db(verbosity=0, serialize=False)
+        try:
+            self._benchmark(sorted(sizes), repeat, explain)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def _benchmark(self, sizes, repeat, explain):
+        device = Device.objects.create(name="benchmark")
+        actuators = [
+            Actuator.objects.create(name=f"zone {i}", gpio_pin=i, device=device)
+            for i in range(NUMBER_OF_ACTUATORS)
+        ]
+        now = timezone.now()
+        schedule_time = ScheduleTime.objects.create(
+            weekday=now.weekday(), start_time=now.time()
+        )
+        schedule_time.actuators.add(*actuators)
+        actuator = actuators[0]
+
+        queries = {
+            "has_run": lambda: has_run(schedule_time, actuator),
+            "has_run_recently": lambda: has_run_recently(actuator),
+            "open runs": lambda: ActuatorRunLog.objects.filter(
+                actuator=actuator, end_datetime__isnull=True
+            ).exists(),
+            "recent water": lambda: Actuator.get_recent_water_durations_in_minutes(
+                days_ago=3
+            ),
+            "running runs": lambda: list(
+                ActuatorRunLog.objects.filter(end_datetime__isnull=True)
+            ),
+            "queued one-offs": lambda: list(
+                ScheduleTime.objects.filter(
+                    ~Exists(ActuatorRunLog.objects.filter(schedule_time=OuterRef("pk")))
+                )
+            ),
+            "dashboard page": lambda: list(ActuatorRunLog.objects.all()[:25]),
+        }
+
+        self.stdout.write(
+            "rows".rjust(10) + "".join(name.rjust(22) for name in queries)
+        )
+        # one run still going, like during a scheduler pass
+        ActuatorRunLog.objects.create(actuator=actuator, start_datetime=now)
+        row_count = 0
+        for size in sizes:
+            self._seed(actuators, schedule_time, start=row_count, end=size)
+            row_count = size
+            timings = [self._time(query, repeat) for query in queries.values()]
+            self.stdout.write(
+                f"{size:>10}"
+                + "".join(f"{timing * 1000:>19.3f} ms" for timing in timings)
+            )
+
+        if explain:
+            self.stdout.write("")
+            plans = {
+                "has_run": ActuatorRunLog.objects.filter(
+                    schedule_time=schedule_time,
+                    actuator=actuator,
+                    start_datetime__gte=now - timedelta(days=1),
+                ),
+                "has_run_recently": ActuatorRunLog.objects.filter(
+                    actuator=actuator, start_datetime__gte=now
+                ),
+                "open runs": ActuatorRunLog.objects.filter(
+                    actuator=actuator, end_datetime__isnull=True
+                ),
+                "running runs": ActuatorRunLog.objects.filter(
+                    end_datetime__isnull=True
+                ),
+            }
+            for name, queryset in plans.items():
+                self.stdout.write(f"{name}: {queryset.explain()}")
+
+    def _seed(self, actuators, schedule_time, start, end):
+        """
+        Add finished run logs numbered `start` to `end`, spread backwards in
+        time from now at four runs per actuator per day.
+        """
+        logger.info(f"Seeding run logs {start} to {end}")
+        now = timezone.now()
+        runs_per_day = 4 * len(actuators)
+        batch = []
+        for i in range(start, end):
+            start_datetime = now - timedelta(days=(i + 1) / runs_per_day)
+            batch.append(
+                ActuatorRunLog(
+                    actuator=actuators[i % len(actuators)],
+                    schedule_time=schedule_time if i % 2 else None,
+                    start_datetime=start_datetime,
+                    end_datetime=start_datetime + timedelta(minutes=12),
+                    duration_seconds=12 * 60,
+                )
+            )
+            if len(batch) >= BATCH_SIZE:
+                ActuatorRunLog.objects.bulk_create(batch)
+                batch = []
+        ActuatorRunLog.objects.bulk_create(batch)
+
+    def _time(self, query, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            query()
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings)
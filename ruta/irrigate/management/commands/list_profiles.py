@@ -0,0 +1,73 @@
+import io
+import pstats
+
+from django.core.management.base import BaseCommand, CommandError
+
+from irrigate.profiling import get_profile_dir, list_profiles
+
+
+class Command(BaseCommand):
+    help = (
+        "List the profiles saved by --profile and PROFILE_REQUESTS, or "
+        "summarize the slowest functions in some of them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "names",
+            nargs="*",
+            help="Profiles to summarize, by file name or 'latest'",
+        )
+        parser.add_argument(
+            "--trigger",
+            help="Only list profiles whose trigger contains this",
+        )
+        parser.add_argument(
+            "--sort",
+            default="cumulative",
+            choices=["cumulative", "tottime", "calls"],
+            help="How to order functions in a summary",
+        )
+        parser.add_argument(
+            "--limit", type=int, default=25, help="Functions to show per summary"
+        )
+
+    def handle(self, names, trigger, sort, limit, *args, **kwargs):
+        profiles = list_profiles()
+        if trigger:
+            profiles = [profile for profile in profiles if trigger in profile.trigger]
+
+        if not names:
+            self._list(profiles)
+            return
+
+        by_name = {profile.name: profile for profile in profiles}
+        for name in names:
+            if name == "latest":
+                if not profiles:
+                    raise CommandError(f"No profiles in {get_profile_dir()}")
+                profile = profiles[0]
+            elif name in by_name:
+                profile = by_name[name]
+            else:
+                raise CommandError(f"No profile named {name}")
+            self._summarize(profile, sort, limit)
+
+    def _list(self, profiles):
+        if not profiles:
+            self.stdout.write(f"No profiles in {get_profile_dir()}")
+            return
+        self.stdout.write(f"{'captured at':<20}{'seconds':>10}  {'trigger':<30}name")
+        for profile in profiles:
+            seconds = pstats.Stats(profile.path).total_tt
+            self.stdout.write(
+                f"{profile.captured_at:%Y-%m-%d %H:%M:%S}  {seconds:>8.3f}  "
+                f"{profile.trigger:<30}{profile.name}"
+            )
+
+    def _summarize(self, profile, sort, limit):
+        stream = io.StringIO()
+        stats = pstats.Stats(profile.path, stream=stream)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+        self.stdout.write(f"{profile.name} ({profile.trigger})")
+        self.stdout.write(stream.getvalue())
@@ -1,8 +1,9 @@
 import logging
+from contextlib import nullcontext
 
 from django.core.management.base import BaseCommand, CommandError
-from irrigate.monitor import MonitoringEvent, MonitoringEventStatus, emit
-from irrigate.schedule import run_all
+from irrigate.profiling import capture_profile
+from irrigate.schedule import run_all_and_report
 
 logger = logging.getLogger(__name__)
 
@@ -10,23 +11,10 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("--dry-run", action="store_true")
+        parser.add_argument(
+            "--profile", action="store_true", help="Save a cProfile of the pass"
+        )
 
-    def handle(self, dry_run=False, *args, **kwargs):
-        logger.info(f"Checking for runnable jobs. dry_run: {dry_run}")
-        try:
-            actuators_that_ran = run_all(dry_run=dry_run)
-        except Exception as e:
-            event = MonitoringEvent(
-                name=f"Error while running scheduled jobs {e}",
-                status=MonitoringEventStatus.FAILURE,
-            )
-            emit(event)
-            return
-        if actuators_that_ran:
-            event = MonitoringEvent(
-                name=f"Scheduled time complete for sprinklers: {actuators_that_ran}",
-                status=MonitoringEventStatus.SUCCESS,
-            )
-            emit(event)
-
-        logger.info(f"Finished checking for runnable jobs. dry_run: {dry_run}")
+    def handle(self, dry_run=False, profile=False, *args, **kwargs):
+        with capture_profile("run_all") if profile else nullcontext():
+            run_all_and_report(dry_run=dry_run)
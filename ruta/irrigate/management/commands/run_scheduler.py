@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from irrigate.scheduler import POLL_INTERVAL_IN_SECONDS, Scheduler
+
+
+class Command(BaseCommand):
+    help = (
+        "Stay resident and run schedule times as they come due. "
+        "Replaces running run_scheduled_jobs from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true")
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=POLL_INTERVAL_IN_SECONDS,
+            help="Seconds between checks for schedule changes",
+        )
+        parser.add_argument(
+            "--profile", action="store_true", help="Save a cProfile of every pass"
+        )
+
+    def handle(
+        self,
+        dry_run=False,
+        poll_interval=POLL_INTERVAL_IN_SECONDS,
+        profile=False,
+        **kwargs,
+    ):
+        Scheduler(
+            dry_run=dry_run, poll_interval=poll_interval, profile=profile
+        ).run_forever()
@@ -0,0 +1,138 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from irrigate.tracing import group_traces, read_spans
+
+BAR_WIDTH = 40
+
+
+class Command(BaseCommand):
+    help = (
+        "List recent scheduler passes from the trace file, or draw some of "
+        "them as a timeline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "trace_ids",
+            nargs="*",
+            help="Passes to draw, by trace id, the start of one, or 'latest'",
+        )
+        parser.add_argument(
+            "--limit", type=int, default=20, help="Passes to list, newest first"
+        )
+        parser.add_argument(
+            "--min-seconds",
+            type=float,
+            default=0,
+            help="Leave out spans quicker than this, and the spans under them",
+        )
+        parser.add_argument(
+            "--no-db", action="store_true", help="Leave out database query spans"
+        )
+
+    def handle(self, trace_ids, limit, min_seconds, no_db, *args, **kwargs):
+        # newest pass first
+        traces = sorted(
+            group_traces(read_spans()).items(),
+            key=lambda item: item[1][0]["start"],
+            reverse=True,
+        )
+        if not trace_ids:
+            self._list(traces[:limit])
+            return
+
+        for trace_id in trace_ids:
+            if trace_id == "latest":
+                if not traces:
+                    raise CommandError(f"No traces in {settings.TRACE_FILE}")
+                spans = traces[0][1]
+            else:
+                matches = [spans for id_, spans in traces if id_.startswith(trace_id)]
+                if len(matches) != 1:
+                    raise CommandError(
+                        f"{len(matches)} traces match {trace_id}, expected one"
+                    )
+                spans = matches[0]
+            self._draw(spans, min_seconds, no_db)
+
+    def _list(self, traces):
+        if not traces:
+            self.stdout.write(f"No traces in {settings.TRACE_FILE}")
+            return
+        self.stdout.write(
+            f"{'started at':<21}{'seconds':>9}  {'status':<10}{'zones':>6}  trace"
+        )
+        for trace_id, spans in traces:
+            root = _get_root(spans)
+            attributes = root["attributes"] if root else {}
+            status = attributes.get("status", "unfinished" if not root else "")
+            self.stdout.write(
+                f"{_format_start(spans[0]['start']):<21}"
+                f"{_get_seconds(spans, root):>9.3f}  {status:<10}"
+                f"{attributes.get('zones', ''):>6}  {trace_id}"
+            )
+
+    def _draw(self, spans, min_seconds, no_db):
+        root = _get_root(spans)
+        started = spans[0]["start"]
+        total_seconds = _get_seconds(spans, root) or 1
+        title = root["name"] if root else "unfinished pass"
+        self.stdout.write(
+            f"{title} {spans[0]['trace_id']} at {_format_start(started)}, "
+            f"{_get_seconds(spans, root):.3f} s"
+        )
+
+        children = {}
+        for span in spans:
+            children.setdefault(span["parent_id"], []).append(span)
+        # a pass that never finished has no root, so start from its orphans
+        span_ids = {span["span_id"] for span in spans}
+        tops = [span for span in spans if span["parent_id"] not in span_ids]
+
+        def draw(span, depth):
+            duration = span["duration"] or 0
+            if duration < min_seconds or (no_db and span["name"] == "db"):
+                return
+            offset = span["start"] - started
+            bar_start = min(BAR_WIDTH - 1, int(offset / total_seconds * BAR_WIDTH))
+            bar_length = max(1, round(duration / total_seconds * BAR_WIDTH))
+            bar_length = min(bar_length, BAR_WIDTH - bar_start)
+            bar = " " * bar_start + "#" * bar_length
+            details = " ".join(
+                f"{key}={value}"
+                for key, value in span["attributes"].items()
+                if value is not None
+            )
+            if span["error"]:
+                details = f"{details} error={span['error']}".strip()
+            self.stdout.write(
+                f"{offset:>10.3f} {duration:>10.3f} |{bar:<{BAR_WIDTH}}| "
+                f"{'  ' * depth}{span['name']} {details}".rstrip()
+            )
+            for child in children.get(span["span_id"], []):
+                draw(child, depth + 1)
+
+        self.stdout.write(f"{'offset s':>10} {'seconds':>10}")
+        for span in tops:
+            draw(span, 0)
+
+
+def _get_root(spans):
+    return next((span for span in spans if span["parent_id"] is None), None)
+
+
+def _get_seconds(spans, root):
+    if root:
+        return root["duration"]
+    return max(span["start"] + (span["duration"] or 0) for span in spans) - min(
+        span["start"] for span in spans
+    )
+
+
+def _format_start(start):
+    started = datetime.fromtimestamp(start, tz=timezone.get_current_timezone())
+    return f"{started:%Y-%m-%d %H:%M:%S}"
@@ -1,13 +1,25 @@
 import logging
+from contextlib import nullcontext
 
 from django.core.management.base import BaseCommand, CommandError
+from irrigate.gpio import GPIOWriteError
+from irrigate.profiling import capture_profile
 from irrigate.schedule import stop_all
 
 logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
-    def handle(self, *args, **kwargs):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--profile", action="store_true", help="Save a cProfile of the stop"
+        )
+
+    def handle(self, profile=False, *args, **kwargs):
         logger.info(f"Stopping all actuators")
-        stop_all()
+        with capture_profile("stop_all") if profile else nullcontext():
+            try:
+                stop_all()
+            except GPIOWriteError as e:
+                raise CommandError(str(e))
         logger.info(f"Stopped all actuators")
@@ -0,0 +1,380 @@
+"""
+Counters, gauges and histograms, exposed in the Prometheus text format.
+
+Each process keeps its own metrics in memory and writes a snapshot of them
+to a file of its own under CACHE_DIR. `/metrics` adds up the snapshots of
+every process, so the scheduler, cron runs and each web worker all count.
+Snapshots left by processes that have exited are folded into one archive,
+keeping their counts without keeping a file per process forever.
+"""
+import atexit
+import bisect
+import fcntl
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# how often a process rewrites its snapshot, at most
+WRITE_INTERVAL_IN_SECONDS = 15
+ARCHIVE_NAME = "archive.json"
+
+_process_id: Optional[str] = None
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def labels(self, **labels) -> "BoundMetric":
+        return BoundMetric(self, self._key(labels))
+
+    def samples(self) -> Dict[Tuple[str, ...], object]:
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    def _copy(self, value):
+        return value
+
+
+class BoundMetric:
+    """
+    A metric with its label values filled in.
+    """
+
+    def __init__(self, metric: Metric, key: Tuple[str, ...]):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount: float = 1):
+        self.metric._inc(self.key, amount)
+
+    def set(self, value: float):
+        self.metric._set(self.key, value)
+
+    def observe(self, value: float):
+        self.metric._observe(self.key, value)
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def _inc(self, key, amount):
+        if amount < 0:
+            raise ValueError("Counters only go up")
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def inc(self, amount: float = 1):
+        self._inc(self._key({}), amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def _inc(self, key, amount):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float):
+        self._set(self._key({}), value)
+
+
+class Histogram(Metric):
+    """
+    Observations counted into fixed buckets, plus their sum and count.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _observe(self, key, value):
+        with self._lock:
+            if key not in self._values:
+                # a count per bucket, the +Inf bucket, then the sum
+                self._values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts = self._values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def _copy(self, value):
+        return list(value)
+
+    def observe(self, value: float):
+        self._observe(self._key({}), value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._last_write = 0.0
+        self._write_lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"{metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()) -> Gauge:
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def snapshot(self) -> dict:
+        return {
+            "written_at": time.time(),
+            "metrics": {
+                metric.name: {
+                    "type": metric.type,
+                    "help": metric.help,
+                    "labelnames": list(metric.labelnames),
+                    "buckets": list(getattr(metric, "buckets", [])),
+                    "samples": [
+                        [list(key), value] for key, value in metric.samples().items()
+                    ],
+                }
+                for metric in self._metrics.values()
+            },
+        }
+
+    def write_snapshot(self, directory: Optional[str] = None):
+        directory = directory or get_metrics_dir()
+        with self._write_lock:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{get_process_id()}.json")
+            _write_json(path, self.snapshot())
+            self._last_write = time.monotonic()
+
+    def maybe_write_snapshot(self, interval: float = WRITE_INTERVAL_IN_SECONDS):
+        """
+        Write a snapshot unless one was written in the last `interval` seconds.
+        """
+        if time.monotonic() - self._last_write < interval:
+            return
+        try:
+            self.write_snapshot()
+        except OSError as e:
+            logger.warning(f"Unable to write metrics: {e}")
+
+
+REGISTRY = Registry()
+
+
+def get_process_id() -> str:
+    """
+    Names this process's snapshot. Unique even when a pid is reused, and
+    worked out again after a fork so forked web workers don't share one.
+    """
+    global _process_id
+    if _process_id is None or not _process_id.startswith(f"{os.getpid()}-"):
+        _process_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    return _process_id
+
+
+def get_metrics_dir() -> str:
+    return os.path.join(settings.CACHE_DIR, "metrics")
+
+
+def _write_json(path: str, data: dict):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as snapshot_file:
+        json.dump(data, snapshot_file)
+    os.replace(tmp, path)
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as snapshot_file:
+            return json.load(snapshot_file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Skipping unreadable metrics snapshot {path}: {e}")
+        return None
+
+
+def _is_running(process_id: str) -> bool:
+    pid = int(process_id.split("-", 1)[0])
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(snapshots: List[dict], keep_gauges: bool = True) -> dict:
+    """
+    Add up counters and histograms across snapshots. Gauges take the value
+    from the newest snapshot that has one, or are dropped without
+    `keep_gauges`.
+    """
+    merged = {}
+    for snapshot in sorted(snapshots, key=lambda snapshot: snapshot["written_at"]):
+        for name, metric in snapshot["metrics"].items():
+            if metric["type"] == "gauge" and not keep_gauges:
+                continue
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            samples = target["samples"]
+            for key, value in metric["samples"]:
+                key = tuple(key)
+                if metric["type"] == "gauge":
+                    samples[key] = value
+                elif metric["type"] == "histogram":
+                    if key in samples and len(samples[key]) == len(value):
+                        value = [a + b for a, b in zip(samples[key], value)]
+                    samples[key] = value
+                else:
+                    samples[key] = samples.get(key, 0) + value
+    return {
+        "written_at": time.time(),
+        "metrics": {
+            name: {
+                **metric,
+                "samples": [
+                    [list(key), value] for key, value in metric["samples"].items()
+                ],
+            }
+            for name, metric in merged.items()
+        },
+    }
+
+
+def collect(directory: Optional[str] = None) -> dict:
+    """
+    Every process's metrics added together.
+
+    Snapshots from processes that have exited are merged into the archive
+    and removed.
+    """
+    directory = directory or get_metrics_dir()
+    os.makedirs(directory, exist_ok=True)
+    archive_path = os.path.join(directory, ARCHIVE_NAME)
+    with open(os.path.join(directory, ".lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        archive = _read_json(archive_path) if os.path.exists(archive_path) else None
+        live, exited, exited_paths = [], [], []
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".json") or filename == ARCHIVE_NAME:
+                continue
+            path = os.path.join(directory, filename)
+            snapshot = _read_json(path)
+            if snapshot is None:
+                continue
+            if _is_running(filename[: -len(".json")]):
+                live.append(snapshot)
+            else:
+                exited.append(snapshot)
+                exited_paths.append(path)
+
+        if exited:
+            archive = merge(([archive] if archive else []) + exited, keep_gauges=False)
+            _write_json(archive_path, archive)
+            for path in exited_paths:
+                os.remove(path)
+    return merge(([archive] if archive else []) + live)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    ]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render(snapshot: dict) -> str:
+    """
+    A snapshot in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, metric in sorted(snapshot["metrics"].items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        labelnames = metric["labelnames"]
+        for key, value in sorted(metric["samples"]):
+            if metric["type"] != "histogram":
+                labels = _format_labels(labelnames, key)
+                lines.append(f"{name}{labels} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + [math.inf], value[:-1]):
+                cumulative += count
+                labels = _format_labels(
+                    labelnames + ["le"], key + [_format_value(bound)]
+                )
+                lines.append(f"{name}_bucket{labels} {_format_value(cumulative)}")
+            labels = _format_labels(labelnames, key)
+            lines.append(f"{name}_sum{labels} {_format_value(value[-1])}")
+            lines.append(f"{name}_count{labels} {_format_value(cumulative)}")
+    return "\n".join(lines) + "\n"
+
+
+def _write_at_exit():
+    if settings.TEST:
+        return
+    try:
+        REGISTRY.write_snapshot()
+    except OSError:
+        pass
+
+
+atexit.register(_write_at_exit)
@@ -0,0 +1,87 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from irrigate import profiling
+
+logger = logging.getLogger(__name__)
+
+
+class ProfilingMiddleware:
+    """
+    Time each request's SQL, weather calls and template rendering, and send
+    the totals back as a Server-Timing header for browser devtools.
+
+    Requests slower than REQUEST_PROFILING_SLOW_SECONDS are logged with
+    their slowest queries. Timing is on with REQUEST_PROFILING, and with
+    PROFILE_REQUESTS a cProfile of each request is saved. Off otherwise.
+    """
+
+    def __init__(self, get_response):
+        if not (settings.REQUEST_PROFILING or settings.PROFILE_REQUESTS):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if settings.PROFILE_REQUESTS:
+            with profiling.capture_profile(f"{request.method} {request.path}"):
+                return self._handle(request)
+        return self._handle(request)
+
+    def _handle(self, request):
+        if not settings.REQUEST_PROFILING:
+            return self.get_response(request)
+
+        profile = profiling.RequestProfile()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            stack.enter_context(profiling.activate(profile))
+            for connection in connections.all():
+                stack.enter_context(
+                    connection.execute_wrapper(self._query_wrapper(profile))
+                )
+            response = self.get_response(request)
+        total_seconds = time.perf_counter() - started
+
+        response["Server-Timing"] = profile.server_timing(total_seconds)
+        if total_seconds >= settings.REQUEST_PROFILING_SLOW_SECONDS:
+            self._log_slow_request(request, profile, total_seconds)
+        return response
+
+    def process_template_response(self, request, response):
+        # views that render themselves time it with profiling.timed
+        if not response.is_rendered:
+            started = time.perf_counter()
+            response.add_post_render_callback(
+                lambda response: profiling.record(
+                    "template", time.perf_counter() - started
+                )
+            )
+        return response
+
+    @staticmethod
+    def _query_wrapper(profile):
+        def wrapper(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                profile.record_query(sql, time.perf_counter() - started)
+
+        return wrapper
+
+    @staticmethod
+    def _log_slow_request(request, profile, total_seconds):
+        queries = "\n".join(
+            f"  {query.seconds * 1000:.1f} ms: {query.sql}"
+            for query in profile.slowest_queries
+        )
+        logger.warning(
+            f"Slow request {request.method} {request.path} took "
+            f"{total_seconds * 1000:.0f} ms ({profile.server_timing()}). "
+            f"Slowest queries:\n{queries}"
+        )
@@ -0,0 +1,49 @@
+# Generated by Django 3.2.4 on 2026-10-18 06:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("irrigate", "0014_actuator_grass_seed_mode"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WeatherDay",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("location", models.CharField(max_length=255)),
+                ("totalprecip_in", models.FloatField()),
+                ("maxtemp_f", models.FloatField()),
+                (
+                    "source",
+                    models.CharField(
+                        choices=[("history", "History"), ("forecast", "Forecast")],
+                        default="history",
+                        max_length=16,
+                    ),
+                ),
+                ("fetched_at", models.DateTimeField()),
+            ],
+            options={
+                "ordering": ("date",),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="weatherday",
+            constraint=models.UniqueConstraint(
+                fields=("location", "date"), name="unique_weather_day_per_location"
+            ),
+        ),
+    ]
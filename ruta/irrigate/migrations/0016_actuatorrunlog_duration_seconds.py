@@ -0,0 +1,39 @@
+# Generated by Django 3.2.4 on 2026-10-18 06:11
+
+from django.db import migrations, models
+
+
+def backfill_duration_seconds(apps, schema_editor):
+    ActuatorRunLog = apps.get_model("irrigate", "ActuatorRunLog")
+    runs = ActuatorRunLog.objects.filter(end_datetime__isnull=False).only(
+        "start_datetime", "end_datetime"
+    )
+    batch = []
+    for run in runs.iterator():
+        run.duration_seconds = (run.end_datetime - run.start_datetime).total_seconds()
+        batch.append(run)
+        if len(batch) >= 500:
+            ActuatorRunLog.objects.bulk_update(batch, ["duration_seconds"])
+            batch = []
+    ActuatorRunLog.objects.bulk_update(batch, ["duration_seconds"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("irrigate", "0015_weatherday"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="actuatorrunlog",
+            name="duration_seconds",
+            field=models.FloatField(
+                blank=True,
+                db_index=True,
+                help_text="How long the run lasted. Set once the run has ended",
+                null=True,
+            ),
+        ),
+        migrations.RunPython(backfill_duration_seconds, migrations.RunPython.noop),
+    ]
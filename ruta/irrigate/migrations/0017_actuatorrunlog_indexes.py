@@ -0,0 +1,38 @@
+# Generated by Django 3.2.4 on 2026-10-18 06:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("irrigate", "0016_actuatorrunlog_duration_seconds"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="actuatorrunlog",
+            index=models.Index(
+                fields=["schedule_time", "actuator", "start_datetime"],
+                name="runlog_schedule_actuator_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="actuatorrunlog",
+            index=models.Index(
+                fields=["actuator", "start_datetime"], name="runlog_actuator_start_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="actuatorrunlog",
+            index=models.Index(fields=["-start_datetime"], name="runlog_start_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="actuatorrunlog",
+            index=models.Index(
+                condition=models.Q(("end_datetime__isnull", True)),
+                fields=["-start_datetime"],
+                name="runlog_open_runs_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.4 on 2026-10-18 06:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("irrigate", "0017_actuatorrunlog_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="device",
+            name="max_concurrent_actuators",
+            field=models.PositiveSmallIntegerField(
+                default=1,
+                help_text="How many zones the water supply can run at the same time",
+            ),
+        ),
+        migrations.AddField(
+            model_name="device",
+            name="max_flow_rate_per_minute",
+            field=models.FloatField(
+                blank=True,
+                help_text="Most combined flow rate the water supply can keep up with across running zones. Leave blank for no limit",
+                null=True,
+            ),
+        ),
+    ]
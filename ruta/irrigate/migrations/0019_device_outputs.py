@@ -0,0 +1,62 @@
+# Generated by Django 3.2.4 on 2026-10-18 06:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("irrigate", "0018_device_supply_limits"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="device",
+            name="gpio_chip",
+            field=models.PositiveSmallIntegerField(
+                default=0, help_text="GPIO chip number, for GPIO chip outputs"
+            ),
+        ),
+        migrations.AddField(
+            model_name="device",
+            name="i2c_address",
+            field=models.PositiveSmallIntegerField(
+                blank=True,
+                help_text="Address of the relay expander on the bus (e.g. 32 for 0x20)",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="device",
+            name="i2c_bus",
+            field=models.PositiveSmallIntegerField(
+                default=1, help_text="I2C bus number, for relay expander outputs"
+            ),
+        ),
+        migrations.AddField(
+            model_name="device",
+            name="i2c_channels",
+            field=models.PositiveSmallIntegerField(
+                choices=[(8, "8"), (16, "16")],
+                default=8,
+                help_text="How many relay channels the expander has",
+            ),
+        ),
+        migrations.AddField(
+            model_name="device",
+            name="output_type",
+            field=models.CharField(
+                choices=[("gpio", "GPIO chip"), ("i2c", "I2C relay expander")],
+                default="gpio",
+                help_text="What the zone relays are wired to",
+                max_length=8,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="actuator",
+            name="gpio_pin",
+            field=models.SmallIntegerField(
+                help_text="GPIO pin on the raspberry pi, or channel on the device's relay expander"
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 3.2.4 on 2026-10-18 07:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("irrigate", "0019_device_outputs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="actuatorrunlog",
+            name="planned_end_datetime",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="When a timed run is due to end. A watchdog shuts the valve off shortly after if the run is still going",
+                null=True,
+            ),
+        ),
+    ]
@@ -1,26 +1,50 @@
 import logging
+from collections import defaultdict
 from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
+from django.core.exceptions import ValidationError
 from django.db import models, transaction
 from django.db.models import Q
 from django.utils import timezone
 
 from irrigate.constants import (
+    FORECAST_WINDOW_CONSIDERED_IN_DAYS,
     MINIMUM_WATER_DURATION_IN_SECONDS,
+    RECENT_WATER_WINDOW_IN_DAYS,
     SKIP_WATERING_THRESHOLD_IN_SECONDS,
 )
-from irrigate.gpio import GPIO
+from irrigate.gpio import (
+    OFF,
+    ON,
+    WATCHDOG_GRACE_SECONDS,
+    ChipOutput,
+    ExpanderOutput,
+    GPIOWriteError,
+    arm_shutoff,
+    disarm_shutoff,
+    get_shutoff_time,
+)
 from irrigate.weather import (
-    get_current_weather,
-    get_forecasted_weather,
-    get_historical_weather,
+    WeatherSnapshot,
+    fetch_historical_weather,
+    get_local_date,
 )
 
 logger = logging.getLogger(__name__)
 
 
+# how often to re-fetch a day that was still in progress when it was stored
+WEATHER_DAY_REFRESH_INTERVAL = timedelta(hours=1)
+
+
+def seconds_to_minutes(seconds: Optional[float]) -> float:
+    if not seconds:
+        return 0
+    return seconds / 60
+
+
 @dataclass(frozen=True)
 class DurationSummary:
     recent_rain_inches: float
@@ -39,15 +63,175 @@ class DurationSummary:
         return self.final_duration_seconds / 60
 
 
+def get_temperature_multiplier(max_temperature: Optional[float]) -> float:
+    if max_temperature is None:
+        logger.warning("No temperature forecast, not adjusting for temperature")
+        return 1
+
+    if max_temperature >= 85:
+        return 1.3
+    elif max_temperature >= 65:
+        return 1
+    elif max_temperature >= 45:
+        return 0.7
+
+    return 0
+
+
+def _clamp_duration(
+    calculated_duration_in_seconds: float, baseline_duration: float
+) -> Tuple[float, str]:
+    if calculated_duration_in_seconds < SKIP_WATERING_THRESHOLD_IN_SECONDS:
+        return 0, "Skipped"
+
+    final_duration_in_seconds = min(
+        max(calculated_duration_in_seconds, MINIMUM_WATER_DURATION_IN_SECONDS),
+        baseline_duration,
+    )
+    if final_duration_in_seconds == MINIMUM_WATER_DURATION_IN_SECONDS:
+        return final_duration_in_seconds, "Minimum applied"
+    elif final_duration_in_seconds == baseline_duration:
+        return final_duration_in_seconds, "Capped at baseline"
+    return final_duration_in_seconds, "Calculated"
+
+
+def summarize_durations(
+    base_inches_per_week: Sequence[float],
+    flow_rate_per_minute: Sequence[float],
+    baseline_duration_seconds: Sequence[float],
+    recent_sprinkler_minutes: Sequence[float],
+    recent_rain_inches: float,
+    forecasted_rain_inches: float,
+    temperature_multiplier: float,
+) -> List[DurationSummary]:
+    """
+    Work out how long each zone should water and why.
+
+    Zone inputs are columns with one entry per zone. Weather is the same for
+    every zone so it is passed once. Each step runs over whole columns, so
+    one zone and a whole fleet go through the same code.
+    """
+    sprinkler_inches = [
+        minutes * flow_rate
+        for minutes, flow_rate in zip(recent_sprinkler_minutes, flow_rate_per_minute)
+    ]
+    rolling_weekly_shortfalls = [
+        required - (recent_rain_inches + sprinkler + forecasted_rain_inches)
+        for required, sprinkler in zip(base_inches_per_week, sprinkler_inches)
+    ]
+    base_durations = [
+        (shortfall / flow_rate) * 60 if flow_rate else 0
+        for shortfall, flow_rate in zip(rolling_weekly_shortfalls, flow_rate_per_minute)
+    ]
+    calculated_durations = [
+        base_duration * temperature_multiplier for base_duration in base_durations
+    ]
+    final_durations = [
+        _clamp_duration(calculated, baseline)
+        for calculated, baseline in zip(calculated_durations, baseline_duration_seconds)
+    ]
+
+    return [
+        DurationSummary(
+            recent_rain_inches=recent_rain_inches,
+            recent_sprinkler_minutes=recent_sprinkler_minutes[i],
+            recent_sprinkler_inches=sprinkler_inches[i],
+            forecasted_rain_inches=forecasted_rain_inches,
+            baseline_duration_seconds=baseline_duration_seconds[i],
+            base_duration_seconds=base_durations[i],
+            temperature_multiplier=temperature_multiplier,
+            calculated_duration_seconds=calculated_durations[i],
+            final_duration_seconds=final_durations[i][0],
+            reason=final_durations[i][1],
+        )
+        for i in range(len(base_durations))
+    ]
+
+
 class Device(models.Model):
     name = models.CharField(
         max_length=255,
         help_text="Unique ID for a given device (e.g. garage pi, garden pi)",
     )
+    max_concurrent_actuators = models.PositiveSmallIntegerField(
+        default=1,
+        help_text="How many zones the water supply can run at the same time",
+    )
+
+    class OutputType(models.TextChoices):
+        GPIO = "gpio", "GPIO chip"
+        I2C_EXPANDER = "i2c", "I2C relay expander"
+
+    output_type = models.CharField(
+        max_length=8,
+        choices=OutputType.choices,
+        default=OutputType.GPIO,
+        help_text="What the zone relays are wired to",
+    )
+    gpio_chip = models.PositiveSmallIntegerField(
+        default=0, help_text="GPIO chip number, for GPIO chip outputs"
+    )
+    i2c_bus = models.PositiveSmallIntegerField(
+        default=1, help_text="I2C bus number, for relay expander outputs"
+    )
+    i2c_address = models.PositiveSmallIntegerField(
+        blank=True,
+        null=True,
+        help_text="Address of the relay expander on the bus (e.g. 32 for 0x20)",
+    )
+    i2c_channels = models.PositiveSmallIntegerField(
+        choices=[(8, "8"), (16, "16")],
+        default=8,
+        help_text="How many relay channels the expander has",
+    )
+    max_flow_rate_per_minute = models.FloatField(
+        blank=True,
+        null=True,
+        help_text=(
+            "Most combined flow rate the water supply can keep up with across "
+            "running zones. Leave blank for no limit"
+        ),
+    )
 
     def __str__(self):
         return self.name
 
+    def clean(self):
+        if (
+            self.output_type == self.OutputType.I2C_EXPANDER
+            and self.i2c_address is None
+        ):
+            raise ValidationError(
+                {"i2c_address": "Relay expander outputs need an I2C address"}
+            )
+
+    def get_output(self):
+        if self.output_type == self.OutputType.I2C_EXPANDER:
+            return ExpanderOutput(
+                self.i2c_bus, self.i2c_address, channels=self.i2c_channels
+            )
+        return ChipOutput(self.gpio_chip)
+
+    def has_capacity_for(
+        self, actuator: "Actuator", running: Sequence["Actuator"]
+    ) -> bool:
+        """
+        Whether `actuator` can start alongside this device's `running`
+        actuators without going over the water supply limits.
+
+        A zone can always run on its own, even if its flow is over the limit.
+        """
+        if not running:
+            return True
+        if len(running) >= self.max_concurrent_actuators:
+            return False
+        if self.max_flow_rate_per_minute is None:
+            return True
+        total_flow_rate = actuator.flow_rate_per_minute + sum(
+            other.flow_rate_per_minute for other in running
+        )
+        return total_flow_rate <= self.max_flow_rate_per_minute
+
 
 class Actuator(models.Model):
     """
@@ -60,7 +244,9 @@ class Actuator(models.Model):
     name = models.CharField(
         max_length=255, help_text="A name to help identify which actuator this is"
     )
-    gpio_pin = models.SmallIntegerField(help_text="GPIO pin on the raspberry pi")
+    gpio_pin = models.SmallIntegerField(
+        help_text="GPIO pin on the raspberry pi, or channel on the device's relay expander"
+    )
     device = models.ForeignKey(Device, on_delete=models.CASCADE)
     flow_rate_per_minute = models.FloatField(default=0.025)
     base_inches_per_week = models.FloatField(default=1)
@@ -72,17 +258,20 @@ class Actuator(models.Model):
     def __str__(self):
         return f"{self.name} - {self.gpio_pin}"
 
-    def get_precipitation_from_rain_in_inches(self, days_ago=3):
+    def get_precipitation_from_rain_in_inches(
+        self, days_ago=3, snapshot: Optional[WeatherSnapshot] = None
+    ):
         """
         Get the amount of precipitation that has fallen.
         """
-        data = get_historical_weather(days_ago=days_ago)
-        return sum(
-            [day["day"]["totalprecip_in"] for day in data["forecast"]["forecastday"]]
-        )
+        snapshot = snapshot or WeatherSnapshot()
+        return snapshot.get_precipitation_in_inches(days_ago=days_ago)
 
     def get_forecasted_precipitation_from_rain_in_inches(
-        self, days=3, decay_factor=0.9
+        self,
+        days=3,
+        decay_factor=0.9,
+        snapshot: Optional[WeatherSnapshot] = None,
     ):
         """
         Get forecasted rain amount.
@@ -91,107 +280,62 @@ class Actuator(models.Model):
 
         TODO could improve by using forecast confidence, if available.
         """
-        data = get_forecasted_weather(days=days)
-        return sum(
-            [
-                day["day"]["totalprecip_in"] * (decay_factor**i)
-                for i, day in enumerate(data["forecast"]["forecastday"])
-            ]
-        )
-
-    def get_todays_high_temperature(self):
-        forecasted_weather = get_forecasted_weather(days=1)
-        return forecasted_weather["forecast"]["forecastday"][0]["day"]["maxtemp_f"]
-
-    def get_temperature_watering_adjustment_multiplier(self) -> float:
-        max_temperature = self.get_todays_high_temperature()
-
-        if max_temperature >= 85:
-            return 1.3
-        elif max_temperature >= 65:
-            return 1
-        elif max_temperature >= 45:
-            return 0.7
-
-        return 0
-
-    def _get_base_duration_in_seconds(self):
-        required_inches_of_water_per_week = self.base_inches_per_week
-
-        baseline_duration = self.duration_in_minutes_per_scheduled_day * 60
-        rain_amount = self.get_precipitation_from_rain_in_inches(days_ago=3)
-        sprinkler_amount = self.get_recent_water_amount_in_inches(days_ago=3)
-        forecasted_rain_amount = self.get_forecasted_precipitation_from_rain_in_inches(
-            days=2
-        )
-
-        rolling_weekly_shortfall = required_inches_of_water_per_week - (
-            rain_amount + sprinkler_amount + forecasted_rain_amount
-        )
-        logger.info(
-            f"Rain amount: {rain_amount} - Sprinkler amount: {sprinkler_amount} - Baseline duration - {baseline_duration} - Shortfall: {rolling_weekly_shortfall}"
+        snapshot = snapshot or WeatherSnapshot()
+        return snapshot.get_forecasted_precipitation_in_inches(
+            days=days, decay_factor=decay_factor
         )
 
-        return (rolling_weekly_shortfall / self.flow_rate_per_minute) * 60
+    def get_todays_high_temperature(self, snapshot: Optional[WeatherSnapshot] = None):
+        snapshot = snapshot or WeatherSnapshot()
+        return snapshot.get_todays_high_temperature()
 
-    def get_duration_summary(self) -> DurationSummary:
-        required_inches_of_water_per_week = self.base_inches_per_week
-        baseline_duration = self.duration_in_minutes_per_scheduled_day * 60
-        rain_amount = self.get_precipitation_from_rain_in_inches(days_ago=3)
-        sprinkler_minutes = self.get_recent_water_duration_in_minutes(days_ago=3)
-        sprinkler_amount = sprinkler_minutes * self.flow_rate_per_minute
-        forecasted_rain_amount = self.get_forecasted_precipitation_from_rain_in_inches(
-            days=2
+    def get_temperature_watering_adjustment_multiplier(
+        self, snapshot: Optional[WeatherSnapshot] = None
+    ) -> float:
+        return get_temperature_multiplier(
+            self.get_todays_high_temperature(snapshot=snapshot)
         )
 
-        rolling_weekly_shortfall = required_inches_of_water_per_week - (
-            rain_amount + sprinkler_amount + forecasted_rain_amount
-        )
-        logger.info(
-            f"Rain amount: {rain_amount} - Sprinkler amount: {sprinkler_amount} - Baseline duration - {baseline_duration} - Shortfall: {rolling_weekly_shortfall}"
-        )
-
-        base_duration_in_seconds = (
-            rolling_weekly_shortfall / self.flow_rate_per_minute
-        ) * 60
-        temperature_multiplier = self.get_temperature_watering_adjustment_multiplier()
-        logger.info(
-            f"Base duration is {base_duration_in_seconds} and temperature multipler is {temperature_multiplier}"
-        )
+    def _get_base_duration_in_seconds(self, snapshot: Optional[WeatherSnapshot] = None):
+        return self.get_duration_summary(snapshot=snapshot).base_duration_seconds
 
-        calculated_duration_in_seconds = (
-            base_duration_in_seconds * temperature_multiplier
-        )
+    def get_duration_summary(
+        self,
+        snapshot: Optional[WeatherSnapshot] = None,
+        recent_sprinkler_minutes: Optional[float] = None,
+    ) -> DurationSummary:
+        """
+        Work out how long to water and why.
 
-        if calculated_duration_in_seconds < SKIP_WATERING_THRESHOLD_IN_SECONDS:
-            final_duration_in_seconds = 0
-            reason = "Skipped"
-        else:
-            final_duration_in_seconds = min(
-                max(calculated_duration_in_seconds, MINIMUM_WATER_DURATION_IN_SECONDS),
-                baseline_duration,
+        Use `plan_durations` instead when calculating several actuators.
+        """
+        snapshot = snapshot or WeatherSnapshot()
+        if recent_sprinkler_minutes is None:
+            recent_sprinkler_minutes = self.get_recent_water_duration_in_minutes(
+                days_ago=RECENT_WATER_WINDOW_IN_DAYS
             )
-            if final_duration_in_seconds == MINIMUM_WATER_DURATION_IN_SECONDS:
-                reason = "Minimum applied"
-            elif final_duration_in_seconds == baseline_duration:
-                reason = "Capped at baseline"
-            else:
-                reason = "Calculated"
-
-        return DurationSummary(
-            recent_rain_inches=rain_amount,
-            recent_sprinkler_minutes=sprinkler_minutes,
-            recent_sprinkler_inches=sprinkler_amount,
-            forecasted_rain_inches=forecasted_rain_amount,
-            baseline_duration_seconds=baseline_duration,
-            base_duration_seconds=base_duration_in_seconds,
-            temperature_multiplier=temperature_multiplier,
-            calculated_duration_seconds=calculated_duration_in_seconds,
-            final_duration_seconds=final_duration_in_seconds,
-            reason=reason,
+
+        [summary] = summarize_durations(
+            base_inches_per_week=[self.base_inches_per_week],
+            flow_rate_per_minute=[self.flow_rate_per_minute],
+            baseline_duration_seconds=[self.duration_in_minutes_per_scheduled_day * 60],
+            recent_sprinkler_minutes=[recent_sprinkler_minutes],
+            recent_rain_inches=self.get_precipitation_from_rain_in_inches(
+                days_ago=RECENT_WATER_WINDOW_IN_DAYS, snapshot=snapshot
+            ),
+            forecasted_rain_inches=self.get_forecasted_precipitation_from_rain_in_inches(
+                days=FORECAST_WINDOW_CONSIDERED_IN_DAYS, snapshot=snapshot
+            ),
+            temperature_multiplier=self.get_temperature_watering_adjustment_multiplier(
+                snapshot=snapshot
+            ),
         )
+        logger.info(f"Duration for {self}: {summary}")
+        return summary
 
-    def get_duration_in_seconds(self) -> int:
+    def get_duration_in_seconds(
+        self, snapshot: Optional[WeatherSnapshot] = None
+    ) -> int:
         """
         Calculate the total time the sprinkler needs to run to get the desired amount
         of amount of water.
@@ -203,7 +347,7 @@ class Actuator(models.Model):
         boundaries.
         """
 
-        return self.get_duration_summary().final_duration_seconds
+        return self.get_duration_summary(snapshot=snapshot).final_duration_seconds
 
     @property
     def total_duration_in_minutes_per_week(self):
@@ -234,22 +378,59 @@ class Actuator(models.Model):
             run_type=ScheduleTime.RunType.RECURRING
         ).count()
 
-    def get_recent_water_duration_in_minutes(self, days_ago=7):
-        now = timezone.now()
-        start_datetime = now - timedelta(days=days_ago)
-        recent_runs = ActuatorRunLog.objects.filter(
-            actuator=self, start_datetime__gt=start_datetime
+    @classmethod
+    def get_numbers_of_scheduled_times(cls, actuators) -> Dict[int, int]:
+        """
+        `get_number_of_scheduled_times` for many actuators in one query, keyed
+        by actuator id. Actuators without recurring runs are missing.
+        """
+        counts = (
+            ScheduleTime.actuators.through.objects.filter(
+                actuator__in=actuators,
+                scheduletime__run_type=ScheduleTime.RunType.RECURRING,
+            )
+            .order_by()
+            .values("actuator_id")
+            .annotate(count=models.Count("id"))
+            .values_list("actuator_id", "count")
         )
+        return dict(counts)
+
+    def get_recent_water_duration_in_minutes(self, days_ago=7):
+        return self.get_recent_water_durations_in_minutes(
+            days_ago=days_ago, actuators=[self]
+        ).get(self.id, 0)
 
-        total_minutes = 0
-        for run in recent_runs:
-            # being defensive here. if no end datetime is specified, do not
-            # count it
-            if not run.end_datetime:
-                continue
-            total_minutes += (run.end_datetime - run.start_datetime).seconds / 60
+    @classmethod
+    def get_recent_water_durations_in_minutes(cls, days_ago=7, actuators=None):
+        """
+        Minutes each actuator has watered for in the last `days_ago` days,
+        keyed by actuator id, in one query.
 
-        return total_minutes
+        Runs still in progress have no duration yet and count as zero.
+        Actuators that haven't run are missing from the result.
+        """
+        # summing per actuator in a subquery lets each sum use the
+        # (actuator, start_datetime) index, where a GROUP BY over the whole
+        # table would scan it
+        recent_water_seconds = (
+            ActuatorRunLog.objects.filter(
+                actuator=models.OuterRef("pk"),
+                start_datetime__gt=timezone.now() - timedelta(days=days_ago),
+            )
+            .order_by()
+            .values("actuator")
+            .annotate(total=models.Sum("duration_seconds"))
+            .values("total")
+        )
+        totals = cls.objects.annotate(total=models.Subquery(recent_water_seconds))
+        if actuators is not None:
+            totals = totals.filter(pk__in=[actuator.pk for actuator in actuators])
+        totals = totals.filter(total__isnull=False)
+        return {
+            actuator_id: seconds_to_minutes(total)
+            for actuator_id, total in totals.values_list("pk", "total")
+        }
 
     def get_recent_water_amount_in_inches(self, days_ago=7):
         return (
@@ -258,24 +439,40 @@ class Actuator(models.Model):
         )
 
     @transaction.atomic
-    def start(self, schedule_time: Optional["ScheduleTime"] = None):
+    def start(
+        self,
+        schedule_time: Optional["ScheduleTime"] = None,
+        duration_in_seconds: Optional[float] = None,
+    ):
         """
         Start the actuator
+
+        Given a duration, a watchdog is armed to turn it off again even if
+        this process dies before stopping it.
         """
-        with GPIO(self.gpio_pin) as gpio:
-            gpio.start()
-            if not schedule_time:
-                schedule_time = ScheduleTime.objects.create(
-                    run_type=ScheduleTime.RunType.ONE_OFF,
-                    start_time=datetime.now().time(),
-                    weekday=datetime.now().weekday(),
-                )
-                schedule_time.actuators.add(self)
-            ActuatorRunLog.objects.create(
-                actuator=self,
-                start_datetime=timezone.now(),
-                schedule_time=schedule_time,
+        output = self.device.get_output()
+        output.write(self.gpio_pin, ON)
+        if not schedule_time:
+            schedule_time = ScheduleTime.objects.create(
+                run_type=ScheduleTime.RunType.ONE_OFF,
+                start_time=datetime.now().time(),
+                weekday=datetime.now().weekday(),
             )
+            schedule_time.actuators.add(self)
+        start_datetime = timezone.now()
+        planned_end_datetime = (
+            start_datetime + timedelta(seconds=duration_in_seconds)
+            if duration_in_seconds
+            else None
+        )
+        run = ActuatorRunLog.objects.create(
+            actuator=self,
+            start_datetime=start_datetime,
+            planned_end_datetime=planned_end_datetime,
+            schedule_time=schedule_time,
+        )
+        if planned_end_datetime:
+            arm_shutoff(output, self.gpio_pin, run.id, planned_end_datetime)
 
     @transaction.atomic
     def stop(
@@ -286,25 +483,118 @@ class Actuator(models.Model):
         """
         Stop the actuator
         """
-        with GPIO(self.gpio_pin) as gpio:
-            gpio.stop()
-            current_runs = ActuatorRunLog.objects.filter(
-                actuator=self,
-                end_datetime__isnull=True,
+        self.device.get_output().write(self.gpio_pin, OFF)
+        current_runs = ActuatorRunLog.objects.filter(
+            actuator=self,
+            end_datetime__isnull=True,
+        )
+
+        # stopping clears any runs that haven't been ended
+        for current_run in current_runs:
+            end_datetime = (
+                timezone.now()
+                if not duration_in_seconds
+                else (
+                    current_run.start_datetime + timedelta(seconds=duration_in_seconds)
+                )
             )
+            current_run.end_datetime = end_datetime
+            current_run.save()
+        disarm_shutoff(current_run.id for current_run in current_runs)
 
-            # stopping clears any runs that haven't been ended
-            for current_run in current_runs:
-                end_datetime = (
-                    timezone.now()
-                    if not duration_in_seconds
-                    else (
-                        current_run.start_datetime
-                        + timedelta(seconds=duration_in_seconds)
-                    )
+    @classmethod
+    def stop_many(cls, actuators: Iterable["Actuator"]):
+        """
+        Stop several actuators at once, with one write per GPIO chip or relay
+        expander and one update closing all of their open runs.
+
+        Actuators that can't be switched off don't hold up the rest. Every
+        other one is stopped and its runs closed, then a GPIOWriteError is
+        raised for those left running, whose watchdogs stay armed.
+        """
+        actuators = list(actuators)
+        devices = Device.objects.in_bulk({actuator.device_id for actuator in actuators})
+        outputs = {}
+        levels = defaultdict(dict)
+        by_channel = {}
+        for actuator in actuators:
+            output = devices[actuator.device_id].get_output()
+            outputs.setdefault(output.key, output)
+            levels[output.key][actuator.gpio_pin] = OFF
+            by_channel[(output.key, actuator.gpio_pin)] = actuator
+        failed = {}
+        for key, output in outputs.items():
+            try:
+                output.write_many(levels[key])
+            except GPIOWriteError as e:
+                failed.update(
+                    (by_channel[(key, pin)], error) for pin, error in e.failed.items()
                 )
-                current_run.end_datetime = end_datetime
-                current_run.save()
+            except Exception as e:
+                failed.update((by_channel[(key, pin)], e) for pin in levels[key])
+        stopped = [actuator for actuator in actuators if actuator not in failed]
+
+        now = timezone.now()
+        with transaction.atomic():
+            current_runs = list(
+                ActuatorRunLog.objects.filter(
+                    actuator__in=stopped, end_datetime__isnull=True
+                )
+            )
+            for current_run in current_runs:
+                current_run.end_datetime = now
+                current_run.duration_seconds = current_run.get_duration_seconds()
+            ActuatorRunLog.objects.bulk_update(
+                current_runs, ["end_datetime", "duration_seconds"]
+            )
+        disarm_shutoff(current_run.id for current_run in current_runs)
+        if failed:
+            raise GPIOWriteError(failed)
+
+
+def plan_durations(
+    actuators: Iterable[Actuator], snapshot: Optional[WeatherSnapshot] = None
+) -> Dict[int, DurationSummary]:
+    """
+    Duration summaries for many actuators at once, keyed by actuator id.
+
+    Schedule counts and recent sprinkler time come from one query each and
+    weather from one snapshot, however many actuators there are.
+    """
+    actuators = list({actuator.id: actuator for actuator in actuators}.values())
+    if not actuators:
+        return {}
+    snapshot = snapshot or WeatherSnapshot()
+
+    scheduled_times = Actuator.get_numbers_of_scheduled_times(actuators)
+    recent_sprinkler_minutes = Actuator.get_recent_water_durations_in_minutes(
+        days_ago=RECENT_WATER_WINDOW_IN_DAYS, actuators=actuators
+    )
+    summaries = summarize_durations(
+        base_inches_per_week=[actuator.base_inches_per_week for actuator in actuators],
+        flow_rate_per_minute=[actuator.flow_rate_per_minute for actuator in actuators],
+        baseline_duration_seconds=[
+            actuator.total_duration_in_minutes_per_week
+            / scheduled_times[actuator.id]
+            * 60
+            if scheduled_times.get(actuator.id)
+            else 0
+            for actuator in actuators
+        ],
+        recent_sprinkler_minutes=[
+            recent_sprinkler_minutes.get(actuator.id, 0) for actuator in actuators
+        ],
+        recent_rain_inches=snapshot.get_precipitation_in_inches(
+            days_ago=RECENT_WATER_WINDOW_IN_DAYS
+        ),
+        forecasted_rain_inches=snapshot.get_forecasted_precipitation_in_inches(
+            days=FORECAST_WINDOW_CONSIDERED_IN_DAYS
+        ),
+        temperature_multiplier=get_temperature_multiplier(
+            snapshot.get_todays_high_temperature()
+        ),
+    )
+    return {actuator.id: summary for actuator, summary in zip(actuators, summaries)}
 
 
 class ScheduleTime(models.Model):
@@ -335,10 +625,33 @@ class ScheduleTime(models.Model):
 class ActuatorRunLog(models.Model):
     class Meta:
         ordering = ("-start_datetime",)
+        indexes = [
+            # has_run: runs of an actuator for a schedule time on a day
+            models.Index(
+                fields=["schedule_time", "actuator", "start_datetime"],
+                name="runlog_schedule_actuator_idx",
+            ),
+            # has_run_recently and recent water totals
+            models.Index(
+                fields=["actuator", "start_datetime"],
+                name="runlog_actuator_start_idx",
+            ),
+            # dashboard run history, newest first
+            models.Index(fields=["-start_datetime"], name="runlog_start_idx"),
+            # runs still in progress, newest first. skipped on backends
+            # without partial indexes
+            models.Index(
+                fields=["-start_datetime"],
+                condition=Q(end_datetime__isnull=True),
+                name="runlog_open_runs_idx",
+            ),
+        ]
 
     RUNNING = "running"
     FINISHED = "finished"
     SKIPPED = "skipped"
+    # runs this short round to 0.00 minutes and count as skipped
+    SKIPPED_BELOW_SECONDS = 0.3
 
     actuator = models.ForeignKey(Actuator, on_delete=models.CASCADE)
     schedule_time = models.ForeignKey(
@@ -350,10 +663,59 @@ class ActuatorRunLog(models.Model):
     )
     start_datetime = models.DateTimeField()
     end_datetime = models.DateTimeField(blank=True, null=True)
+    planned_end_datetime = models.DateTimeField(
+        blank=True,
+        null=True,
+        help_text="When a timed run is due to end. A watchdog shuts the valve off shortly after if the run is still going",
+    )
+    duration_seconds = models.FloatField(
+        blank=True,
+        null=True,
+        db_index=True,
+        help_text="How long the run lasted. Set once the run has ended",
+    )
 
     def __str__(self):
         return f"{self.start_datetime} - {self.end_datetime} - {self.status} - {self.actuator}"
 
+    def save(self, *args, **kwargs):
+        if self.end_datetime:
+            self.duration_seconds = self.get_duration_seconds()
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def close_overdue_runs(cls) -> List["ActuatorRunLog"]:
+        """
+        End timed runs left open past their watchdog's deadline, which
+        happens when the process running them died.
+
+        Each run ends when its watchdog shut the valve off, or at its planned
+        end if the watchdog left no record.
+        """
+        overdue = list(
+            cls.objects.filter(
+                end_datetime__isnull=True,
+                planned_end_datetime__lt=timezone.now()
+                - timedelta(seconds=WATCHDOG_GRACE_SECONDS),
+            )
+        )
+        fired = []
+        for run in overdue:
+            shutoff_time = get_shutoff_time(run.id)
+            if shutoff_time:
+                fired.append(run.id)
+            run.end_datetime = shutoff_time or run.planned_end_datetime
+            run.duration_seconds = run.get_duration_seconds()
+            logger.warning(f"Closing run {run.id} of actuator {run.actuator_id}")
+        cls.objects.bulk_update(overdue, ["end_datetime", "duration_seconds"])
+        # watchdogs still retrying keep their token
+        disarm_shutoff(fired)
+        return overdue
+
+    def get_duration_seconds(self):
+        end_datetime = self.end_datetime or timezone.now()
+        return (end_datetime - self.start_datetime).total_seconds()
+
     @property
     def status(self):
         if self.duration_in_minutes == 0:
@@ -368,5 +730,104 @@ class ActuatorRunLog(models.Model):
 
     @property
     def duration_in_minutes(self):
-        end_datetime = self.end_datetime or timezone.now()
-        return round((end_datetime - self.start_datetime).seconds / 60, 2)
+        duration_seconds = self.duration_seconds
+        if duration_seconds is None:
+            duration_seconds = self.get_duration_seconds()
+        return round(duration_seconds / 60, 2)
+
+
+class WeatherDay(models.Model):
+    """
+    Observed weather for one day at one location.
+
+    A day fetched after it ended never changes, so it is only ever fetched
+    once. The current day is re-fetched periodically until it is over. Days
+    are dated, and end, by the clock at WEATHER_TIME_ZONE.
+    """
+
+    class Meta:
+        ordering = ("date",)
+        constraints = [
+            models.UniqueConstraint(
+                fields=["location", "date"], name="unique_weather_day_per_location"
+            ),
+        ]
+
+    class Source(models.TextChoices):
+        HISTORY = "history"
+        FORECAST = "forecast"
+
+    date = models.DateField()
+    location = models.CharField(max_length=255)
+    totalprecip_in = models.FloatField()
+    maxtemp_f = models.FloatField()
+    source = models.CharField(
+        max_length=16, choices=Source.choices, default=Source.HISTORY
+    )
+    fetched_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.location} - {self.date} - {self.totalprecip_in} in - {self.maxtemp_f} F"
+
+    @property
+    def is_final(self):
+        return (
+            self.source == self.Source.HISTORY
+            and get_local_date(self.fetched_at) > self.date
+        )
+
+    @classmethod
+    def get_missing_dates(cls, location, days_ago=7, now=None):
+        """
+        The days from `days_ago` days ago through today that aren't stored,
+        or were still in progress when last fetched and are due a re-fetch.
+        """
+        now = now or timezone.now()
+        today = get_local_date(now)
+        start_date = today - timedelta(days=days_ago)
+        stored_days = cls.objects.filter(
+            location=location, date__range=(start_date, today)
+        )
+        up_to_date = {
+            day.date
+            for day in stored_days
+            if day.is_final or day.fetched_at >= now - WEATHER_DAY_REFRESH_INTERVAL
+        }
+        return [
+            start_date + timedelta(days=i)
+            for i in range(days_ago + 1)
+            if start_date + timedelta(days=i) not in up_to_date
+        ]
+
+    @classmethod
+    def ingest_history(cls, location, days_ago=7):
+        """
+        Make sure every day from `days_ago` days ago through today is stored,
+        only fetching the days that are missing or still in progress.
+
+        Returns the days that were fetched.
+        """
+        now = timezone.now()
+        missing = cls.get_missing_dates(location, days_ago=days_ago, now=now)
+        if not missing:
+            return []
+
+        logger.info(f"Fetching weather history for {location}: {missing}")
+        data = fetch_historical_weather(
+            location=location, start_date=missing[0], end_date=missing[-1]
+        )
+        fetched_days = []
+        with transaction.atomic():
+            for day in data:
+                weather_day, _ = cls.objects.update_or_create(
+                    location=location,
+                    date=day.date,
+                    defaults={
+                        "totalprecip_in": day.totalprecip_in,
+                        "maxtemp_f": day.maxtemp_f,
+                        "source": cls.Source.HISTORY,
+                        "fetched_at": now,
+                    },
+                )
+                fetched_days.append(weather_day)
+        return fetched_days
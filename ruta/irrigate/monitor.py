@@ -1,7 +1,12 @@
+import atexit
 import logging
+import queue
+import threading
+import time
 from enum import Enum
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, field
 from datetime import datetime
+from typing import Any, Dict, List, Optional
 
 import requests
 from django.conf import settings
@@ -9,6 +14,15 @@ from django.utils import timezone
 
 BASE_URL = settings.MONITORING_WEBHOOK_URL
 REQUEST_TIMEOUT = (5, 15)
+MAX_QUEUED_EVENTS = 1000
+MAX_BATCH_SIZE = 50
+# how long to wait for more events to batch with the first one
+BATCH_WAIT_IN_SECONDS = 0.5
+MAX_ATTEMPTS = 4
+BACKOFF_IN_SECONDS = 1
+FLUSH_TIMEOUT_IN_SECONDS = 10
+# at most one progress event per interval while a pass runs
+HEARTBEAT_INTERVAL_IN_SECONDS = 300
 
 logger = logging.getLogger(__name__)
 
@@ -23,17 +37,249 @@ class MonitoringEventStatus(Enum):
 class MonitoringEvent:
     name: str
     status: MonitoringEventStatus
-    created_at: datetime = timezone.now()
+    created_at: datetime = field(default_factory=timezone.now)
+    data: Optional[Dict[str, Any]] = None
 
+    def to_json(self):
+        data = asdict(self)
+        data["status"] = self.status.value
+        data["created_at"] = self.created_at.isoformat()
+        return data
 
-def emit(event_data: MonitoringEvent):
-    try:
-        response = requests.post(
-            BASE_URL,
-            data=asdict(event_data),
-            timeout=REQUEST_TIMEOUT,
+
+@dataclass
+class ZoneReport:
+    actuator_id: int
+    actuator: str
+    schedule_time_id: Optional[int] = None
+    planned_seconds: Optional[float] = None
+    actual_seconds: Optional[float] = None
+    reason: str = ""
+    error: Optional[str] = None
+
+
+@dataclass
+class RunReport:
+    """
+    What happened to each zone in one scheduler pass, sent as a single
+    monitoring event once the pass is over.
+
+    Progress heartbeats can be sent while the pass runs, at most one per
+    `heartbeat_interval` seconds.
+    """
+
+    dry_run: bool = False
+    started_at: datetime = field(default_factory=timezone.now)
+    finished_at: Optional[datetime] = None
+    zones: List[ZoneReport] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+    heartbeat_interval: float = HEARTBEAT_INTERVAL_IN_SECONDS
+    _last_heartbeat: Optional[float] = field(default=None, repr=False)
+
+    def add_zone(self, actuator, schedule_time=None) -> ZoneReport:
+        zone = ZoneReport(
+            actuator_id=actuator.id,
+            actuator=str(actuator),
+            schedule_time_id=getattr(schedule_time, "id", None),
         )
-    except Exception as e:
-        logger.warning("Error emitting monitoring event: %s", e)
+        self.zones.append(zone)
+        return zone
+
+    def add_error(self, error: str):
+        self.errors.append(error)
+
+    @property
+    def status(self) -> MonitoringEventStatus:
+        if self.errors or any(zone.error for zone in self.zones):
+            return MonitoringEventStatus.FAILURE
+        if self.finished_at is None:
+            return MonitoringEventStatus.IN_PROGRESS
+        return MonitoringEventStatus.SUCCESS
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "dry_run": self.dry_run,
+            "status": self.status.value,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at and self.finished_at.isoformat(),
+            "zones": [asdict(zone) for zone in self.zones],
+            "errors": self.errors,
+        }
+
+    def heartbeat(self) -> bool:
+        """
+        Send a progress event if one hasn't been sent in the last
+        `heartbeat_interval` seconds. Returns whether one was sent.
+        """
+        now = time.monotonic()
+        if (
+            self._last_heartbeat is not None
+            and now - self._last_heartbeat < self.heartbeat_interval
+        ):
+            return False
+        self._last_heartbeat = now
+        finished = sum(zone.actual_seconds is not None for zone in self.zones)
+        emit(
+            MonitoringEvent(
+                name=f"Scheduler pass running, {finished} of {len(self.zones)} zone(s) done",
+                status=MonitoringEventStatus.IN_PROGRESS,
+                data=self.to_json(),
+            )
+        )
+        return True
+
+    def finish(self) -> MonitoringEvent:
+        """
+        End the pass and send the report.
+        """
+        self.finished_at = timezone.now()
+        event = MonitoringEvent(
+            name=f"Scheduler pass {self.status.value} for {len(self.zones)} zone(s)",
+            status=self.status,
+            data=self.to_json(),
+        )
+        emit(event)
+        return event
+
+
+class Emitter:
+    """
+    Sends monitoring events to a webhook from a background thread.
+
+    `emit` only queues the event, so callers never wait on the webhook.
+    Queued events are posted in batches over one pooled session, and a
+    failed post is retried with exponential backoff. When the queue is full
+    new events are dropped rather than blocking.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        session: Optional[requests.Session] = None,
+        max_queued_events: int = MAX_QUEUED_EVENTS,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        batch_wait: float = BATCH_WAIT_IN_SECONDS,
+        max_attempts: int = MAX_ATTEMPTS,
+        backoff: float = BACKOFF_IN_SECONDS,
+    ):
+        self.url = url
+        self.session = session or requests.Session()
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queued_events)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+
+    def emit(self, event: MonitoringEvent) -> bool:
+        """
+        Queue `event` to be sent. Returns whether it was queued.
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Monitoring queue full, dropping event %s", event.name)
+            return False
+        return True
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait up to `timeout` seconds for every queued event to be sent or
+        given up on. Returns whether the queue was emptied in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _ensure_started(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._work, name="monitoring-emitter", daemon=True
+                )
+                self._thread.start()
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._send(batch)
+            except Exception:
+                logger.exception("Error emitting monitoring events")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _next_batch(self) -> List[MonitoringEvent]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(
+                    self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                )
+            except queue.Empty:
+                break
+        return batch
+
+    def _send(self, batch: List[MonitoringEvent]) -> Optional[requests.Response]:
+        payload = {"events": [event.to_json() for event in batch]}
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = self.session.post(
+                    self.url, json=payload, timeout=REQUEST_TIMEOUT
+                )
+            except requests.RequestException as e:
+                error = e
+            else:
+                # the webhook won't accept a request it rejected once
+                if response.status_code < 500:
+                    if not response.ok:
+                        logger.warning(
+                            "Monitoring webhook rejected %s event(s): %s",
+                            len(batch),
+                            response.status_code,
+                        )
+                    return response
+                error = f"status {response.status_code}"
+            if attempt < self.max_attempts:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+        logger.warning(
+            "Giving up emitting %s monitoring event(s): %s", len(batch), error
+        )
+        return None
+
+
+_emitter: Optional[Emitter] = None
+_emitter_lock = threading.Lock()
+
+
+def get_emitter() -> Optional[Emitter]:
+    global _emitter
+    if not BASE_URL:
         return None
-    return response
+    with _emitter_lock:
+        if _emitter is None:
+            _emitter = Emitter(BASE_URL)
+            atexit.register(_emitter.flush, FLUSH_TIMEOUT_IN_SECONDS)
+        return _emitter
+
+
+def emit(event_data: MonitoringEvent) -> bool:
+    """
+    Queue a monitoring event to be sent in the background.
+    """
+    emitter = get_emitter()
+    if emitter is None:
+        logger.debug("No monitoring webhook configured, not sending %s", event_data)
+        return False
+    return emitter.emit(event_data)
@@ -0,0 +1,186 @@
+import cProfile
+import heapq
+import logging
+import os
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# the profile of the request being handled, if profiling is on
+_current: ContextVar[Optional["RequestProfile"]] = ContextVar(
+    "request_profile", default=None
+)
+
+SLOWEST_QUERIES_KEPT = 5
+
+
+@dataclass(order=True)
+class QueryTiming:
+    seconds: float
+    sql: str = field(compare=False)
+
+
+class RequestProfile:
+    """
+    Where one request spent its time: SQL, weather calls, template
+    rendering and anything else recorded by name.
+    """
+
+    def __init__(self, slowest_queries_kept: int = SLOWEST_QUERIES_KEPT):
+        self.timings: Dict[str, float] = defaultdict(float)
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.slowest_queries_kept = slowest_queries_kept
+        self._slowest: List[QueryTiming] = []
+
+    def record(self, name: str, seconds: float):
+        self.timings[name] += seconds
+        self.counts[name] += 1
+
+    def record_query(self, sql: str, seconds: float):
+        self.record("db", seconds)
+        timing = QueryTiming(seconds, sql)
+        if len(self._slowest) < self.slowest_queries_kept:
+            heapq.heappush(self._slowest, timing)
+        else:
+            heapq.heappushpop(self._slowest, timing)
+
+    @property
+    def slowest_queries(self) -> List[QueryTiming]:
+        return sorted(self._slowest, reverse=True)
+
+    def server_timing(self, total_seconds: Optional[float] = None) -> str:
+        """
+        The timings as a Server-Timing header value, in milliseconds.
+        """
+        metrics = [
+            f'{name};dur={seconds * 1000:.1f};desc="{self.counts[name]} call(s)"'
+            for name, seconds in sorted(self.timings.items())
+        ]
+        if total_seconds is not None:
+            metrics.append(f"total;dur={total_seconds * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+def get_current() -> Optional[RequestProfile]:
+    return _current.get()
+
+
+@contextmanager
+def activate(profile: RequestProfile):
+    token = _current.set(profile)
+    try:
+        yield profile
+    finally:
+        _current.reset(token)
+
+
+def record(name: str, seconds: float):
+    """
+    Add to the current request's profile, if there is one.
+    """
+    profile = _current.get()
+    if profile is not None:
+        profile.record(name, seconds)
+
+
+@contextmanager
+def timed(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+@dataclass
+class CapturedProfile:
+    path: str
+    captured_at: datetime
+    pid: int
+    trigger: str
+
+    @property
+    def name(self):
+        return os.path.basename(self.path)
+
+
+PROFILE_NAME = re.compile(r"^(\d{8}T\d{6})-(\d+)-(.+)\.prof$")
+
+
+def get_profile_dir() -> str:
+    return settings.PROFILE_DIR
+
+
+@contextmanager
+def capture_profile(trigger: str):
+    """
+    cProfile everything run inside the block and save it to the profile
+    directory, named for when it started and `trigger`. Only the newest
+    PROFILES_KEPT profiles are kept.
+    """
+    profiler = cProfile.Profile()
+    started = timezone.localtime()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        try:
+            path = save_profile(profiler, trigger, started)
+        except OSError as e:
+            logger.warning(f"Unable to save {trigger} profile: {e}")
+        else:
+            logger.info(f"Saved {trigger} profile to {path}")
+
+
+def save_profile(profiler: cProfile.Profile, trigger: str, started: datetime) -> str:
+    directory = get_profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9_.]+", "_", trigger).strip("_") or "profile"
+    path = os.path.join(
+        directory, f"{started:%Y%m%dT%H%M%S}-{os.getpid()}-{slug[:80]}.prof"
+    )
+    profiler.dump_stats(path)
+    for profile in list_profiles(directory)[settings.PROFILES_KEPT :]:
+        try:
+            os.remove(profile.path)
+        except FileNotFoundError:
+            # another process rotated it first
+            pass
+    return path
+
+
+def list_profiles(directory: Optional[str] = None) -> List[CapturedProfile]:
+    """
+    Saved profiles, newest first.
+    """
+    directory = directory or get_profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for filename in os.listdir(directory):
+        match = PROFILE_NAME.match(filename)
+        if not match:
+            continue
+        captured_at, pid, trigger = match.groups()
+        profiles.append(
+            CapturedProfile(
+                path=os.path.join(directory, filename),
+                captured_at=datetime.strptime(captured_at, "%Y%m%dT%H%M%S"),
+                pid=int(pid),
+                trigger=trigger,
+            )
+        )
+    return sorted(
+        profiles, key=lambda profile: (profile.captured_at, profile.name), reverse=True
+    )
@@ -1,43 +1,322 @@
+import asyncio
 import logging
 import time
-from typing import List, Optional
-from datetime import timedelta
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
 
+from asgiref.sync import async_to_sync, sync_to_async
 from django.utils import timezone
 
-from irrigate.monitor import MonitoringEvent, MonitoringEventStatus, emit
-from irrigate.models import Actuator, ActuatorRunLog, ScheduleTime
+from irrigate import tracing
+from irrigate.lock import LockHeld, singleton_lock
+from irrigate.metrics import REGISTRY
+from irrigate.monitor import RunReport, ZoneReport
+from irrigate.models import (
+    Actuator,
+    ActuatorRunLog,
+    DurationSummary,
+    ScheduleTime,
+    plan_durations,
+)
+from irrigate.weather import WeatherSnapshot
 
 logger = logging.getLogger(__name__)
 
+RUN_ALL_LOCK_NAME = "run_all"
+
 # Constants for grass seed mode
 GRASS_SEED_DURATION_SECONDS = 300  # 5 minutes
 GRASS_SEED_MORNING_HOUR = 10
 GRASS_SEED_EVENING_HOUR = 0
 GRASS_SEED_RUN_HOURS = (GRASS_SEED_MORNING_HOUR, GRASS_SEED_EVENING_HOUR)
 
+SCHEDULER_PASSES = REGISTRY.counter(
+    "ruta_scheduler_passes_total", "Scheduler passes by outcome", ["status"]
+)
+SCHEDULER_PASS_SECONDS = REGISTRY.histogram(
+    "ruta_scheduler_pass_seconds",
+    "Time taken by scheduler passes that ran zones",
+    buckets=(1, 10, 60, 300, 600, 1200, 1800, 3600, 7200),
+)
+SCHEDULER_START_LAG_SECONDS = REGISTRY.histogram(
+    "ruta_scheduler_start_lag_seconds",
+    "How long after its schedule time each zone started",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600),
+)
+ZONE_RUNS = REGISTRY.counter("ruta_zone_runs_total", "Zone runs", ["zone"])
+ZONE_RUN_SECONDS = REGISTRY.counter(
+    "ruta_zone_run_seconds_total", "Time zones spent watering", ["zone"]
+)
 
-def _run(
+
+def _get_duration_in_seconds(
     actuator: Actuator,
     schedule_time: Optional[ScheduleTime] = None,
-    dry_run: bool = False,
     duration_override: Optional[int] = None,
-) -> int:
+    snapshot: Optional[WeatherSnapshot] = None,
+    duration_summary: Optional[DurationSummary] = None,
+) -> float:
     if duration_override:
         duration_in_seconds = duration_override
     elif schedule_time and schedule_time.duration_in_minutes:
         duration_in_seconds = schedule_time.duration_in_minutes * 60
+    elif duration_summary:
+        duration_in_seconds = duration_summary.final_duration_seconds
     else:
-        duration_in_seconds = actuator.get_duration_in_seconds()
+        duration_in_seconds = actuator.get_duration_in_seconds(snapshot=snapshot)
+    return duration_in_seconds
+
+
+def _record_zone_run(actuator: Actuator, seconds: float):
+    ZONE_RUNS.labels(zone=str(actuator)).inc()
+    ZONE_RUN_SECONDS.labels(zone=str(actuator)).inc(seconds)
+
+
+def _get_start_lag_in_seconds(schedule_time: ScheduleTime) -> float:
+    now = timezone.localtime()
+    scheduled = datetime.combine(now.date(), schedule_time.start_time, now.tzinfo)
+    return max(0, (now - scheduled).total_seconds())
+
+
+def _get_duration_reason(
+    duration_in_seconds: float,
+    schedule_time: Optional[ScheduleTime] = None,
+    duration_override: Optional[int] = None,
+    duration_summary: Optional[DurationSummary] = None,
+) -> str:
+    """
+    Why a run got the duration `_get_duration_in_seconds` gave it.
+    """
+    if duration_override:
+        return "Override"
+    elif schedule_time and schedule_time.duration_in_minutes:
+        return "Scheduled duration"
+    elif duration_summary:
+        return duration_summary.reason
+    return "Calculated" if duration_in_seconds else "Skipped"
+
+
+@contextmanager
+def _zone_span(zone: ZoneReport, actuator: Actuator, schedule_time: ScheduleTime):
+    """
+    Trace one zone's run, ending with what the report made of it.
+    """
+    with tracing.span(
+        "zone",
+        actuator=str(actuator),
+        schedule_time_id=schedule_time.id,
+        scheduled_start=schedule_time.start_time.isoformat(),
+    ) as span:
+        try:
+            yield span
+        finally:
+            span.set(
+                reason=zone.reason,
+                planned_seconds=zone.planned_seconds,
+                actual_seconds=zone.actual_seconds,
+            )
+
+
+def _run(
+    actuator: Actuator,
+    schedule_time: Optional[ScheduleTime] = None,
+    dry_run: bool = False,
+    duration_override: Optional[int] = None,
+    snapshot: Optional[WeatherSnapshot] = None,
+    duration_summary: Optional[DurationSummary] = None,
+) -> int:
+    duration_in_seconds = _get_duration_in_seconds(
+        actuator,
+        schedule_time=schedule_time,
+        duration_override=duration_override,
+        snapshot=snapshot,
+        duration_summary=duration_summary,
+    )
     if not dry_run:
-        actuator.start(schedule_time=schedule_time)
-        time.sleep(duration_in_seconds)
-        actuator.stop(schedule_time=schedule_time)
+        with tracing.span("start"):
+            actuator.start(
+                schedule_time=schedule_time, duration_in_seconds=duration_in_seconds
+            )
+        with tracing.span("water", seconds=duration_in_seconds):
+            time.sleep(duration_in_seconds)
+        with tracing.span("stop"):
+            actuator.stop(schedule_time=schedule_time)
     else:
         logger.info(f"Would run {actuator} for {duration_in_seconds} second(s)")
     return duration_in_seconds
 
 
+@dataclass
+class ActiveRun:
+    actuator: Actuator
+    schedule_time: ScheduleTime
+
+
+class RunExecutor:
+    """
+    Runs many zones at once from a single event loop.
+
+    Each active run is a timer on the loop rather than a process held in
+    `time.sleep`. Database and GPIO calls are made off the loop, back on the
+    thread that called `run`.
+    """
+
+    def __init__(
+        self,
+        snapshot: Optional[WeatherSnapshot] = None,
+        duration_summaries: Optional[Dict[int, DurationSummary]] = None,
+        reasons: Optional[Dict[int, str]] = None,
+        report: Optional[RunReport] = None,
+    ):
+        self.snapshot = snapshot
+        self.duration_summaries = duration_summaries or {}
+        # by schedule time id
+        self.reasons = reasons or {}
+        self.report = report or RunReport()
+        self.active: List[ActiveRun] = []
+
+    def run(self, due_runs: List[Tuple[ScheduleTime, Actuator]]):
+        """
+        Run `due_runs` in order, overlapping as many as each device's water
+        supply allows. Blocks until every run has finished.
+        """
+        async_to_sync(self._run_all)(due_runs)
+
+    def _has_capacity_for(self, actuator: Actuator) -> bool:
+        running = [
+            run.actuator
+            for run in self.active
+            if run.actuator.device_id == actuator.device_id
+        ]
+        # an actuator never overlaps with itself
+        return actuator not in running and actuator.device.has_capacity_for(
+            actuator, running
+        )
+
+    async def _run_all(self, due_runs: List[Tuple[ScheduleTime, Actuator]]):
+        self.capacity_changed = asyncio.Condition()
+        self.aborted = False
+        self.timers = set()
+        results = await asyncio.gather(
+            *(
+                self._run_one(schedule_time, actuator)
+                for schedule_time, actuator in due_runs
+            ),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _abort(self):
+        """
+        Cut every active run short and start no more. Runs are never
+        cancelled outright, so each still gets to stop its own valve.
+        """
+        self.aborted = True
+        for timer in self.timers:
+            timer.cancel()
+        async with self.capacity_changed:
+            self.capacity_changed.notify_all()
+
+    async def _run_one(self, schedule_time: ScheduleTime, actuator: Actuator):
+        zone = self.report.add_zone(actuator, schedule_time)
+        with _zone_span(zone, actuator, schedule_time) as span:
+            await self._run_zone(zone, span, schedule_time, actuator)
+
+    async def _run_zone(
+        self,
+        zone: ZoneReport,
+        span: tracing.Span,
+        schedule_time: ScheduleTime,
+        actuator: Actuator,
+    ):
+        with tracing.span("wait_for_capacity"):
+            async with self.capacity_changed:
+                await self.capacity_changed.wait_for(
+                    lambda: self.aborted or self._has_capacity_for(actuator)
+                )
+                if self.aborted:
+                    zone.reason = "Pass aborted"
+                    return
+                run = ActiveRun(actuator=actuator, schedule_time=schedule_time)
+                self.active.append(run)
+
+        started = None
+        try:
+            # a plan is only good for an actuator's first run in the pass,
+            # later ones need to count the water it just got
+            duration_summary = self.duration_summaries.pop(actuator.id, None)
+            with tracing.span("get_duration"):
+                duration_in_seconds = await sync_to_async(_get_duration_in_seconds)(
+                    actuator,
+                    schedule_time=schedule_time,
+                    snapshot=self.snapshot,
+                    duration_summary=duration_summary,
+                )
+            zone.planned_seconds = duration_in_seconds
+            zone.reason = self.reasons.get(schedule_time.id) or _get_duration_reason(
+                duration_in_seconds,
+                schedule_time=schedule_time,
+                duration_summary=duration_summary,
+            )
+            if self.aborted:
+                zone.reason = "Pass aborted"
+                return
+            logger.info(f"running actuator {actuator}")
+            # only queues an event now and then, so it is safe on the loop
+            self.report.heartbeat()
+            start_lag_in_seconds = _get_start_lag_in_seconds(schedule_time)
+            SCHEDULER_START_LAG_SECONDS.observe(start_lag_in_seconds)
+            span.set(start_lag_seconds=start_lag_in_seconds)
+            started = time.monotonic()
+            with tracing.span("start"):
+                await sync_to_async(actuator.start)(
+                    schedule_time=schedule_time,
+                    duration_in_seconds=duration_in_seconds,
+                )
+            # another zone may have failed while this valve was opening
+            if self.aborted:
+                logger.info(f"Stopping actuator {actuator} early")
+                return
+
+            timer = asyncio.ensure_future(asyncio.sleep(duration_in_seconds))
+            self.timers.add(timer)
+            try:
+                with tracing.span("water", seconds=duration_in_seconds):
+                    await timer
+            except asyncio.CancelledError:
+                if not self.aborted:
+                    raise
+                logger.info(f"Stopping actuator {actuator} early")
+                return
+            finally:
+                self.timers.discard(timer)
+        except Exception as e:
+            zone.error = str(e)
+            await self._abort()
+            raise
+        finally:
+            if started is not None:
+                with tracing.span("stop"):
+                    await sync_to_async(actuator.stop)(schedule_time=schedule_time)
+                zone.actual_seconds = time.monotonic() - started
+                _record_zone_run(actuator, zone.actual_seconds)
+            async with self.capacity_changed:
+                self.active.remove(run)
+                self.capacity_changed.notify_all()
+
+        if duration_in_seconds:
+            logger.info(
+                f"Finished running actuator {actuator} for {duration_in_seconds} second(s)"
+            )
+        else:
+            logger.info(f"Skipped running actuator {actuator}")
+        self.report.heartbeat()
+
+
 def has_run(schedule_time: ScheduleTime, actuator: Actuator):
     runs = ActuatorRunLog.objects.filter(
         schedule_time=schedule_time,
@@ -47,8 +326,14 @@ def has_run(schedule_time: ScheduleTime, actuator: Actuator):
     # for one-offs, we only run them once ever, but for recurring we run them
     # once per week
     if schedule_time.run_type == ScheduleTime.RunType.RECURRING:
-        now = timezone.now().date()
-        runs = runs.filter(start_datetime__date=now)
+        # a range rather than start_datetime__date so the index can be used
+        start_of_day = timezone.localtime().replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        runs = runs.filter(
+            start_datetime__gte=start_of_day,
+            start_datetime__lt=start_of_day + timedelta(days=1),
+        )
 
     return runs.exists()
 
@@ -66,13 +351,24 @@ def has_run_recently(actuator: Actuator):
     ).exists()
 
 
-def run_all(dry_run: bool = False) -> List[Actuator]:
+def run_all(
+    dry_run: bool = False, report: Optional[RunReport] = None
+) -> List[Actuator]:
     """
-    Run sprinklers scheduled to run in order, one at a time.
+    Run sprinklers scheduled to run in order, as many at a time as each
+    device's water supply allows.
     Also handles grass seed mode for applicable actuators.
 
+    What happened to each zone is added to `report`, if given.
+
     Returns sprinklers that ran, if any.
     """
+    report = report or RunReport(dry_run=dry_run)
+    if not dry_run:
+        # runs whose process died were shut off by their watchdog
+        with tracing.span("close_overdue_runs"):
+            ActuatorRunLog.close_overdue_runs()
+
     now = timezone.now()
     weekday = now.weekday()
     hour = now.time()
@@ -85,49 +381,52 @@ def run_all(dry_run: bool = False) -> List[Actuator]:
     )
     verb = "running" if not dry_run else "simulating"
     logger.info(f"Scheduled times: {schedule_times}")
+    # every actuator in this pass shares one weather lookup
+    snapshot = WeatherSnapshot()
     actuators_that_ran = []
+    # why runs get their duration, where their schedule time doesn't say
+    reasons = {}
 
-    # First run the regularly scheduled actuators
-    for schedule_time in schedule_times:
-        for actuator in schedule_time.actuators.all():
-            if has_run(schedule_time, actuator):
-                logger.info(
-                    f"Actuator {actuator} has already run today for {schedule_time}"
-                )
-                continue
-            event = MonitoringEvent(
-                name=f"Starting run for {actuator} - dry_run: {dry_run}",
-                status=MonitoringEventStatus.IN_PROGRESS,
-            )
-            emit(event)
-
-            if not dry_run:
-                logger.info(f"{verb} actuator {actuator}")
-                seconds_run = _run(actuator, schedule_time=schedule_time)
-                minutes_run = seconds_run / 60
-                event = MonitoringEvent(
-                    name=f"Ran {actuator} for {minutes_run}",
-                    status=MonitoringEventStatus.IN_PROGRESS,
-                )
-                if seconds_run:
+    due_runs = []
+    with tracing.span("find_due_runs") as span:
+        for schedule_time in schedule_times:
+            for actuator in schedule_time.actuators.select_related("device"):
+                if has_run(schedule_time, actuator):
                     logger.info(
-                        f"Finished {verb} actuator {actuator} for {seconds_run} second(s)"
+                        f"Actuator {actuator} has already run today for {schedule_time}"
                     )
-                else:
-                    logger.info(f"Skipped {verb} actuator {actuator}")
-            actuators_that_ran.append(actuator)
+                    continue
+                due_runs.append((schedule_time, actuator))
+        span.set(due_runs=len(due_runs))
 
-    # Now handle grass seed mode actuators - they run twice daily for 5 minutes
+    # plan every calculated run in the pass together rather than one by one
+    duration_summaries = {}
+    if not dry_run:
+        with tracing.span("plan_durations"):
+            duration_summaries = plan_durations(
+                [
+                    actuator
+                    for schedule_time, actuator in due_runs
+                    if not schedule_time.duration_in_minutes
+                ],
+                snapshot=snapshot,
+            )
+
+    # grass seed mode actuators run twice daily for 5 minutes, alongside the
+    # regularly scheduled ones and within the same water supply limits
     current_hour = now.hour
     if current_hour in GRASS_SEED_RUN_HOURS:
-        grass_seed_actuators = Actuator.objects.filter(grass_seed_mode=True)
+        grass_seed_actuators = Actuator.objects.filter(
+            grass_seed_mode=True
+        ).select_related("device")
         logger.info(
             f"Found {grass_seed_actuators.count()} actuators in grass seed mode"
         )
+        scheduled = {actuator for _, actuator in due_runs}
 
         for actuator in grass_seed_actuators:
-            # Check if it has already run during this hour window
-            if has_run_recently(actuator):
+            # Check if it has already run, or is about to, in this hour window
+            if actuator in scheduled or has_run_recently(actuator):
                 logger.info(
                     f"Actuator {actuator} has already run in this hour window, skipping grass seed mode"
                 )
@@ -141,28 +440,68 @@ def run_all(dry_run: bool = False) -> List[Actuator]:
                 duration_in_minutes=GRASS_SEED_DURATION_SECONDS / 60,
             )
             schedule_time.actuators.add(actuator)
+            logger.info(f"{verb} actuator {actuator} in grass seed mode")
+            due_runs.append((schedule_time, actuator))
+            reasons[schedule_time.id] = "Grass seed mode"
 
-            event = MonitoringEvent(
-                name=f"Starting grass seed mode run for {actuator} - dry_run: {dry_run}",
-                status=MonitoringEventStatus.IN_PROGRESS,
-            )
-            emit(event)
+    if not dry_run:
+        with tracing.span("run_zones"):
+            RunExecutor(
+                snapshot=snapshot,
+                duration_summaries=duration_summaries,
+                reasons=reasons,
+                report=report,
+            ).run(due_runs)
+    else:
+        for schedule_time, actuator in due_runs:
+            zone = report.add_zone(actuator, schedule_time)
+            if schedule_time.id in reasons:
+                zone.planned_seconds = GRASS_SEED_DURATION_SECONDS
+            zone.reason = "Dry run"
+    actuators_that_ran.extend(actuator for _, actuator in due_runs)
 
-            if not dry_run:
-                logger.info(f"{verb} actuator {actuator} in grass seed mode")
-                seconds_run = _run(
-                    actuator,
-                    schedule_time=schedule_time,
-                    duration_override=GRASS_SEED_DURATION_SECONDS,
-                )
-                event = MonitoringEvent(
-                    name=f"Ran {actuator} in grass seed mode",
-                    status=MonitoringEventStatus.SUCCESS,
-                )
-                emit(event)
-                logger.info(f"Finished {verb} actuator {actuator} in grass seed mode")
-            actuators_that_ran.append(actuator)
+    return actuators_that_ran
+
+
+def run_all_and_report(dry_run: bool = False) -> List[Actuator]:
+    """
+    `run_all`, sending one report of the pass instead of raising.
+
+    Passes with nothing to run and no errors send nothing. Only one pass
+    runs at a time. Any other pass started meanwhile returns straight away
+    without running anything.
+    """
+    logger.info(f"Checking for runnable jobs. dry_run: {dry_run}")
+    report = RunReport(dry_run=dry_run)
+    actuators_that_ran = []
+    started = time.perf_counter()
+    with tracing.trace("scheduler_pass", dry_run=dry_run) as span:
+        try:
+            with singleton_lock(RUN_ALL_LOCK_NAME):
+                actuators_that_ran = run_all(dry_run=dry_run, report=report)
+        except LockHeld as e:
+            logger.info(f"Another scheduler pass is already running: {e}")
+            SCHEDULER_PASSES.labels(status="locked").inc()
+            span.set(status="locked")
+            return []
+        except Exception as e:
+            logger.exception("Error while running scheduled jobs")
+            report.add_error(f"Error while running scheduled jobs {e}")
+        if report.zones or report.errors:
+            # the emitter posts from its own thread, so this only queues it
+            with tracing.span("report"):
+                report.finish()
+            SCHEDULER_PASS_SECONDS.observe(time.perf_counter() - started)
+            status = report.status.value
+        else:
+            status = "idle"
+            # most passes find nothing due, keep them from burying the rest
+            span.discard()
+        SCHEDULER_PASSES.labels(status=status).inc()
+        span.set(status=status, zones=len(report.zones), errors=len(report.errors))
+    REGISTRY.maybe_write_snapshot(interval=0)
 
+    logger.info(f"Finished checking for runnable jobs. dry_run: {dry_run}")
     return actuators_that_ran
 
 
@@ -170,8 +509,7 @@ def stop_all():
     """
     This will run off all sprinklers
     """
-    actuators = Actuator.objects.all()
-    for actuator in actuators:
-        logger.info(f"Stopping {actuator} ")
-        actuator.stop()
-        logger.info(f"Stopped {actuator} ")
+    actuators = list(Actuator.objects.all())
+    logger.info(f"Stopping {actuators}")
+    Actuator.stop_many(actuators)
+    logger.info(f"Stopped {actuators}")
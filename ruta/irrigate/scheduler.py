@@ -0,0 +1,169 @@
+import logging
+import time
+from contextlib import nullcontext
+from datetime import datetime, time as time_of_day, timedelta
+from typing import List, Optional, Tuple
+
+from django.core.cache import caches
+from django.db import close_old_connections
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from irrigate.models import Actuator, ActuatorRunLog, ScheduleTime
+from irrigate.profiling import capture_profile
+from irrigate.schedule import GRASS_SEED_RUN_HOURS, run_all_and_report
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_VERSION_KEY = "schedule_version"
+POLL_INTERVAL_IN_SECONDS = 5
+
+cache = caches["scheduler"]
+
+
+def get_schedule_version() -> int:
+    return cache.get(SCHEDULE_VERSION_KEY, 0)
+
+
+def bump_schedule_version():
+    """
+    Tell the resident scheduler that schedule times or grass seed mode changed.
+    """
+    cache.set(SCHEDULE_VERSION_KEY, get_schedule_version() + 1, timeout=None)
+
+
+class ScheduleIndex:
+    """
+    When things are due to run, held in memory so the scheduler can work out
+    its next wake up without querying the database.
+    """
+
+    def __init__(
+        self,
+        start_times: List[Tuple[int, time_of_day]],
+        grass_seed_mode: bool = False,
+        version: int = 0,
+    ):
+        self.start_times = start_times
+        self.grass_seed_mode = grass_seed_mode
+        self.version = version
+
+    @classmethod
+    def load(cls) -> "ScheduleIndex":
+        # read the version first so a change made while loading is not missed
+        version = get_schedule_version()
+        has_run = ActuatorRunLog.objects.filter(schedule_time=OuterRef("pk"))
+        start_times = (
+            ScheduleTime.objects.filter(enabled=True)
+            .annotate(has_run=Exists(has_run))
+            .exclude(run_type=ScheduleTime.RunType.ONE_OFF, has_run=True)
+            .order_by()
+            .values_list("weekday", "start_time")
+            .distinct()
+        )
+        return cls(
+            start_times=list(start_times),
+            grass_seed_mode=Actuator.objects.filter(grass_seed_mode=True).exists(),
+            version=version,
+        )
+
+    def next_due(self, now: datetime) -> Optional[datetime]:
+        """
+        The first time after `now` that `run_all` has something to do, in the
+        same timezone it checks schedule times in.
+        """
+        due_times = []
+        for weekday, start_time in self.start_times:
+            days_ahead = (weekday - now.weekday()) % 7
+            due = datetime.combine(
+                now.date() + timedelta(days=days_ahead), start_time, now.tzinfo
+            )
+            if due <= now:
+                due += timedelta(days=7)
+            due_times.append(due)
+
+        if self.grass_seed_mode:
+            for hour in GRASS_SEED_RUN_HOURS:
+                due = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+                if due <= now:
+                    due += timedelta(days=1)
+                due_times.append(due)
+
+        return min(due_times, default=None)
+
+
+class Scheduler:
+    """
+    Stays resident and sleeps until the next schedule time is due, instead of
+    cron starting Django every few minutes to find nothing to do.
+    """
+
+    def __init__(
+        self,
+        dry_run: bool = False,
+        poll_interval: float = POLL_INTERVAL_IN_SECONDS,
+        profile: bool = False,
+    ):
+        self.dry_run = dry_run
+        self.poll_interval = poll_interval
+        self.profile = profile
+        self.index = None
+        self.last_started = None
+
+    def reload(self):
+        close_old_connections()
+        self.index = ScheduleIndex.load()
+        logger.info(
+            f"Loaded {len(self.index.start_times)} schedule time(s), "
+            f"grass seed mode: {self.index.grass_seed_mode}"
+        )
+
+    def run_due(self) -> datetime:
+        """
+        Run a pass, returning when it started. Passes start at least a poll
+        interval apart.
+
+        Schedule changes made by the pass itself, such as grass seed mode's
+        one-off schedule times, don't count as changes.
+        """
+        if self.last_started is not None:
+            since = (timezone.now() - self.last_started).total_seconds()
+            if since < self.poll_interval:
+                time.sleep(self.poll_interval - since)
+        started = self.last_started = timezone.now()
+        close_old_connections()
+        with capture_profile("run_all") if self.profile else nullcontext():
+            run_all_and_report(dry_run=self.dry_run)
+        self.index.version = get_schedule_version()
+        return started
+
+    def wait_until(self, due: Optional[datetime]) -> bool:
+        """
+        Sleep until `due`, checking for schedule changes every poll interval.
+
+        Returns False as soon as the schedule changes, True once `due` passes.
+        """
+        while get_schedule_version() == self.index.version:
+            now = timezone.now()
+            if due is None:
+                time.sleep(self.poll_interval)
+                continue
+            if now >= due:
+                return True
+            time.sleep(min((due - now).total_seconds(), self.poll_interval))
+        logger.info("Schedule changed, reloading")
+        return False
+
+    def run_forever(self):
+        while True:
+            self.reload()
+            # anything that came due while the schedule was changing runs now
+            started = self.run_due()
+            while True:
+                # counting from the start of the last pass, so anything that
+                # came due while it ran is due straight away
+                due = self.index.next_due(started)
+                logger.info(f"Next run due at {due}")
+                if not self.wait_until(due):
+                    break
+                started = self.run_due()
@@ -0,0 +1,24 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from irrigate.models import Actuator, ScheduleTime
+from irrigate.scheduler import bump_schedule_version
+
+
+@receiver(post_save, sender=ScheduleTime)
+@receiver(post_delete, sender=ScheduleTime)
+@receiver(post_delete, sender=Actuator)
+def schedule_changed(sender, **kwargs):
+    bump_schedule_version()
+
+
+@receiver(m2m_changed, sender=ScheduleTime.actuators.through)
+def schedule_actuators_changed(sender, action, **kwargs):
+    if action.startswith("post_"):
+        bump_schedule_version()
+
+
+@receiver(post_save, sender=Actuator)
+def actuator_changed(sender, update_fields=None, **kwargs):
+    if update_fields is None or "grass_seed_mode" in update_fields:
+        bump_schedule_version()
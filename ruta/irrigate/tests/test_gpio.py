@@ -0,0 +1,185 @@
+from unittest.mock import Mock, call
+
+from django.test import SimpleTestCase, override_settings
+
+from irrigate.gpio import (
+    GPIO,
+    ExpanderOutput,
+    OFF,
+    ON,
+    GPIOManager,
+    GPIOWriteError,
+    SimulatedChip,
+    SimulatedGPIOError,
+    load_backend,
+)
+from irrigate.watchdog import shut_off_pin
+
+
+class GPIOManagerTests(SimpleTestCase):
+    def setUp(self):
+        self.lgpio = Mock()
+        self.lgpio.gpiochip_open.return_value = 7
+        self.manager = GPIOManager(gpio_module=self.lgpio)
+
+    def test_chip_is_opened_once_and_pins_claimed_per_write(self):
+        for _ in range(3):
+            with GPIO(5, manager=self.manager) as gpio:
+                gpio.start()
+                gpio.stop()
+
+        self.lgpio.gpiochip_open.assert_called_once_with(0)
+        self.assertEqual(
+            self.lgpio.gpio_claim_output.call_args_list,
+            [call(7, 5, ON), call(7, 5, OFF)] * 3,
+        )
+        self.assertEqual(self.lgpio.gpio_free.call_args_list, [call(7, 5)] * 6)
+        self.lgpio.gpio_write.assert_not_called()
+        self.lgpio.gpiochip_close.assert_not_called()
+
+    def test_timings_are_recorded_per_operation(self):
+        gpio = GPIO(5, manager=self.manager)
+        gpio.start()
+        gpio.stop()
+
+        self.assertEqual(self.manager.timings["open"].count, 1)
+        self.assertEqual(self.manager.timings["claim"].count, 2)
+        self.assertEqual(self.manager.timings["free"].count, 2)
+        self.assertGreaterEqual(
+            self.manager.timings["claim"].max_seconds,
+            self.manager.timings["claim"].mean_seconds,
+        )
+
+    def test_close_releases_every_chip(self):
+        self.manager.write(5, ON)
+        self.manager.write(5, OFF, chip=1)
+
+        self.manager.close()
+
+        self.assertEqual(self.lgpio.gpiochip_close.call_args_list, [call(7), call(7)])
+
+    def test_write_many_is_one_group_claim(self):
+        self.manager.write_many({5: ON, 6: ON, 7: OFF})
+
+        self.lgpio.group_claim_output.assert_called_once_with(
+            7, [5, 6, 7], [ON, ON, OFF]
+        )
+        self.lgpio.group_free.assert_called_once_with(7, 5)
+        self.lgpio.gpio_write.assert_not_called()
+        self.assertEqual(self.manager.level(6), ON)
+
+
+class SimulatedChipTests(SimpleTestCase):
+    def setUp(self):
+        self.chip = SimulatedChip()
+        self.manager = GPIOManager(gpio_module=self.chip)
+
+    def test_tracks_levels_and_write_history(self):
+        gpio = GPIO(5, manager=self.manager)
+        gpio.start()
+        gpio.stop()
+
+        self.assertEqual(self.chip.level(5), OFF)
+        self.assertEqual([write.level for write in self.chip.writes], [ON, OFF])
+        self.assertEqual(gpio.read(), OFF)
+        self.assertEqual(self.chip.claimed, set())
+
+    def test_group_writes_switch_every_pin_in_one_call(self):
+        self.manager.write_many({5: ON, 6: ON, 7: ON})
+        self.manager.write_many({5: OFF, 6: OFF, 7: OFF})
+
+        self.assertEqual(self.chip.calls["group_claim_output"], 2)
+        self.assertEqual([self.chip.level(pin) for pin in (5, 6, 7)], [OFF, OFF, OFF])
+        self.assertEqual(self.chip.claimed, set())
+
+    def test_processes_can_drive_each_others_pins(self):
+        # a web worker starts zones, another worker and stop_all stop them
+        other = GPIOManager(gpio_module=self.chip)
+        self.manager.write(5, ON)
+        self.manager.write_many({6: ON, 7: ON})
+
+        other.write_many({5: OFF, 6: OFF})
+        other.write(7, OFF)
+        self.assertEqual([self.chip.level(pin) for pin in (5, 6, 7)], [OFF, OFF, OFF])
+
+        self.manager.write(5, ON)
+        shut_off_pin(self.chip, 0, 5)
+        self.assertEqual(self.chip.level(5), OFF)
+
+    def test_write_many_writes_around_a_busy_pin(self):
+        self.manager.write_many({5: ON, 6: ON, 7: ON})
+        handle = self.chip.gpiochip_open(0)
+        self.chip.gpio_claim_output(handle, 6, ON)
+
+        with self.assertRaises(GPIOWriteError) as raised:
+            self.manager.write_many({5: OFF, 6: OFF, 7: OFF})
+
+        self.assertEqual(list(raised.exception.failed), [6])
+        self.assertEqual([self.chip.level(pin) for pin in (5, 6, 7)], [OFF, ON, OFF])
+        self.assertEqual(self.chip.claimed, {(0, 6)})
+
+    def test_claiming_a_claimed_pin_fails(self):
+        handle = self.chip.gpiochip_open(0)
+        self.chip.gpio_claim_output(handle, 5)
+
+        with self.assertRaisesRegex(SimulatedGPIOError, "busy"):
+            self.chip.gpio_claim_output(handle, 5)
+
+    def test_writing_an_unclaimed_pin_fails(self):
+        handle = self.chip.gpiochip_open(0)
+
+        with self.assertRaisesRegex(SimulatedGPIOError, "not allocated"):
+            self.chip.gpio_write(handle, 5, ON)
+
+    def test_injected_failures(self):
+        gpio = GPIO(5, manager=self.manager)
+        gpio.stop()
+        self.chip.fail("gpio_claim_output", times=2)
+
+        for _ in range(2):
+            with self.assertRaises(SimulatedGPIOError):
+                gpio.start()
+        gpio.start()
+
+        self.assertEqual(self.chip.level(5), ON)
+
+    def test_injected_latency(self):
+        self.chip.latency = {"gpio_claim_output": 0.01}
+        gpio = GPIO(5, manager=self.manager)
+        gpio.start()
+        gpio.stop()
+
+        self.assertGreaterEqual(self.manager.timings["claim"].mean_seconds, 0.01)
+        self.assertLess(self.manager.timings["free"].mean_seconds, 0.01)
+
+    @override_settings(GPIO_BACKEND="simulated", GPIO_SIMULATED_LATENCY_SECONDS=0.5)
+    def test_load_backend_simulated(self):
+        backend = load_backend()
+
+        self.assertIsInstance(backend, SimulatedChip)
+        self.assertEqual(backend.latency, 0.5)
+
+    def test_expander_writes_are_coalesced_per_port(self):
+        expander = ExpanderOutput(1, 0x20, manager=self.manager)
+
+        expander.write_many({0: ON, 1: ON, 7: ON})
+        expander.write_many({0: ON, 1: ON})
+        expander.write(1, OFF)
+
+        self.assertEqual(
+            [(write.bus, write.address, write.data) for write in self.chip.i2c_writes],
+            [(1, 0x20, b"\x7c"), (1, 0x20, b"\x7e")],
+        )
+
+    def test_expander_keeps_channels_other_processes_set(self):
+        other = GPIOManager(gpio_module=self.chip)
+        ExpanderOutput(1, 0x20, manager=self.manager).write(3, ON)
+        ExpanderOutput(1, 0x20, manager=other).write(3, OFF)
+
+        ExpanderOutput(1, 0x20, manager=self.manager).write(4, ON)
+
+        self.assertEqual(self.chip.i2c_writes[-1].data, b"\xef")
+
+    def test_expander_rejects_unknown_channels(self):
+        with self.assertRaises(ValueError):
+            ExpanderOutput(1, 0x20, manager=self.manager).write(8, ON)
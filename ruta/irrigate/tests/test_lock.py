@@ -0,0 +1,44 @@
+import tempfile
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, override_settings
+
+from irrigate.lock import LockHeld, singleton_lock
+from irrigate.schedule import RUN_ALL_LOCK_NAME, run_all_and_report
+
+
+class SingletonLockTests(SimpleTestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        settings_override = override_settings(CACHE_DIR=cache_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_second_holder_is_refused(self):
+        with singleton_lock("test"):
+            with self.assertRaisesRegex(LockHeld, "locked by pid"):
+                with singleton_lock("test"):
+                    pass
+
+    def test_lock_is_released_on_exit(self):
+        with singleton_lock("test"):
+            pass
+
+        with singleton_lock("test"):
+            pass
+
+    def test_lock_is_released_on_error(self):
+        with self.assertRaises(ValueError):
+            with singleton_lock("test"):
+                raise ValueError
+
+        with singleton_lock("test"):
+            pass
+
+    @patch("irrigate.schedule.run_all")
+    def test_run_all_and_report_skips_while_another_pass_runs(self, mock_run_all):
+        with singleton_lock(RUN_ALL_LOCK_NAME):
+            self.assertEqual(run_all_and_report(), [])
+
+        mock_run_all.assert_not_called()
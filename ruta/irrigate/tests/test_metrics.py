@@ -0,0 +1,130 @@
+import json
+import os
+import tempfile
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from irrigate import metrics
+from irrigate.gpio import GPIO, GPIOManager, SimulatedChip
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_render(self):
+        runs = self.registry.counter("runs_total", "Runs", ["zone"])
+        level = self.registry.gauge("level", "Level")
+        seconds = self.registry.histogram("seconds", "Seconds", buckets=(1, 5))
+        runs.labels(zone='front "lawn"').inc()
+        runs.labels(zone='front "lawn"').inc(2)
+        level.set(3)
+        for value in (0.5, 2, 10):
+            seconds.observe(value)
+
+        text = metrics.render(self.registry.snapshot())
+
+        self.assertIn("# TYPE runs_total counter\n", text)
+        self.assertIn('runs_total{zone="front \\"lawn\\""} 3.0\n', text)
+        self.assertIn("level 3.0\n", text)
+        self.assertIn('seconds_bucket{le="1.0"} 1.0\n', text)
+        self.assertIn('seconds_bucket{le="5.0"} 2.0\n', text)
+        self.assertIn('seconds_bucket{le="+Inf"} 3.0\n', text)
+        self.assertIn("seconds_sum 12.5\n", text)
+        self.assertIn("seconds_count 3.0\n", text)
+
+    def test_labels_must_match(self):
+        runs = self.registry.counter("runs_total", "Runs", ["zone"])
+
+        with self.assertRaises(ValueError):
+            runs.labels(actuator="front").inc()
+        with self.assertRaises(ValueError):
+            runs.labels(zone="front").inc(-1)
+
+    def write(self, process_id, registry):
+        path = os.path.join(self.directory, f"{process_id}.json")
+        with open(path, "w") as snapshot_file:
+            json.dump(registry.snapshot(), snapshot_file)
+        return path
+
+    def test_collect_adds_up_processes_and_archives_exited_ones(self):
+        for process_id, runs, level in (("1-a", 1, 10), ("2-b", 2, 20)):
+            registry = metrics.Registry()
+            registry.counter("runs_total", "Runs").inc(runs)
+            registry.gauge("level", "Level").set(level)
+            registry.histogram("seconds", "Seconds").observe(runs)
+            exited = self.write(process_id, registry)
+
+        with patch("irrigate.metrics._is_running", side_effect=lambda id: id == "1-a"):
+            first = metrics.render(metrics.collect(self.directory))
+            self.write("3-c", registry)
+            second = metrics.render(metrics.collect(self.directory))
+
+        self.assertFalse(os.path.exists(exited))
+        self.assertIn("runs_total 3.0\n", first)
+        self.assertIn("seconds_count 2.0\n", first)
+        # only a running process's gauge counts
+        self.assertIn("level 10.0\n", first)
+        self.assertIn("runs_total 5.0\n", second)
+
+    def test_gpio_operations_are_timed(self):
+        GPIO(5, manager=GPIOManager(gpio_module=SimulatedChip())).start()
+
+        samples = dict(
+            (tuple(key), value)
+            for key, value in metrics.REGISTRY.snapshot()["metrics"][
+                "ruta_gpio_operation_seconds"
+            ]["samples"]
+        )
+        self.assertIn(("claim",), samples)
+
+
+class MetricsViewTests(TestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        settings_override = override_settings(
+            CACHE_DIR=cache_dir.name, METRICS_TOKEN="secret"
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_metrics_require_authentication(self):
+        user = get_user_model().objects.create_user(username="user", password="pw")
+        self.client.force_login(user)
+
+        response = self.client.get(reverse("metrics"))
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_metrics_with_wrong_token(self):
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer wrong"
+        )
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_metrics_with_token(self):
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret"
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        self.assertIn(b"# TYPE ruta_scheduler_passes_total counter", response.content)
+
+    def test_metrics_for_staff(self):
+        user = get_user_model().objects.create_user(
+            username="staff", password="pw", is_staff=True
+        )
+        self.client.force_login(user)
+
+        response = self.client.get(reverse("metrics"))
+
+        self.assertEqual(response.status_code, 200)
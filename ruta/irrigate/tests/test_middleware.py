@@ -0,0 +1,61 @@
+import tempfile
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from irrigate.models import Device
+from irrigate.profiling import list_profiles
+
+
+@patch("irrigate.views.plan_durations", return_value={})
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username="admin", password="pw", is_staff=True, is_superuser=True
+        )
+        self.client.force_login(self.user)
+
+    def test_off_by_default(self, mock_plan_durations):
+        response = self.client.get(reverse("dashboard"))
+
+        self.assertNotIn("Server-Timing", response)
+
+    @override_settings(REQUEST_PROFILING=True)
+    def test_dashboard_server_timing(self, mock_plan_durations):
+        response = self.client.get(reverse("dashboard"))
+
+        self.assertEqual(response.status_code, 200)
+        timing = response["Server-Timing"]
+        self.assertIn("db;dur=", timing)
+        self.assertIn("template;dur=", timing)
+        self.assertIn("total;dur=", timing)
+
+    @override_settings(REQUEST_PROFILING=True)
+    def test_admin_changelist_template_time(self, mock_plan_durations):
+        Device.objects.create(name="device")
+
+        response = self.client.get(reverse("admin:irrigate_device_changelist"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("template;dur=", response["Server-Timing"])
+
+    @override_settings(REQUEST_PROFILING=True, REQUEST_PROFILING_SLOW_SECONDS=0)
+    def test_slow_requests_are_logged(self, mock_plan_durations):
+        with self.assertLogs("irrigate.middleware", "WARNING") as logs:
+            self.client.get(reverse("dashboard"))
+
+        self.assertIn("Slow request GET /", logs.output[0])
+        self.assertIn("Slowest queries:", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
+    @override_settings(PROFILE_REQUESTS=True)
+    def test_profile_requests(self, mock_plan_durations):
+        with tempfile.TemporaryDirectory() as profile_dir:
+            with override_settings(PROFILE_DIR=profile_dir):
+                response = self.client.get(reverse("dashboard"))
+                profiles = list_profiles()
+
+        self.assertNotIn("Server-Timing", response)
+        self.assertEqual([profile.trigger for profile in profiles], ["GET"])
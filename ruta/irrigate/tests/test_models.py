@@ -1,9 +1,21 @@
-from datetime import datetime, time, timedelta
+from datetime import date, datetime, time, timedelta
 from unittest.mock import Mock, patch
 
+from django.core.exceptions import ValidationError
 from django.test import TestCase
 from django.utils import timezone
-from irrigate.models import Actuator, ActuatorRunLog, Device, ScheduleTime
+from freezegun import freeze_time
+
+from irrigate.gpio import OFF, ON, GPIOManager, GPIOWriteError, SimulatedChip
+from irrigate.models import (
+    Actuator,
+    ActuatorRunLog,
+    Device,
+    ScheduleTime,
+    WeatherDay,
+    plan_durations,
+)
+from irrigate.weather import DailyWeather, WeatherSnapshot
 
 
 class ActuatorTests(TestCase):
@@ -95,6 +107,39 @@ class ActuatorTests(TestCase):
 
         self.assertEqual(minutes, 12 * 3)
 
+    def test_get_recent_water_duration_in_minutes_counts_runs_over_a_day(self):
+        start_datetime = timezone.now() - timedelta(days=2)
+        ActuatorRunLog.objects.create(
+            actuator=self.actuator,
+            start_datetime=start_datetime,
+            end_datetime=start_datetime + timedelta(days=1, minutes=12),
+        )
+
+        minutes = self.actuator.get_recent_water_duration_in_minutes(days_ago=7)
+
+        self.assertEqual(minutes, 24 * 60 + 12)
+
+    def test_get_recent_water_durations_in_minutes_groups_by_actuator(self):
+        other_actuator = Actuator.objects.create(
+            name="other", gpio_pin=6, device=self.actuator.device
+        )
+        for actuator, minutes in [
+            (self.actuator, 12),
+            (self.actuator, 5),
+            (other_actuator, 7),
+        ]:
+            start_datetime = timezone.now() - timedelta(hours=1)
+            ActuatorRunLog.objects.create(
+                actuator=actuator,
+                start_datetime=start_datetime,
+                end_datetime=start_datetime + timedelta(minutes=minutes),
+            )
+
+        with self.assertNumQueries(1):
+            minutes = Actuator.get_recent_water_durations_in_minutes(days_ago=1)
+
+        self.assertEqual(minutes, {self.actuator.id: 17, other_actuator.id: 7})
+
     def test_get_recent_water_amount_in_inches(self):
         for i in range(3):
             start_datetime = timezone.now() - timedelta(days=i + 1)
@@ -134,6 +179,151 @@ class ActuatorTests(TestCase):
 
         self.assertEqual(amount, 0)
 
+    def test_stop_stores_duration_seconds(self):
+        start_datetime = timezone.now() - timedelta(minutes=30)
+        run = ActuatorRunLog.objects.create(
+            actuator=self.actuator, start_datetime=start_datetime
+        )
+        self.assertIsNone(run.duration_seconds)
+
+        self.actuator.stop(duration_in_seconds=600)
+
+        run.refresh_from_db()
+        self.assertEqual(run.end_datetime, start_datetime + timedelta(seconds=600))
+        self.assertEqual(run.duration_seconds, 600)
+        self.assertEqual(run.duration_in_minutes, 10)
+        self.assertEqual(run.status, ActuatorRunLog.FINISHED)
+
+    def test_stop_many_closes_open_runs_together(self):
+        chip = SimulatedChip()
+        expander = Device.objects.create(
+            name="expander",
+            output_type=Device.OutputType.I2C_EXPANDER,
+            i2c_address=0x20,
+        )
+        actuators = [
+            self.actuator,
+            Actuator.objects.create(
+                name="test", gpio_pin=6, device=self.actuator.device
+            ),
+            Actuator.objects.create(name="test", gpio_pin=0, device=expander),
+            Actuator.objects.create(name="test", gpio_pin=3, device=expander),
+        ]
+        start_datetime = timezone.now() - timedelta(minutes=10)
+        for actuator in actuators:
+            ActuatorRunLog.objects.create(
+                actuator=actuator, start_datetime=start_datetime
+            )
+
+        # every expander channel on
+        chip.i2c_write_device(chip.i2c_open(1, 0x20), b"\x00")
+
+        with patch("irrigate.gpio._manager", GPIOManager(gpio_module=chip)):
+            with self.assertNumQueries(5):
+                Actuator.stop_many(actuators)
+
+        self.assertEqual(chip.calls["group_claim_output"], 1)
+        self.assertEqual([chip.level(pin) for pin in (5, 6)], [OFF, OFF])
+        self.assertEqual(
+            [(write.address, write.data) for write in chip.i2c_writes],
+            [(0x20, b"\x00"), (0x20, b"\x09")],
+        )
+        self.assertFalse(
+            ActuatorRunLog.objects.filter(end_datetime__isnull=True).exists()
+        )
+        self.assertTrue(
+            all(run.duration_seconds >= 600 for run in ActuatorRunLog.objects.all())
+        )
+
+    def test_stop_many_stops_what_it_can(self):
+        chip = SimulatedChip()
+        busy = Actuator.objects.create(
+            name="busy", gpio_pin=6, device=self.actuator.device
+        )
+        for actuator in (self.actuator, busy):
+            ActuatorRunLog.objects.create(
+                actuator=actuator, start_datetime=timezone.now()
+            )
+        # another process is mid-write on pin 6
+        chip.gpio_claim_output(chip.gpiochip_open(0), 6, ON)
+
+        with patch("irrigate.gpio._manager", GPIOManager(gpio_module=chip)):
+            with self.assertRaisesRegex(GPIOWriteError, "busy"):
+                Actuator.stop_many([self.actuator, busy])
+
+        self.assertEqual([chip.level(pin) for pin in (5, 6)], [OFF, ON])
+        self.assertEqual(
+            list(
+                ActuatorRunLog.objects.filter(end_datetime__isnull=True).values_list(
+                    "actuator", flat=True
+                )
+            ),
+            [busy.id],
+        )
+
+    def test_run_log_status_uses_stored_duration(self):
+        start_datetime = timezone.now() - timedelta(days=1)
+        run = ActuatorRunLog.objects.create(
+            actuator=self.actuator,
+            start_datetime=start_datetime,
+            end_datetime=start_datetime,
+        )
+
+        self.assertEqual(run.duration_seconds, 0)
+        self.assertEqual(run.status, ActuatorRunLog.SKIPPED)
+
+    def test_start_with_duration_plans_its_end(self):
+        with patch("irrigate.models.arm_shutoff") as arm_shutoff:
+            self.actuator.start(duration_in_seconds=600)
+
+        run = ActuatorRunLog.objects.get()
+        self.assertEqual(
+            run.planned_end_datetime, run.start_datetime + timedelta(seconds=600)
+        )
+        self.assertEqual(
+            arm_shutoff.call_args.args[1:], (5, run.id, run.planned_end_datetime)
+        )
+
+    def test_start_without_duration_arms_nothing(self):
+        with patch("irrigate.models.arm_shutoff") as arm_shutoff:
+            self.actuator.start()
+
+        self.assertIsNone(ActuatorRunLog.objects.get().planned_end_datetime)
+        arm_shutoff.assert_not_called()
+
+    @patch("irrigate.models.get_shutoff_time")
+    def test_close_overdue_runs(self, get_shutoff_time):
+        now = timezone.now()
+        fired_at = now - timedelta(minutes=50)
+        overdue, watchdog_fired, on_time, untimed = [
+            ActuatorRunLog.objects.create(
+                actuator=self.actuator,
+                start_datetime=now - timedelta(hours=1),
+                planned_end_datetime=planned_end_datetime,
+            )
+            for planned_end_datetime in (
+                now - timedelta(minutes=40),
+                now - timedelta(minutes=50, seconds=30),
+                now,
+                None,
+            )
+        ]
+        get_shutoff_time.side_effect = lambda run_id: (
+            fired_at if run_id == watchdog_fired.id else None
+        )
+
+        closed = ActuatorRunLog.close_overdue_runs()
+
+        self.assertEqual({run.id for run in closed}, {overdue.id, watchdog_fired.id})
+        overdue.refresh_from_db()
+        self.assertEqual(overdue.end_datetime, overdue.planned_end_datetime)
+        self.assertEqual(overdue.duration_seconds, 20 * 60)
+        watchdog_fired.refresh_from_db()
+        self.assertEqual(watchdog_fired.end_datetime, fired_at)
+        self.assertEqual(
+            ActuatorRunLog.objects.filter(end_datetime__isnull=True).count(), 2
+        )
+
     def test_get_number_of_scheduled_times(self):
         for i in range(3):
             start_time = time(6, 0)
@@ -145,3 +335,190 @@ class ActuatorTests(TestCase):
         count = self.actuator.get_number_of_scheduled_times()
 
         self.assertEqual(count, 3)
+
+
+class DeviceOutputTests(TestCase):
+    def setUp(self):
+        self.chip = SimulatedChip()
+        manager = patch("irrigate.gpio._manager", GPIOManager(gpio_module=self.chip))
+        manager.start()
+        self.addCleanup(manager.stop)
+
+    def test_actuator_on_second_gpio_chip(self):
+        device = Device.objects.create(name="device", gpio_chip=1)
+        actuator = Actuator.objects.create(name="test", gpio_pin=5, device=device)
+
+        actuator.start()
+
+        self.assertEqual(self.chip.level(5, chip=1), ON)
+        self.assertIsNone(self.chip.level(5, chip=0))
+
+    def test_actuators_on_relay_expander(self):
+        device = Device.objects.create(
+            name="expander",
+            output_type=Device.OutputType.I2C_EXPANDER,
+            i2c_address=0x20,
+            i2c_channels=16,
+        )
+        first = Actuator.objects.create(name="test", gpio_pin=0, device=device)
+        second = Actuator.objects.create(name="test", gpio_pin=9, device=device)
+
+        first.start()
+        second.start()
+        first.stop()
+
+        self.assertEqual(
+            [write.data for write in self.chip.i2c_writes],
+            [b"\xfe\xff", b"\xfe\xfd", b"\xff\xfd"],
+        )
+
+    def test_relay_expander_needs_an_address(self):
+        device = Device(name="expander", output_type=Device.OutputType.I2C_EXPANDER)
+
+        with self.assertRaises(ValidationError):
+            device.full_clean()
+
+
+class DeviceTests(TestCase):
+    def setUp(self):
+        self.device = Device(
+            name="device", max_concurrent_actuators=2, max_flow_rate_per_minute=0.05
+        )
+
+    def actuator(self, flow_rate_per_minute=0.02):
+        return Actuator(
+            name="zone", gpio_pin=5, flow_rate_per_minute=flow_rate_per_minute
+        )
+
+    def test_has_capacity_for_alone_even_over_flow_limit(self):
+        self.assertTrue(self.device.has_capacity_for(self.actuator(0.1), []))
+
+    def test_has_capacity_for_within_limits(self):
+        self.assertTrue(
+            self.device.has_capacity_for(self.actuator(), [self.actuator(0.03)])
+        )
+
+    def test_has_capacity_for_over_flow_limit(self):
+        self.assertFalse(
+            self.device.has_capacity_for(self.actuator(), [self.actuator(0.04)])
+        )
+
+    def test_has_capacity_for_over_concurrent_limit(self):
+        self.device.max_flow_rate_per_minute = None
+
+        self.assertFalse(
+            self.device.has_capacity_for(
+                self.actuator(), [self.actuator(), self.actuator()]
+            )
+        )
+
+
+class PlanDurationsTests(TestCase):
+    def setUp(self):
+        device = Device.objects.create(name="device")
+        self.actuators = [
+            Actuator.objects.create(
+                name=f"zone {i}",
+                gpio_pin=i,
+                device=device,
+                flow_rate_per_minute=0.02 * (i + 1),
+            )
+            for i in range(3)
+        ]
+        for weekday in range(3):
+            schedule_time = ScheduleTime.objects.create(
+                weekday=weekday, start_time=time(6, 0)
+            )
+            schedule_time.actuators.add(*self.actuators[: weekday + 1])
+        start_datetime = timezone.now() - timedelta(days=1)
+        ActuatorRunLog.objects.create(
+            actuator=self.actuators[1],
+            start_datetime=start_datetime,
+            end_datetime=start_datetime + timedelta(minutes=5),
+        )
+        self.snapshot = Mock(spec=WeatherSnapshot)
+        self.snapshot.get_precipitation_in_inches.return_value = 0.1
+        self.snapshot.get_forecasted_precipitation_in_inches.return_value = 0.05
+        self.snapshot.get_todays_high_temperature.return_value = 90
+
+    def test_plan_durations_matches_get_duration_summary(self):
+        summaries = plan_durations(self.actuators, snapshot=self.snapshot)
+
+        self.assertEqual(
+            summaries,
+            {
+                actuator.id: actuator.get_duration_summary(snapshot=self.snapshot)
+                for actuator in self.actuators
+            },
+        )
+
+    def test_plan_durations_query_count_does_not_grow_with_actuators(self):
+        with self.assertNumQueries(2):
+            plan_durations(self.actuators, snapshot=self.snapshot)
+
+    def test_plan_durations_no_actuators(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(plan_durations([], snapshot=self.snapshot), {})
+
+
+def history_response(*dates):
+    return tuple(DailyWeather(date.fromisoformat(day), 0.1, 70) for day in dates)
+
+
+class WeatherDayTests(TestCase):
+    @patch("irrigate.models.fetch_historical_weather")
+    def test_ingest_history_only_fetches_missing_days(
+        self, mock_fetch_historical_weather
+    ):
+        mock_fetch_historical_weather.return_value = history_response(
+            "2021-05-28", "2021-05-29", "2021-05-30", "2021-05-31"
+        )
+        with freeze_time("2021-05-31 10:00:00+00:00"):
+            WeatherDay.ingest_history(location="here", days_ago=3)
+
+        mock_fetch_historical_weather.return_value = history_response(
+            "2021-05-31", "2021-06-01"
+        )
+        with freeze_time("2021-06-01 10:00:00+00:00"):
+            WeatherDay.ingest_history(location="here", days_ago=3)
+
+        self.assertEqual(WeatherDay.objects.filter(location="here").count(), 5)
+        mock_fetch_historical_weather.assert_called_with(
+            location="here",
+            start_date=datetime(2021, 5, 31).date(),
+            end_date=datetime(2021, 6, 1).date(),
+        )
+
+    @patch("irrigate.models.fetch_historical_weather")
+    def test_ingest_history_goes_by_the_locations_date(
+        self, mock_fetch_historical_weather
+    ):
+        mock_fetch_historical_weather.return_value = history_response(
+            "2021-05-30", "2021-05-31"
+        )
+        # still the evening of May 31st in Ann Arbor
+        with freeze_time("2021-06-01 02:00:00+00:00"):
+            WeatherDay.ingest_history(location="here", days_ago=1)
+
+        mock_fetch_historical_weather.assert_called_once_with(
+            location="here",
+            start_date=date(2021, 5, 30),
+            end_date=date(2021, 5, 31),
+        )
+        self.assertFalse(WeatherDay.objects.get(date=date(2021, 5, 31)).is_final)
+        self.assertTrue(WeatherDay.objects.get(date=date(2021, 5, 30)).is_final)
+
+    @patch("irrigate.models.fetch_historical_weather")
+    def test_ingest_history_skips_recently_fetched_today(
+        self, mock_fetch_historical_weather
+    ):
+        mock_fetch_historical_weather.return_value = history_response(
+            "2021-05-30", "2021-05-31"
+        )
+        with freeze_time("2021-05-31 10:00:00+00:00"):
+            WeatherDay.ingest_history(location="here", days_ago=1)
+        with freeze_time("2021-05-31 10:30:00+00:00"):
+            fetched_days = WeatherDay.ingest_history(location="here", days_ago=1)
+
+        self.assertEqual(fetched_days, [])
+        mock_fetch_historical_weather.assert_called_once()
@@ -1,39 +1,179 @@
-from unittest.mock import patch
+import time
+from unittest.mock import Mock, patch
 
 import requests
 from django.test import SimpleTestCase
+from freezegun import freeze_time
 
 from irrigate.monitor import (
-    BASE_URL,
     REQUEST_TIMEOUT,
+    Emitter,
     MonitoringEvent,
     MonitoringEventStatus,
+    RunReport,
     emit,
 )
 
 
+def make_event(name="test event"):
+    return MonitoringEvent(name=name, status=MonitoringEventStatus.IN_PROGRESS)
+
+
 class MonitorTests(SimpleTestCase):
-    @patch("irrigate.monitor.requests.post")
-    def test_emit_uses_request_timeout(self, mock_post):
-        event = MonitoringEvent(
-            name="test event",
-            status=MonitoringEventStatus.IN_PROGRESS,
+    def setUp(self):
+        self.session = Mock()
+        self.session.post.return_value = Mock(status_code=200, ok=True)
+
+    def make_emitter(self, **kwargs):
+        kwargs.setdefault("batch_wait", 0.1)
+        kwargs.setdefault("backoff", 0)
+        return Emitter("https://example.com/hook", session=self.session, **kwargs)
+
+    @patch("irrigate.monitor.BASE_URL", None)
+    def test_emit_without_webhook_does_nothing(self):
+        self.assertFalse(emit(make_event()))
+
+    def test_events_are_batched_into_one_post(self):
+        emitter = self.make_emitter()
+
+        for i in range(3):
+            emitter.emit(make_event(f"event {i}"))
+        self.assertTrue(emitter.flush(timeout=5))
+
+        self.session.post.assert_called_once()
+        self.assertEqual(self.session.post.call_args.kwargs["timeout"], REQUEST_TIMEOUT)
+        events = self.session.post.call_args.kwargs["json"]["events"]
+        self.assertEqual(
+            [event["name"] for event in events], ["event 0", "event 1", "event 2"]
+        )
+        self.assertEqual(events[0]["status"], "in progress")
+
+    def test_batches_are_capped(self):
+        emitter = self.make_emitter(max_batch_size=2)
+
+        for i in range(5):
+            emitter.emit(make_event(f"event {i}"))
+        emitter.flush(timeout=5)
+
+        self.assertEqual(self.session.post.call_count, 3)
+
+    def test_emit_does_not_wait_on_slow_webhook(self):
+        def slow_post(*args, **kwargs):
+            time.sleep(0.5)
+            return Mock(status_code=200, ok=True)
+
+        self.session.post.side_effect = slow_post
+        emitter = self.make_emitter()
+
+        started = time.monotonic()
+        emitter.emit(make_event())
+
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertFalse(emitter.flush(timeout=0.1))
+        self.assertTrue(emitter.flush(timeout=5))
+
+    def test_failures_are_retried(self):
+        self.session.post.side_effect = [
+            requests.Timeout("timed out"),
+            Mock(status_code=503, ok=False),
+            Mock(status_code=200, ok=True),
+        ]
+        emitter = self.make_emitter()
+
+        emitter.emit(make_event())
+        emitter.flush(timeout=5)
+
+        self.assertEqual(self.session.post.call_count, 3)
+
+    def test_gives_up_after_max_attempts(self):
+        self.session.post.side_effect = requests.ConnectionError("refused")
+        emitter = self.make_emitter(max_attempts=2)
+
+        emitter.emit(make_event())
+        emitter.emit(make_event())
+
+        self.assertTrue(emitter.flush(timeout=5))
+        self.assertEqual(self.session.post.call_count, 2)
+
+    def test_rejected_events_are_not_retried(self):
+        self.session.post.return_value = Mock(status_code=400, ok=False)
+        emitter = self.make_emitter()
+
+        emitter.emit(make_event())
+        emitter.flush(timeout=5)
+
+        self.session.post.assert_called_once()
+
+    @patch.object(Emitter, "_ensure_started")
+    def test_full_queue_drops_events(self, ensure_started):
+        emitter = self.make_emitter(max_queued_events=1)
+
+        self.assertTrue(emitter.emit(make_event()))
+        self.assertFalse(emitter.emit(make_event()))
+        self.assertEqual(emitter.dropped, 1)
+
+    def test_events_are_stamped_when_created(self):
+        with freeze_time("2021-05-31 10:00:00"):
+            first = make_event()
+        with freeze_time("2021-05-31 10:05:00"):
+            second = make_event()
+
+        self.assertLess(first.created_at, second.created_at)
+
+
+class RunReportTests(SimpleTestCase):
+    def setUp(self):
+        self.actuator = Mock(id=1, __str__=Mock(return_value="front lawn"))
+
+    @patch("irrigate.monitor.time.monotonic")
+    @patch("irrigate.monitor.emit")
+    def test_heartbeats_are_rate_limited(self, mock_emit, mock_monotonic):
+        report = RunReport(heartbeat_interval=60)
+        mock_monotonic.side_effect = [0, 30, 61]
+
+        self.assertTrue(report.heartbeat())
+        self.assertFalse(report.heartbeat())
+        self.assertTrue(report.heartbeat())
+
+        self.assertEqual(mock_emit.call_count, 2)
+        self.assertEqual(
+            mock_emit.call_args.args[0].status, MonitoringEventStatus.IN_PROGRESS
         )
 
-        emit(event)
+    @patch("irrigate.monitor.emit")
+    def test_finish_sends_every_zone_in_one_event(self, mock_emit):
+        report = RunReport()
+        zone = report.add_zone(self.actuator, Mock(id=7))
+        zone.planned_seconds = 600
+        zone.actual_seconds = 601
+        zone.reason = "Calculated"
 
-        mock_post.assert_called_once()
-        self.assertEqual(mock_post.call_args.kwargs["timeout"], REQUEST_TIMEOUT)
-        self.assertEqual(mock_post.call_args.args[0], BASE_URL)
+        report.finish()
 
-    @patch("irrigate.monitor.requests.post")
-    def test_emit_returns_when_request_times_out(self, mock_post):
-        mock_post.side_effect = requests.Timeout("timed out")
-        event = MonitoringEvent(
-            name="test event",
-            status=MonitoringEventStatus.IN_PROGRESS,
+        mock_emit.assert_called_once()
+        event = mock_emit.call_args.args[0]
+        self.assertEqual(event.status, MonitoringEventStatus.SUCCESS)
+        self.assertEqual(event.data["status"], "success")
+        self.assertEqual(
+            event.data["zones"],
+            [
+                {
+                    "actuator_id": 1,
+                    "actuator": "front lawn",
+                    "schedule_time_id": 7,
+                    "planned_seconds": 600,
+                    "actual_seconds": 601,
+                    "reason": "Calculated",
+                    "error": None,
+                }
+            ],
         )
 
-        response = emit(event)
+    @patch("irrigate.monitor.emit")
+    def test_zone_errors_fail_the_report(self, mock_emit):
+        report = RunReport()
+        report.add_zone(self.actuator).error = "GPIO busy"
+
+        event = report.finish()
 
-        self.assertIsNone(response)
+        self.assertEqual(event.status, MonitoringEventStatus.FAILURE)
@@ -0,0 +1,90 @@
+import os
+import tempfile
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+from freezegun import freeze_time
+
+from irrigate import profiling
+
+
+class RequestProfileTests(SimpleTestCase):
+    def test_record_needs_an_active_profile(self):
+        profiling.record("weather", 1)
+
+        profile = profiling.RequestProfile()
+        with profiling.activate(profile):
+            profiling.record("weather", 0.25)
+            profiling.record("weather", 0.25)
+        profiling.record("weather", 1)
+
+        self.assertEqual(profile.timings, {"weather": 0.5})
+        self.assertEqual(
+            profile.server_timing(total_seconds=1),
+            'weather;dur=500.0;desc="2 call(s)", total;dur=1000.0',
+        )
+
+    def test_keeps_slowest_queries(self):
+        profile = profiling.RequestProfile(slowest_queries_kept=2)
+
+        for seconds in (0.1, 0.3, 0.2, 0.05):
+            profile.record_query(f"SELECT {seconds}", seconds)
+
+        self.assertEqual(
+            [query.sql for query in profile.slowest_queries],
+            ["SELECT 0.3", "SELECT 0.2"],
+        )
+        self.assertEqual(profile.counts["db"], 4)
+
+
+class CaptureProfileTests(SimpleTestCase):
+    def setUp(self):
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        settings_override = override_settings(
+            PROFILE_DIR=profile_dir.name, PROFILES_KEPT=2
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def capture(self, when, trigger):
+        with freeze_time(when):
+            with profiling.capture_profile(trigger):
+                sum(range(100))
+
+    def test_profiles_are_named_for_time_and_trigger_and_rotated(self):
+        self.capture("2021-05-31 10:00:00", "run_all")
+        self.capture("2021-05-31 10:05:00", "GET /admin/")
+        self.capture("2021-05-31 10:10:00", "stop_all")
+
+        profiles = profiling.list_profiles()
+
+        self.assertEqual(
+            [profile.trigger for profile in profiles], ["stop_all", "GET_admin"]
+        )
+        self.assertTrue(profiles[0].name.startswith(f"20210531T101000-{os.getpid()}-"))
+
+    def test_list_profiles_command(self):
+        self.capture("2021-05-31 10:00:00", "run_all")
+        self.capture("2021-05-31 10:05:00", "stop_all")
+        out = StringIO()
+
+        call_command("list_profiles", stdout=out)
+        listing = out.getvalue()
+        call_command("list_profiles", "latest", "--limit", "5", stdout=out)
+
+        self.assertLess(listing.index("stop_all"), listing.index("run_all"))
+        self.assertIn("2021-05-31 10:05:00", listing)
+        self.assertIn("function calls", out.getvalue())
+
+    @patch("irrigate.management.commands.run_scheduled_jobs.run_all_and_report")
+    def test_run_scheduled_jobs_profile(self, mock_run_all_and_report):
+        call_command("run_scheduled_jobs", "--profile")
+        call_command("run_scheduled_jobs")
+
+        self.assertEqual(mock_run_all_and_report.call_count, 2)
+        self.assertEqual(
+            [profile.trigger for profile in profiling.list_profiles()], ["run_all"]
+        )
@@ -1,11 +1,34 @@
-from datetime import time
+import threading
+from datetime import datetime, time, timedelta
+from types import SimpleNamespace
 from unittest.mock import Mock, patch
 
 from django.test import TestCase
+from django.utils import timezone
 from freezegun import freeze_time
 
+from irrigate.gpio import OFF, ON, GPIOManager, SimulatedChip
 from irrigate.models import Actuator, ActuatorRunLog, Device, ScheduleTime
-from irrigate.schedule import GRASS_SEED_DURATION_SECONDS, run_all
+from irrigate.monitor import MonitoringEventStatus, RunReport
+from irrigate.schedule import (
+    GRASS_SEED_DURATION_SECONDS,
+    RunExecutor,
+    has_run,
+    run_all,
+    run_all_and_report,
+)
+
+
+def plan(duration_in_seconds):
+    def plan_durations(actuators, snapshot=None):
+        return {
+            actuator.id: SimpleNamespace(
+                final_duration_seconds=duration_in_seconds, reason="Calculated"
+            )
+            for actuator in actuators
+        }
+
+    return plan_durations
 
 
 class ScheduleTests(TestCase):
@@ -15,20 +38,13 @@ class ScheduleTests(TestCase):
             name="test", gpio_pin=5, device=self.device
         )
 
-    @patch("irrigate.models.Actuator.get_temperature_watering_adjustment_multiplier")
-    @patch("irrigate.models.Actuator.get_duration_in_seconds")
-    @patch("irrigate.schedule.time.sleep")
-    def test_run_all(
-        self,
-        mock_sleep,
-        mock_get_duration_in_seconds,
-        mock_get_temperature_watering_adjustment_multiplier,
-    ):
-        mock_get_temperature_watering_adjustment_multiplier.return_value = 1
+    @patch("irrigate.schedule.plan_durations")
+    @patch("irrigate.schedule.asyncio.sleep")
+    def test_run_all(self, mock_sleep, mock_plan_durations):
         schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
         schedule_time.actuators.add(self.actuator)
         SPRINKLER_DURATION = 720
-        mock_get_duration_in_seconds.return_value = SPRINKLER_DURATION
+        mock_plan_durations.side_effect = plan(SPRINKLER_DURATION)
         with freeze_time("2021-05-31 9:55"):
             run_all()
             mock_sleep.assert_not_called()
@@ -42,23 +58,16 @@ class ScheduleTests(TestCase):
             run_all()
             mock_sleep.assert_not_called()
 
-    @patch("irrigate.models.Actuator.get_temperature_watering_adjustment_multiplier")
-    @patch("irrigate.models.Actuator.get_duration_in_seconds")
-    @patch("irrigate.schedule.time.sleep")
-    def test_run_all_multiple(
-        self,
-        mock_sleep,
-        mock_get_duration_in_seconds,
-        mock_get_temperature_watering_adjustment_multiplier,
-    ):
-        mock_get_temperature_watering_adjustment_multiplier.return_value = 1
+    @patch("irrigate.schedule.plan_durations")
+    @patch("irrigate.schedule.asyncio.sleep")
+    def test_run_all_multiple(self, mock_sleep, mock_plan_durations):
         schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
         another_actuator = Actuator.objects.create(
             name="test", gpio_pin=6, device=self.device
         )
         schedule_time.actuators.add(self.actuator, another_actuator)
         SPRINKLER_DURATION = 720
-        mock_get_duration_in_seconds.return_value = SPRINKLER_DURATION
+        mock_plan_durations.side_effect = plan(SPRINKLER_DURATION)
         with freeze_time("2021-05-31 9:55"):
             run_all()
             mock_sleep.assert_not_called()
@@ -72,24 +81,324 @@ class ScheduleTests(TestCase):
             run_all()
             mock_sleep.assert_not_called()
 
+    @patch("irrigate.schedule.plan_durations")
+    @patch("irrigate.schedule.asyncio.sleep")
+    def test_run_all_plans_due_actuators_together(
+        self, mock_sleep, mock_plan_durations
+    ):
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        another_actuator = Actuator.objects.create(
+            name="test", gpio_pin=6, device=self.device
+        )
+        schedule_time.actuators.add(self.actuator, another_actuator)
+        mock_plan_durations.side_effect = plan(720)
+
+        with freeze_time("2021-05-31 10:01"):
+            run_all()
+
+        mock_plan_durations.assert_called_once()
+        (actuators,), _ = mock_plan_durations.call_args
+        self.assertEqual(set(actuators), {self.actuator, another_actuator})
+        self.assertEqual(mock_sleep.call_count, 2)
+
+    @patch("irrigate.models.Actuator.get_duration_in_seconds")
+    @patch("irrigate.schedule.plan_durations")
+    @patch("irrigate.schedule.asyncio.sleep")
+    def test_run_all_recalculates_repeat_runs_of_an_actuator(
+        self, mock_sleep, mock_plan_durations, mock_get_duration_in_seconds
+    ):
+        for start_time in (time(6, 0), time(10, 0)):
+            ScheduleTime.objects.create(weekday=0, start_time=start_time).actuators.add(
+                self.actuator
+            )
+        mock_plan_durations.side_effect = plan(720)
+        mock_get_duration_in_seconds.return_value = 60
+
+        with freeze_time("2021-05-31 10:01"):
+            run_all()
+
+        self.assertEqual(
+            [call.args for call in mock_sleep.call_args_list], [(720,), (60,)]
+        )
+
+    @patch("irrigate.schedule.plan_durations")
+    def test_run_all_overlaps_runs_within_device_limit(self, mock_plan_durations):
+        self.device.max_concurrent_actuators = 2
+        self.device.save()
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        actuators = [self.actuator] + [
+            Actuator.objects.create(name="test", gpio_pin=pin, device=self.device)
+            for pin in (6, 7)
+        ]
+        schedule_time.actuators.add(*actuators)
+        mock_plan_durations.side_effect = plan(0.2)
+
+        with freeze_time("2021-05-31 10:01", tick=True):
+            run_all()
+            self.assertTrue(
+                all(has_run(schedule_time, actuator) for actuator in actuators)
+            )
+
+        first, second, third = ActuatorRunLog.objects.order_by("start_datetime")
+        self.assertLess(second.start_datetime, first.end_datetime)
+        self.assertGreaterEqual(third.start_datetime, first.end_datetime)
+        self.assertLess(
+            third.end_datetime - first.start_datetime, timedelta(seconds=0.6)
+        )
+
+    @patch("irrigate.schedule.plan_durations")
+    def test_run_all_switches_pins_with_latency(self, mock_plan_durations):
+        chip = SimulatedChip(latency=0.01)
+        self.device.max_concurrent_actuators = 10
+        self.device.save()
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        schedule_time.actuators.add(
+            self.actuator,
+            *(
+                Actuator.objects.create(name="test", gpio_pin=pin, device=self.device)
+                for pin in range(6, 15)
+            ),
+        )
+        mock_plan_durations.side_effect = plan(0.1)
+
+        with patch("irrigate.gpio._manager", GPIOManager(gpio_module=chip)):
+            with freeze_time("2021-05-31 10:01", tick=True):
+                run_all()
+
+        for pin in range(5, 15):
+            self.assertEqual(
+                [write.level for write in chip.writes if write.pin == pin], [ON, OFF]
+            )
+        # every zone was on at once, not one after another
+        last_on = max(
+            write.monotonic_time for write in chip.writes if write.level == ON
+        )
+        first_off = min(
+            write.monotonic_time for write in chip.writes if write.level == OFF
+        )
+        self.assertLess(last_on, first_off)
+
+    @patch("irrigate.schedule.plan_durations")
+    @patch("irrigate.schedule.asyncio.sleep")
+    def test_run_all_stops_active_runs_on_error(self, mock_sleep, mock_plan_durations):
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        another_actuator = Actuator.objects.create(
+            name="test", gpio_pin=6, device=self.device
+        )
+        schedule_time.actuators.add(self.actuator, another_actuator)
+        self.device.max_concurrent_actuators = 2
+        self.device.save()
+        mock_plan_durations.side_effect = plan(600)
+        mock_sleep.side_effect = [RuntimeError, None]
+
+        with freeze_time("2021-05-31 10:01"), self.assertRaises(RuntimeError):
+            run_all()
+
+        self.assertEqual(ActuatorRunLog.objects.count(), 2)
+        self.assertFalse(
+            ActuatorRunLog.objects.filter(end_datetime__isnull=True).exists()
+        )
+
+    @patch("irrigate.schedule.plan_durations")
+    @patch("irrigate.schedule.asyncio.sleep")
+    def test_run_all_stops_a_valve_that_opened_as_the_pass_aborted(
+        self, mock_sleep, mock_plan_durations
+    ):
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        another_actuator = Actuator.objects.create(
+            name="test", gpio_pin=6, device=self.device
+        )
+        schedule_time.actuators.add(self.actuator, another_actuator)
+        self.device.max_concurrent_actuators = 2
+        self.device.save()
+        mock_plan_durations.side_effect = plan(600)
+        aborted = threading.Event()
+        start = Actuator.start
+        abort = RunExecutor._abort
+
+        def start_or_fail(actuator, **kwargs):
+            if actuator == self.actuator:
+                raise RuntimeError("stuck valve")
+            # still opening when the other zone fails
+            start(actuator, **kwargs)
+            self.assertTrue(aborted.wait(timeout=5))
+
+        async def record_abort(executor):
+            await abort(executor)
+            aborted.set()
+
+        with patch.object(
+            Actuator, "start", autospec=True, side_effect=start_or_fail
+        ), patch.object(
+            RunExecutor, "_abort", autospec=True, side_effect=record_abort
+        ), freeze_time(
+            "2021-05-31 10:01"
+        ), self.assertRaises(
+            RuntimeError
+        ):
+            run_all()
+
+        mock_sleep.assert_not_called()
+        run_log = ActuatorRunLog.objects.get()
+        self.assertEqual(run_log.actuator, another_actuator)
+        self.assertIsNotNone(run_log.end_datetime)
+
+    @patch("irrigate.monitor.emit")
+    @patch("irrigate.schedule.plan_durations")
+    @patch("irrigate.schedule.asyncio.sleep")
+    def test_run_all_and_report_sends_one_report(
+        self, mock_sleep, mock_plan_durations, mock_emit
+    ):
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        fixed = ScheduleTime.objects.create(
+            weekday=0, start_time=time(9, 0), duration_in_minutes=5
+        )
+        another_actuator = Actuator.objects.create(
+            name="test", gpio_pin=6, device=self.device
+        )
+        schedule_time.actuators.add(self.actuator, another_actuator)
+        fixed.actuators.add(another_actuator)
+        mock_plan_durations.side_effect = plan(720)
+
+        with freeze_time("2021-05-31 10:01"):
+            run_all_and_report()
+
+        # the first heartbeat, then the report
+        self.assertEqual(mock_emit.call_count, 2)
+        event = mock_emit.call_args.args[0]
+        self.assertEqual(event.status, MonitoringEventStatus.SUCCESS)
+        zones = {
+            (zone["actuator_id"], zone["schedule_time_id"]): zone
+            for zone in event.data["zones"]
+        }
+        self.assertEqual(len(zones), 3)
+        self.assertEqual(
+            zones[(another_actuator.id, fixed.id)]["reason"], "Scheduled duration"
+        )
+        self.assertEqual(zones[(another_actuator.id, fixed.id)]["planned_seconds"], 300)
+        zone = zones[(self.actuator.id, schedule_time.id)]
+        self.assertEqual((zone["planned_seconds"], zone["reason"]), (720, "Calculated"))
+        self.assertIsNotNone(zone["actual_seconds"])
+
+    @patch("irrigate.monitor.emit")
+    @patch("irrigate.schedule.plan_durations")
+    @patch("irrigate.schedule.asyncio.sleep")
+    def test_run_all_and_report_reports_errors(
+        self, mock_sleep, mock_plan_durations, mock_emit
+    ):
+        ScheduleTime.objects.create(weekday=0, start_time=time(10, 0)).actuators.add(
+            self.actuator
+        )
+        mock_plan_durations.side_effect = plan(600)
+        mock_sleep.side_effect = RuntimeError("stuck")
+
+        with freeze_time("2021-05-31 10:01"):
+            self.assertEqual(run_all_and_report(), [])
+
+        event = mock_emit.call_args.args[0]
+        self.assertEqual(event.status, MonitoringEventStatus.FAILURE)
+        self.assertEqual(event.data["zones"][0]["error"], "stuck")
+        self.assertEqual(len(event.data["errors"]), 1)
+
+    @patch("irrigate.monitor.emit")
+    def test_run_all_and_report_quiet_when_nothing_is_due(self, mock_emit):
+        run_all_and_report()
+
+        mock_emit.assert_not_called()
+
     @patch("irrigate.schedule._run")
     def test_run_all_no_times(self, mock_run):
         run_all()
         mock_run.assert_not_called()
 
-    @patch("irrigate.schedule.emit")
-    @patch("irrigate.schedule._run")
-    def test_run_all_grass_seed_mode_runs_at_evening_hour(self, mock_run, mock_emit):
-        mock_run.return_value = GRASS_SEED_DURATION_SECONDS
+    @patch("irrigate.schedule.asyncio.sleep")
+    def test_run_all_grass_seed_mode_runs_at_evening_hour(self, mock_sleep):
         self.actuator.grass_seed_mode = True
         self.actuator.save()
+        report = RunReport()
 
         with freeze_time("2021-06-01 00:01:00+00:00"):
-            actuators_that_ran = run_all()
+            actuators_that_ran = run_all(report=report)
 
         self.assertEqual(actuators_that_ran, [self.actuator])
-        mock_run.assert_called_once_with(
-            self.actuator,
-            schedule_time=ScheduleTime.objects.get(),
-            duration_override=GRASS_SEED_DURATION_SECONDS,
+        mock_sleep.assert_called_once_with(GRASS_SEED_DURATION_SECONDS)
+        run_log = ActuatorRunLog.objects.get()
+        self.assertEqual(run_log.schedule_time, ScheduleTime.objects.get())
+        self.assertIsNotNone(run_log.end_datetime)
+        self.assertEqual(report.zones[0].reason, "Grass seed mode")
+
+    @patch("irrigate.schedule.plan_durations")
+    def test_run_all_grass_seed_mode_keeps_to_device_limit(self, mock_plan_durations):
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        schedule_time.actuators.add(self.actuator)
+        grass_seed_actuator = Actuator.objects.create(
+            name="test", gpio_pin=6, device=self.device, grass_seed_mode=True
         )
+        mock_plan_durations.side_effect = plan(0.1)
+
+        with patch("irrigate.schedule.GRASS_SEED_DURATION_SECONDS", 0.1):
+            with freeze_time("2021-05-31 10:01", tick=True):
+                run_all()
+
+        first, second = ActuatorRunLog.objects.order_by("start_datetime")
+        self.assertEqual(
+            [first.actuator, second.actuator], [self.actuator, grass_seed_actuator]
+        )
+        self.assertGreaterEqual(second.start_datetime, first.end_datetime)
+
+    @patch("irrigate.schedule.plan_durations")
+    def test_run_all_grass_seed_mode_overlaps_within_device_limit(
+        self, mock_plan_durations
+    ):
+        self.device.max_concurrent_actuators = 2
+        self.device.save()
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        schedule_time.actuators.add(self.actuator)
+        Actuator.objects.create(
+            name="test", gpio_pin=6, device=self.device, grass_seed_mode=True
+        )
+        mock_plan_durations.side_effect = plan(0.1)
+
+        with patch("irrigate.schedule.GRASS_SEED_DURATION_SECONDS", 0.1):
+            with freeze_time("2021-05-31 10:01", tick=True):
+                run_all()
+
+        first, second = ActuatorRunLog.objects.order_by("start_datetime")
+        self.assertLess(second.start_datetime, first.end_datetime)
+
+    @patch("irrigate.schedule.plan_durations")
+    @patch("irrigate.schedule.asyncio.sleep")
+    def test_run_all_grass_seed_mode_skips_scheduled_actuators(
+        self, mock_sleep, mock_plan_durations
+    ):
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        schedule_time.actuators.add(self.actuator)
+        self.actuator.grass_seed_mode = True
+        self.actuator.save()
+        mock_plan_durations.side_effect = plan(720)
+
+        with freeze_time("2021-05-31 10:01"):
+            run_all()
+
+        mock_sleep.assert_called_once_with(720)
+        self.assertEqual(ScheduleTime.objects.count(), 1)
+
+    def test_has_run_only_counts_runs_from_today(self):
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        ActuatorRunLog.objects.create(
+            actuator=self.actuator,
+            schedule_time=schedule_time,
+            start_datetime=timezone.make_aware(datetime(2021, 5, 30, 23, 59)),
+        )
+
+        with freeze_time("2021-05-31 10:01"):
+            self.assertFalse(has_run(schedule_time, self.actuator))
+
+        ActuatorRunLog.objects.create(
+            actuator=self.actuator,
+            schedule_time=schedule_time,
+            start_datetime=timezone.make_aware(datetime(2021, 5, 31, 0, 0)),
+        )
+
+        with freeze_time("2021-05-31 10:01"):
+            self.assertTrue(has_run(schedule_time, self.actuator))
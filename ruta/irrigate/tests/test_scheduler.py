@@ -0,0 +1,211 @@
+from datetime import datetime, time, timedelta
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from freezegun import freeze_time
+
+from irrigate import schedule
+from irrigate.models import Actuator, ActuatorRunLog, Device, ScheduleTime
+from irrigate.scheduler import (
+    ScheduleIndex,
+    Scheduler,
+    bump_schedule_version,
+    cache,
+    get_schedule_version,
+)
+
+
+def aware(*args):
+    return timezone.make_aware(datetime(*args))
+
+
+class ScheduleIndexNextDueTests(SimpleTestCase):
+    # 2021-05-31 is a Monday
+    def test_next_due_later_today(self):
+        index = ScheduleIndex(start_times=[(0, time(10, 0))])
+
+        due = index.next_due(aware(2021, 5, 31, 9, 55))
+
+        self.assertEqual(due, aware(2021, 5, 31, 10, 0))
+
+    def test_next_due_next_week_once_passed(self):
+        index = ScheduleIndex(start_times=[(0, time(10, 0))])
+
+        due = index.next_due(aware(2021, 5, 31, 10, 0))
+
+        self.assertEqual(due, aware(2021, 6, 7, 10, 0))
+
+    def test_next_due_picks_earliest(self):
+        index = ScheduleIndex(start_times=[(2, time(6, 0)), (1, time(18, 30))])
+
+        due = index.next_due(aware(2021, 5, 31, 9, 55))
+
+        self.assertEqual(due, aware(2021, 6, 1, 18, 30))
+
+    def test_next_due_includes_grass_seed_hours(self):
+        index = ScheduleIndex(start_times=[(2, time(6, 0))], grass_seed_mode=True)
+
+        due = index.next_due(aware(2021, 5, 31, 10, 30))
+
+        self.assertEqual(due, aware(2021, 6, 1, 0, 0))
+
+    def test_next_due_nothing_scheduled(self):
+        self.assertIsNone(ScheduleIndex(start_times=[]).next_due(timezone.now()))
+
+
+class ScheduleIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.device = Device.objects.create(name="device")
+        self.actuator = Actuator.objects.create(
+            name="test", gpio_pin=5, device=self.device
+        )
+
+    def test_load_skips_disabled_and_finished_one_offs(self):
+        ScheduleTime.objects.create(weekday=0, start_time=time(6, 0))
+        ScheduleTime.objects.create(weekday=1, start_time=time(6, 0), enabled=False)
+        queued = ScheduleTime.objects.create(
+            weekday=2, start_time=time(7, 0), run_type=ScheduleTime.RunType.ONE_OFF
+        )
+        finished = ScheduleTime.objects.create(
+            weekday=3, start_time=time(8, 0), run_type=ScheduleTime.RunType.ONE_OFF
+        )
+        ActuatorRunLog.objects.create(
+            actuator=self.actuator,
+            schedule_time=finished,
+            start_datetime=timezone.now(),
+        )
+
+        index = ScheduleIndex.load()
+
+        self.assertCountEqual(
+            index.start_times, [(0, time(6, 0)), (queued.weekday, time(7, 0))]
+        )
+        self.assertFalse(index.grass_seed_mode)
+
+    def test_schedule_changes_bump_version(self):
+        version = get_schedule_version()
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(6, 0))
+        self.assertGreater(get_schedule_version(), version)
+
+        version = get_schedule_version()
+        schedule_time.actuators.add(self.actuator)
+        self.assertGreater(get_schedule_version(), version)
+
+        version = get_schedule_version()
+        self.actuator.grass_seed_mode = True
+        self.actuator.save(update_fields=["grass_seed_mode"])
+        self.assertGreater(get_schedule_version(), version)
+
+    def test_unrelated_actuator_updates_keep_version(self):
+        version = get_schedule_version()
+
+        self.actuator.save(update_fields=["name"])
+
+        self.assertEqual(get_schedule_version(), version)
+
+
+class SchedulerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.scheduler = Scheduler(poll_interval=5)
+        self.scheduler.reload()
+
+    @patch("irrigate.scheduler.time.sleep")
+    def test_wait_until_sleeps_until_due(self, mock_sleep):
+        with freeze_time("2021-05-31 09:59:58") as frozen:
+            mock_sleep.side_effect = lambda seconds: frozen.tick(seconds)
+
+            self.assertTrue(
+                self.scheduler.wait_until(timezone.now() + timedelta(seconds=12))
+            )
+
+        self.assertEqual(
+            [call.args[0] for call in mock_sleep.call_args_list], [5, 5, 2]
+        )
+
+    @patch("irrigate.scheduler.time.sleep")
+    @patch("irrigate.scheduler.run_all_and_report")
+    def test_times_due_during_a_long_pass_run_straight_after(
+        self, mock_run_all_and_report, mock_sleep
+    ):
+        for start_time in (time(6, 0), time(7, 0)):
+            ScheduleTime.objects.create(weekday=0, start_time=start_time)
+        passes = []
+        mock_sleep.side_effect = AssertionError("Slept with a pass due")
+
+        with freeze_time("2021-05-31 06:00") as frozen:
+
+            def run_all_and_report(dry_run):
+                passes.append(timezone.now())
+                if len(passes) == 2:
+                    raise KeyboardInterrupt
+                frozen.tick(timedelta(minutes=90))
+
+            mock_run_all_and_report.side_effect = run_all_and_report
+            with self.assertRaises(KeyboardInterrupt):
+                self.scheduler.run_forever()
+
+        self.assertEqual(passes, [aware(2021, 5, 31, 6, 0), aware(2021, 5, 31, 7, 30)])
+
+    @patch("irrigate.monitor.emit")
+    @patch("irrigate.scheduler.time.sleep")
+    @patch("irrigate.scheduler.run_all_and_report")
+    def test_grass_seed_pass_does_not_wake_itself(
+        self, mock_run_all_and_report, mock_sleep, mock_emit
+    ):
+        device = Device.objects.create(name="device")
+        Actuator.objects.create(
+            name="test", gpio_pin=5, device=device, grass_seed_mode=True
+        )
+        scheduler = Scheduler(dry_run=True, poll_interval=5)
+        passes = []
+        sleeps = []
+
+        with freeze_time("2021-05-31 10:00") as frozen:
+
+            def run_all_and_report(dry_run):
+                passes.append(timezone.now())
+                if len(passes) > 3:
+                    raise KeyboardInterrupt
+                schedule.run_all_and_report(dry_run=dry_run)
+
+            def sleep(seconds):
+                sleeps.append(seconds)
+                if len(sleeps) > 3:
+                    raise KeyboardInterrupt
+                frozen.tick(seconds)
+
+            mock_run_all_and_report.side_effect = run_all_and_report
+            mock_sleep.side_effect = sleep
+            with self.assertRaises(KeyboardInterrupt):
+                scheduler.run_forever()
+
+        self.assertEqual(passes, [aware(2021, 5, 31, 10, 0)])
+        self.assertEqual(sleeps, [5, 5, 5, 5])
+        self.assertEqual(
+            ScheduleTime.objects.filter(run_type=ScheduleTime.RunType.ONE_OFF).count(),
+            1,
+        )
+
+    @patch("irrigate.scheduler.time.sleep")
+    @patch("irrigate.scheduler.run_all_and_report")
+    def test_passes_start_a_poll_interval_apart(
+        self, mock_run_all_and_report, mock_sleep
+    ):
+        with freeze_time("2021-05-31 10:00") as frozen:
+            mock_sleep.side_effect = lambda seconds: frozen.tick(seconds)
+            self.scheduler.run_due()
+            frozen.tick(2)
+            started = self.scheduler.run_due()
+
+        mock_sleep.assert_called_once_with(3)
+        self.assertEqual(started, aware(2021, 5, 31, 10, 0, 5))
+
+    @patch("irrigate.scheduler.time.sleep")
+    def test_wait_until_stops_when_schedule_changes(self, mock_sleep):
+        mock_sleep.side_effect = lambda seconds: bump_schedule_version()
+
+        self.assertFalse(self.scheduler.wait_until(None))
+        mock_sleep.assert_called_once_with(5)
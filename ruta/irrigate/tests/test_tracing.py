@@ -0,0 +1,214 @@
+import asyncio
+import os
+import tempfile
+from datetime import time
+from io import StringIO
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from freezegun import freeze_time
+
+from irrigate import tracing
+from irrigate.models import Actuator, Device, ScheduleTime
+from irrigate.schedule import run_all_and_report
+from irrigate.tests.test_schedule import plan
+
+
+class TracingTestCase(SimpleTestCase):
+    def setUp(self):
+        trace_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(trace_dir.cleanup)
+        self.trace_file = os.path.join(trace_dir.name, "spans.ndjson")
+        settings_override = override_settings(TRACING=True, TRACE_FILE=self.trace_file)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def spans_by_name(self):
+        return {span["name"]: span for span in tracing.read_spans()}
+
+
+class TracingTests(TracingTestCase):
+    def test_spans_need_a_trace(self):
+        with tracing.span("zone") as span:
+            span.set(actuator="front")
+
+        self.assertEqual(tracing.read_spans(), [])
+
+    @override_settings(TRACING=False)
+    def test_tracing_off(self):
+        with tracing.trace("scheduler_pass"):
+            with tracing.span("zone"):
+                pass
+
+        self.assertEqual(tracing.read_spans(), [])
+
+    def test_spans_nest(self):
+        with tracing.trace("scheduler_pass", dry_run=False) as root:
+            with tracing.span("zone", actuator="front"):
+                with self.assertRaises(RuntimeError):
+                    with tracing.span("start"):
+                        raise RuntimeError("stuck")
+            root.set(status="failure")
+
+        spans = self.spans_by_name()
+        self.assertEqual(
+            [span["name"] for span in tracing.read_spans()],
+            ["start", "zone", "scheduler_pass"],
+        )
+        self.assertIsNone(spans["scheduler_pass"]["parent_id"])
+        self.assertEqual(
+            spans["scheduler_pass"]["attributes"],
+            {"dry_run": False, "status": "failure"},
+        )
+        self.assertEqual(spans["zone"]["parent_id"], spans["scheduler_pass"]["span_id"])
+        self.assertEqual(spans["start"]["parent_id"], spans["zone"]["span_id"])
+        self.assertEqual(spans["start"]["error"], "RuntimeError: stuck")
+        self.assertEqual(
+            {span["trace_id"] for span in spans.values()},
+            {spans["scheduler_pass"]["trace_id"]},
+        )
+
+    def test_spans_are_written_as_the_trace_ends(self):
+        with tracing.trace("scheduler_pass"):
+            with tracing.span("zone"):
+                pass
+            self.assertEqual(tracing.read_spans(), [])
+
+        self.assertEqual(
+            [span["name"] for span in tracing.read_spans()], ["zone", "scheduler_pass"]
+        )
+
+    def test_discarded_trace_is_not_written(self):
+        with tracing.trace("scheduler_pass") as root:
+            with tracing.span("zone"):
+                pass
+            root.discard()
+
+        self.assertEqual(tracing.read_spans(), [])
+
+    def test_spans_follow_tasks_and_threads(self):
+        def get_duration():
+            with tracing.span("get_duration"):
+                pass
+
+        async def run_zone(name):
+            with tracing.span(name):
+                await sync_to_async(get_duration)()
+
+        async def run_zones():
+            await asyncio.gather(run_zone("front"), run_zone("back"))
+
+        with tracing.trace("scheduler_pass"):
+            async_to_sync(run_zones)()
+
+        spans = tracing.read_spans()
+        ids = {span["name"]: span["span_id"] for span in spans}
+        parents = sorted(
+            (span["name"], span["parent_id"])
+            for span in spans
+            if span["name"] != "scheduler_pass"
+        )
+        self.assertEqual(
+            parents,
+            sorted(
+                [
+                    ("front", ids["scheduler_pass"]),
+                    ("back", ids["scheduler_pass"]),
+                    ("get_duration", ids["front"]),
+                    ("get_duration", ids["back"]),
+                ]
+            ),
+        )
+
+    def test_rotation(self):
+        exporter = tracing.FileExporter(self.trace_file, max_bytes=600, backups=2)
+        for number in range(12):
+            with tracing.trace("scheduler_pass", exporter=exporter, number=number):
+                pass
+
+        self.assertTrue(os.path.exists(f"{self.trace_file}.2"))
+        self.assertFalse(os.path.exists(f"{self.trace_file}.3"))
+        for path in (self.trace_file, f"{self.trace_file}.1"):
+            self.assertLessEqual(os.path.getsize(path), 600)
+        with override_settings(TRACE_BACKUPS=2):
+            numbers = [span["attributes"]["number"] for span in tracing.read_spans()]
+        # the newest spans survive, oldest first
+        self.assertEqual(numbers, list(range(12 - len(numbers), 12)))
+
+    def test_truncated_lines_are_skipped(self):
+        with tracing.trace("scheduler_pass"):
+            pass
+        with open(self.trace_file, "a") as span_file:
+            span_file.write('{"trace_id": "cut sh')
+
+        self.assertEqual(len(tracing.read_spans()), 1)
+
+
+@patch("irrigate.schedule.asyncio.sleep")
+@patch("irrigate.schedule.plan_durations", side_effect=plan(600))
+class SchedulerTracingTests(TracingTestCase, TestCase):
+    def setUp(self):
+        super().setUp()
+        device = Device.objects.create(name="device")
+        self.actuator = Actuator.objects.create(name="front", gpio_pin=5, device=device)
+        schedule_time = ScheduleTime.objects.create(weekday=0, start_time=time(10, 0))
+        schedule_time.actuators.add(self.actuator)
+
+    @patch("irrigate.monitor.emit")
+    def test_scheduler_pass_is_traced(self, mock_emit, mock_plan_durations, mock_sleep):
+        with freeze_time("2021-05-31 10:01"):
+            run_all_and_report()
+
+        spans = tracing.read_spans()
+        by_name = {span["name"]: span for span in spans}
+        self.assertEqual(
+            by_name["scheduler_pass"]["attributes"],
+            {"dry_run": False, "status": "success", "zones": 1, "errors": 0},
+        )
+        zone = by_name["zone"]
+        self.assertEqual(zone["attributes"]["actuator"], str(self.actuator))
+        self.assertEqual(zone["attributes"]["scheduled_start"], "10:00:00")
+        self.assertEqual(zone["attributes"]["start_lag_seconds"], 60)
+        self.assertEqual(zone["attributes"]["planned_seconds"], 600)
+        self.assertEqual(
+            by_name["run_zones"]["parent_id"], by_name["scheduler_pass"]["span_id"]
+        )
+        zone_children = {
+            span["name"] for span in spans if span["parent_id"] == zone["span_id"]
+        }
+        self.assertEqual(
+            zone_children,
+            {"wait_for_capacity", "get_duration", "start", "water", "stop"},
+        )
+        start = by_name["start"]["span_id"]
+        self.assertIn(
+            "gpio", {span["name"] for span in spans if span["parent_id"] == start}
+        )
+        self.assertIn("db", by_name)
+
+    def test_idle_pass_is_not_traced(self, mock_plan_durations, mock_sleep):
+        with freeze_time("2021-05-31 9:55"):
+            run_all_and_report()
+
+        self.assertEqual(tracing.read_spans(), [])
+
+    @patch("irrigate.monitor.emit")
+    def test_show_traces(self, mock_emit, mock_plan_durations, mock_sleep):
+        with freeze_time("2021-05-31 10:01"):
+            run_all_and_report()
+        out = StringIO()
+
+        call_command("show_traces", stdout=out)
+        listing = out.getvalue()
+        trace_id = tracing.read_spans()[0]["trace_id"]
+        call_command("show_traces", trace_id[:8], "--no-db", stdout=out)
+        timeline = out.getvalue()[len(listing) :]
+
+        self.assertIn(trace_id, listing)
+        self.assertIn("success", listing)
+        self.assertIn(f"scheduler_pass {trace_id}", timeline)
+        self.assertIn("    zone actuator=front", timeline)
+        self.assertIn("start_lag_seconds=60", timeline)
+        self.assertNotIn(" db ", timeline)
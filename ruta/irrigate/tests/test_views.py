@@ -80,11 +80,11 @@ class DashboardTests(TestCase):
             reason="Calculated",
         )
 
-    @patch("irrigate.models.Actuator.get_duration_summary")
+    @patch("irrigate.views.plan_durations")
     def test_dashboard_includes_schedule_queue_and_paginated_runs(
-        self, mock_get_duration_summary
+        self, mock_plan_durations
     ):
-        mock_get_duration_summary.return_value = self.duration_summary()
+        mock_plan_durations.return_value = {self.actuator.id: self.duration_summary()}
         recurring_schedule = ScheduleTime.objects.create(
             run_type=ScheduleTime.RunType.RECURRING,
             weekday=ScheduleTime.Weekday.MONDAY,
@@ -141,12 +141,12 @@ class DashboardTests(TestCase):
 
         self.assertEqual(list(response.context["queued_one_offs"]), [])
 
-    @patch("irrigate.models.Actuator.get_duration_summary")
+    @patch("irrigate.views.plan_durations")
     @freeze_time("2021-05-31 09:55:00+00:00")
     def test_dashboard_includes_browser_timezone_datetime_markup(
-        self, mock_get_duration_summary
+        self, mock_plan_durations
     ):
-        mock_get_duration_summary.return_value = self.duration_summary()
+        mock_plan_durations.return_value = {self.actuator.id: self.duration_summary()}
         recurring_schedule = ScheduleTime.objects.create(
             run_type=ScheduleTime.RunType.RECURRING,
             weekday=ScheduleTime.Weekday.MONDAY,
@@ -172,11 +172,9 @@ class DashboardTests(TestCase):
         self.assertContains(response, 'data-dashboard-format="weekday"')
         self.assertContains(response, 'data-dashboard-format="time"')
 
-    @patch("irrigate.models.Actuator.get_duration_summary")
-    def test_dashboard_includes_calculated_duration_details(
-        self, mock_get_duration_summary
-    ):
-        mock_get_duration_summary.return_value = self.duration_summary()
+    @patch("irrigate.views.plan_durations")
+    def test_dashboard_includes_calculated_duration_details(self, mock_plan_durations):
+        mock_plan_durations.return_value = {self.actuator.id: self.duration_summary()}
         recurring_schedule = ScheduleTime.objects.create(
             run_type=ScheduleTime.RunType.RECURRING,
             weekday=ScheduleTime.Weekday.MONDAY,
@@ -192,7 +190,7 @@ class DashboardTests(TestCase):
             [
                 {
                     "actuator": self.actuator,
-                    "summary": mock_get_duration_summary.return_value,
+                    "summary": mock_plan_durations.return_value[self.actuator.id],
                 }
             ],
         )
@@ -203,10 +201,11 @@ class DashboardTests(TestCase):
         self.assertContains(response, "Forecast 0.10 in")
         self.assertContains(response, "Calculated")
 
-    @patch("irrigate.models.Actuator.get_duration_summary")
+    @patch("irrigate.views.plan_durations")
     def test_dashboard_uses_explicit_recurring_duration_when_set(
-        self, mock_get_duration_summary
+        self, mock_plan_durations
     ):
+        mock_plan_durations.return_value = {}
         recurring_schedule = ScheduleTime.objects.create(
             run_type=ScheduleTime.RunType.RECURRING,
             weekday=ScheduleTime.Weekday.MONDAY,
@@ -217,7 +216,7 @@ class DashboardTests(TestCase):
 
         response = self.client.get(reverse("dashboard"))
 
-        mock_get_duration_summary.assert_not_called()
+        self.assertEqual(list(mock_plan_durations.call_args.args[0]), [])
         self.assertContains(response, "10 min")
         self.assertNotContains(response, "Rain 0.25 in")
 
@@ -0,0 +1,161 @@
+import os
+import tempfile
+import time
+from datetime import timedelta
+from functools import partial
+from unittest.mock import Mock, patch
+
+from django.test import SimpleTestCase, override_settings
+from django.utils import timezone
+
+from irrigate import watchdog
+from irrigate.gpio import (
+    OFF,
+    ON,
+    ChipOutput,
+    ExpanderOutput,
+    GPIOManager,
+    SimulatedChip,
+    arm_shutoff,
+    disarm_shutoff,
+    get_gpio_lock_dir,
+    get_shutoff_time,
+    get_shutoff_token,
+)
+
+
+class WatchdogTests(SimpleTestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.token = os.path.join(cache_dir.name, "run-1")
+        open(self.token, "w").close()
+        self.chip = SimulatedChip()
+
+    def test_shuts_off_pin_and_records_when(self):
+        fired = watchdog.run(
+            self.chip,
+            self.token,
+            at=time.time(),
+            shut_off=partial(watchdog.shut_off_pin, chip=0, pin=5),
+        )
+
+        self.assertTrue(fired)
+        self.assertEqual(self.chip.level(5), OFF)
+        self.assertFalse(self.chip.claimed)
+        with open(self.token) as token_file:
+            self.assertAlmostEqual(float(token_file.read()), time.time(), delta=5)
+
+    def test_shuts_off_only_its_expander_channel(self):
+        handle = self.chip.i2c_open(1, 0x20)
+        self.chip.i2c_write_device(handle, b"\xfa")
+
+        watchdog.run(
+            self.chip,
+            self.token,
+            at=time.time(),
+            shut_off=partial(
+                watchdog.shut_off_channel,
+                bus=1,
+                address=0x20,
+                channels=8,
+                channel=2,
+                lock_dir=os.path.dirname(self.token),
+            ),
+        )
+
+        self.assertEqual(self.chip.i2c_writes[-1].data, b"\xfe")
+
+    def test_does_nothing_once_disarmed(self):
+        os.remove(self.token)
+
+        fired = watchdog.run(
+            self.chip,
+            self.token,
+            at=time.time(),
+            shut_off=partial(watchdog.shut_off_pin, chip=0, pin=5),
+        )
+
+        self.assertFalse(fired)
+        self.assertFalse(self.chip.calls)
+
+    @patch("irrigate.watchdog.RETRY_INTERVAL_IN_SECONDS", 0)
+    def test_retries_while_pin_is_claimed_then_gives_up(self):
+        handle = self.chip.gpiochip_open(0)
+        self.chip.gpio_claim_output(handle, 5, ON)
+
+        fired = watchdog.run(
+            self.chip,
+            self.token,
+            at=time.time(),
+            shut_off=partial(watchdog.shut_off_pin, chip=0, pin=5),
+            retry_for=0.05,
+        )
+
+        self.assertFalse(fired)
+        self.assertGreater(self.chip.calls["gpio_claim_output"], 2)
+        self.assertEqual(self.chip.level(5), ON)
+        self.assertFalse(os.path.exists(self.token))
+
+
+class ArmShutoffTests(SimpleTestCase):
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        settings_override = override_settings(CACHE_DIR=cache_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.manager = GPIOManager(gpio_module=Mock())
+
+    @patch("irrigate.gpio.subprocess.Popen")
+    def test_arm_starts_detached_watchdog(self, popen):
+        at = timezone.now()
+
+        armed = arm_shutoff(ChipOutput(1, manager=self.manager), 5, 42, at)
+
+        self.assertTrue(armed)
+        self.assertTrue(os.path.exists(get_shutoff_token(42)))
+        args = popen.call_args.args[0]
+        self.assertEqual(args[1:3], ["-m", "irrigate.watchdog"])
+        self.assertEqual(args[-3:], ["--gpio", "1", "5"])
+        deadline = float(args[args.index("--at") + 1])
+        self.assertGreater(deadline, at.timestamp())
+        self.assertTrue(popen.call_args.kwargs["start_new_session"])
+
+    @patch("irrigate.gpio.subprocess.Popen")
+    def test_arm_passes_expander_channel(self, popen):
+        output = ExpanderOutput(1, 0x20, channels=16, manager=self.manager)
+
+        arm_shutoff(output, 9, 42, timezone.now())
+
+        args = popen.call_args.args[0]
+        self.assertEqual(args[-5:], ["--i2c", "1", "32", "16", "9"])
+        # the watchdog shares the expander's lock with irrigate.gpio
+        self.assertEqual(args[args.index("--lock-dir") + 1], get_gpio_lock_dir())
+
+    @patch("irrigate.gpio.subprocess.Popen")
+    def test_no_watchdog_for_simulated_chip(self, popen):
+        output = ChipOutput(manager=GPIOManager(gpio_module=SimulatedChip()))
+
+        self.assertFalse(arm_shutoff(output, 5, 42, timezone.now()))
+        popen.assert_not_called()
+        self.assertFalse(os.path.exists(get_shutoff_token(42)))
+
+    @patch("irrigate.gpio.subprocess.Popen")
+    def test_disarm_removes_token(self, popen):
+        arm_shutoff(ChipOutput(manager=self.manager), 5, 42, timezone.now())
+
+        disarm_shutoff([42, 43])
+
+        self.assertFalse(os.path.exists(get_shutoff_token(42)))
+
+    def test_get_shutoff_time(self):
+        token = get_shutoff_token(42)
+        os.makedirs(os.path.dirname(token))
+        open(token, "w").close()
+        self.assertIsNone(get_shutoff_time(42))
+
+        fired_at = timezone.now() - timedelta(minutes=1)
+        watchdog.record_fired(token, fired_at.timestamp())
+
+        self.assertEqual(get_shutoff_time(42), fired_at)
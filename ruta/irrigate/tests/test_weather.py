@@ -1,40 +1,376 @@
+from datetime import date
 from unittest.mock import Mock, patch
 
-from django.test import SimpleTestCase
+import requests
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from freezegun import freeze_time
 
+from irrigate.models import WeatherDay
 from irrigate.weather import (
     REQUEST_TIMEOUT,
-    get_current_weather,
+    WHERE_I_AM,
+    CircuitBreaker,
+    DailyWeather,
+    WeatherSnapshot,
+    WeatherUnavailable,
+    cache,
     get_forecasted_weather,
-    get_historical_weather,
+    fetch_historical_weather,
 )
 
 
+def weather_response(*days):
+    return {
+        "forecast": {
+            "forecastday": [
+                {
+                    "date": day,
+                    "day": {"totalprecip_in": precip, "maxtemp_f": maxtemp},
+                }
+                for day, precip, maxtemp in days
+            ]
+        }
+    }
+
+
+def daily_weather(*days):
+    return tuple(
+        DailyWeather(date.fromisoformat(day), precip, maxtemp)
+        for day, precip, maxtemp in days
+    )
+
+
+@freeze_time("2021-05-31 10:00:00+00:00")
 class WeatherTests(SimpleTestCase):
     def setUp(self):
+        cache.clear()
         self.response = Mock()
-        self.response.json.return_value = {"weather": "data"}
+        self.response.json.return_value = weather_response(("2021-05-31", 0.1, 70))
 
     @patch("irrigate.weather.requests.get")
-    def test_current_weather_uses_request_timeout(self, mock_get):
+    def test_forecasted_weather_uses_request_timeout(self, mock_get):
         mock_get.return_value = self.response
 
-        get_current_weather()
+        get_forecasted_weather()
 
         self.assertEqual(mock_get.call_args.kwargs["timeout"], REQUEST_TIMEOUT)
 
     @patch("irrigate.weather.requests.get")
-    def test_forecasted_weather_uses_request_timeout(self, mock_get):
+    def test_historical_weather_uses_request_timeout(self, mock_get):
         mock_get.return_value = self.response
 
-        get_forecasted_weather()
+        fetch_historical_weather(
+            location=WHERE_I_AM,
+            start_date=date(2021, 5, 28),
+            end_date=date(2021, 5, 31),
+        )
 
         self.assertEqual(mock_get.call_args.kwargs["timeout"], REQUEST_TIMEOUT)
 
     @patch("irrigate.weather.requests.get")
-    def test_historical_weather_uses_request_timeout(self, mock_get):
+    def test_cache_key_ignores_how_defaults_are_passed(self, mock_get):
         mock_get.return_value = self.response
 
-        get_historical_weather()
+        get_forecasted_weather()
+        get_forecasted_weather(WHERE_I_AM, days=3)
+        data = get_forecasted_weather(location=WHERE_I_AM, days=3)
 
-        self.assertEqual(mock_get.call_args.kwargs["timeout"], REQUEST_TIMEOUT)
+        self.assertEqual(data, daily_weather(("2021-05-31", 0.1, 70)))
+        mock_get.assert_called_once()
+
+    @patch("irrigate.weather.requests.get")
+    def test_forecasts_share_the_widest_fetch(self, mock_get):
+        self.response.json.return_value = weather_response(
+            ("2021-05-31", 0.1, 70),
+            ("2021-06-01", 0.2, 70),
+            ("2021-06-02", 0.3, 70),
+        )
+        mock_get.return_value = self.response
+
+        one_day = get_forecasted_weather(days=1)
+        three_days = get_forecasted_weather(days=3)
+
+        mock_get.assert_called_once()
+        self.assertEqual(mock_get.call_args.kwargs["params"]["days"], 3)
+        self.assertEqual(one_day, three_days[:1])
+        self.assertEqual(len(three_days), 3)
+
+    @patch("irrigate.weather.requests.get")
+    def test_cache_is_per_location(self, mock_get):
+        mock_get.return_value = self.response
+
+        get_forecasted_weather(location="Ann Arbor")
+        get_forecasted_weather(location="Detroit")
+
+        self.assertEqual(mock_get.call_count, 2)
+
+
+def run_immediately(target, **kwargs):
+    return Mock(start=target)
+
+
+class StaleWhileRevalidateTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.response = Mock()
+        self.response.json.return_value = weather_response(("2021-05-31", 0.1, 70))
+        self.old = daily_weather(("2021-05-31", 0.1, 70))
+
+    @patch("irrigate.weather.threading.Thread", side_effect=run_immediately)
+    @patch("irrigate.weather.requests.get")
+    def test_stale_entry_is_served_and_refreshed(self, mock_get, mock_thread):
+        mock_get.return_value = self.response
+        with freeze_time("2021-05-31 10:00:00"):
+            get_forecasted_weather()
+
+        self.response.json.return_value = weather_response(("2021-05-31", 0.5, 70))
+        with freeze_time("2021-05-31 11:30:00"):
+            data = get_forecasted_weather()
+            refreshed = get_forecasted_weather()
+
+        self.assertEqual(data, self.old)
+        self.assertEqual(refreshed, daily_weather(("2021-05-31", 0.5, 70)))
+        self.assertEqual(mock_get.call_count, 2)
+
+    @patch("irrigate.weather.threading.Thread", side_effect=run_immediately)
+    @patch("irrigate.weather.requests.get")
+    def test_stale_entry_is_kept_when_refresh_fails(self, mock_get, mock_thread):
+        mock_get.return_value = self.response
+        with freeze_time("2021-05-31 10:00:00"):
+            get_forecasted_weather()
+
+        mock_get.side_effect = requests.Timeout("timed out")
+        with freeze_time("2021-05-31 11:30:00"):
+            data = get_forecasted_weather()
+            again = get_forecasted_weather()
+
+        self.assertEqual(data, self.old)
+        self.assertEqual(again, self.old)
+
+    @patch("irrigate.weather.threading.Thread", side_effect=run_immediately)
+    @patch("irrigate.weather.requests.get")
+    def test_past_days_are_dropped_from_a_stale_entry(self, mock_get, mock_thread):
+        self.response.json.return_value = weather_response(
+            ("2021-05-31", 0.1, 70), ("2021-06-01", 0.2, 80)
+        )
+        mock_get.return_value = self.response
+        with freeze_time("2021-05-31 10:00:00"):
+            get_forecasted_weather()
+
+        mock_get.side_effect = requests.Timeout("timed out")
+        with freeze_time("2021-06-01 10:00:00"):
+            data = get_forecasted_weather(days=1)
+
+        self.assertEqual(data, daily_weather(("2021-06-01", 0.2, 80)))
+
+    @patch("irrigate.weather.threading.Thread", side_effect=run_immediately)
+    @patch("irrigate.weather.requests.get")
+    def test_past_days_are_dropped_from_the_widest_window(self, mock_get, mock_thread):
+        self.response.json.return_value = weather_response(
+            ("2021-05-31", 0.1, 70), ("2021-06-01", 0.2, 80), ("2021-06-02", 0.3, 90)
+        )
+        mock_get.return_value = self.response
+        with freeze_time("2021-06-01 03:50:00"):
+            get_forecasted_weather(days=3)
+
+        # a little after midnight at the location, and still fresh
+        with freeze_time("2021-06-01 04:10:00"):
+            data = get_forecasted_weather(days=3)
+
+        mock_get.assert_called_once()
+        self.assertEqual(
+            data, daily_weather(("2021-06-01", 0.2, 80), ("2021-06-02", 0.3, 90))
+        )
+
+    @patch("irrigate.weather.threading.Thread", side_effect=run_immediately)
+    @patch("irrigate.weather.requests.get")
+    def test_entry_without_today_is_a_miss(self, mock_get, mock_thread):
+        mock_get.return_value = self.response
+        with freeze_time("2021-05-31 10:00:00"):
+            get_forecasted_weather()
+
+        mock_get.side_effect = requests.Timeout("timed out")
+        with freeze_time("2021-06-01 10:00:00"):
+            with self.assertRaises(WeatherUnavailable):
+                get_forecasted_weather()
+
+        mock_get.side_effect = None
+        self.response.json.return_value = weather_response(("2021-06-01", 0.3, 75))
+        with freeze_time("2021-06-01 10:00:00"):
+            data = get_forecasted_weather()
+
+        self.assertEqual(data, daily_weather(("2021-06-01", 0.3, 75)))
+
+    @patch("irrigate.weather.requests.get")
+    def test_unexpected_response_is_a_failure(self, mock_get):
+        self.response.json.return_value = {"error": {"message": "bad key"}}
+        mock_get.return_value = self.response
+
+        with self.assertRaises(WeatherUnavailable):
+            get_forecasted_weather()
+
+    @patch("irrigate.weather.requests.get")
+    def test_raises_when_nothing_is_cached(self, mock_get):
+        mock_get.side_effect = requests.ConnectionError("down")
+
+        with self.assertRaises(WeatherUnavailable):
+            get_forecasted_weather()
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker("test", failure_threshold=2, cooldown=60)
+        self.func = Mock(side_effect=requests.Timeout("timed out"), __name__="func")
+        self.guarded = self.breaker.guard(self.func)
+
+    def test_opens_after_repeated_failures(self):
+        for _ in range(2):
+            with self.assertRaises(WeatherUnavailable):
+                self.guarded()
+        with self.assertRaises(WeatherUnavailable):
+            self.guarded()
+
+        self.assertEqual(self.func.call_count, 2)
+        self.assertTrue(self.breaker.is_open())
+
+    def test_trial_call_after_cooldown(self):
+        with freeze_time("2021-05-31 10:00:00"):
+            for _ in range(2):
+                with self.assertRaises(WeatherUnavailable):
+                    self.guarded()
+
+        self.func.side_effect = None
+        self.func.return_value = "data"
+        with freeze_time("2021-05-31 10:01:01"):
+            self.assertEqual(self.guarded(), "data")
+            self.assertFalse(self.breaker.is_open())
+
+    def test_one_failure_reopens_after_cooldown(self):
+        with freeze_time("2021-05-31 10:00:00"):
+            for _ in range(2):
+                with self.assertRaises(WeatherUnavailable):
+                    self.guarded()
+
+        with freeze_time("2021-05-31 10:01:01"):
+            with self.assertRaises(WeatherUnavailable):
+                self.guarded()
+            self.assertTrue(self.breaker.is_open())
+
+
+@freeze_time("2021-05-31 10:00:00+00:00")
+class WeatherSnapshotTests(SimpleTestCase):
+    def setUp(self):
+        self.forecast = daily_weather(
+            ("2021-05-31", 0.5, 88),
+            ("2021-06-01", 1, 70),
+            ("2021-06-02", 1, 70),
+        )
+
+    @patch("irrigate.weather.get_forecasted_weather")
+    def test_slices_forecast_window(self, mock_get_forecasted_weather):
+        mock_get_forecasted_weather.return_value = self.forecast
+        snapshot = WeatherSnapshot()
+
+        self.assertEqual(snapshot.get_forecasted_precipitation_in_inches(days=1), 0.5)
+        self.assertAlmostEqual(
+            snapshot.get_forecasted_precipitation_in_inches(days=2), 0.5 + 0.9
+        )
+        self.assertEqual(snapshot.get_todays_high_temperature(), 88)
+        mock_get_forecasted_weather.assert_called_once_with(
+            location=snapshot.location, days=3
+        )
+
+    @patch("irrigate.weather.get_forecasted_weather")
+    def test_past_days_are_not_forecast(self, mock_get_forecasted_weather):
+        mock_get_forecasted_weather.return_value = daily_weather(
+            ("2021-05-30", 2, 95), ("2021-06-01", 1, 70)
+        )
+        snapshot = WeatherSnapshot()
+
+        self.assertEqual(snapshot.get_forecasted_precipitation_in_inches(days=2), 1)
+        self.assertIsNone(snapshot.get_todays_high_temperature())
+
+    @patch("irrigate.weather.get_forecasted_weather")
+    def test_no_forecast_when_weather_unavailable(self, mock_get_forecasted_weather):
+        mock_get_forecasted_weather.side_effect = WeatherUnavailable("down")
+        snapshot = WeatherSnapshot()
+
+        self.assertEqual(snapshot.get_forecasted_precipitation_in_inches(days=2), 0)
+        self.assertIsNone(snapshot.get_todays_high_temperature())
+
+    @patch("irrigate.weather.get_forecasted_weather")
+    @patch("irrigate.models.fetch_historical_weather")
+    def test_does_not_fetch_until_needed(
+        self, mock_fetch_historical_weather, mock_get_forecasted_weather
+    ):
+        WeatherSnapshot()
+
+        mock_fetch_historical_weather.assert_not_called()
+        mock_get_forecasted_weather.assert_not_called()
+
+    def test_rejects_windows_wider_than_snapshot(self):
+        snapshot = WeatherSnapshot(history_days=3, forecast_days=2)
+
+        with self.assertRaises(ValueError):
+            snapshot.get_precipitation_in_inches(days_ago=7)
+        with self.assertRaises(ValueError):
+            snapshot.get_forecasted_precipitation_in_inches(days=3)
+
+
+@freeze_time("2021-05-31 10:00:00+00:00")
+class WeatherSnapshotHistoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def store_history(self, *days):
+        for day in days:
+            WeatherDay.objects.create(
+                location=WHERE_I_AM,
+                date=date.fromisoformat(day),
+                totalprecip_in=0.1,
+                maxtemp_f=70,
+                fetched_at=timezone.now(),
+            )
+
+    @patch("irrigate.weather.connections")
+    @patch("irrigate.weather.threading.Thread", side_effect=run_immediately)
+    @patch("irrigate.models.fetch_historical_weather")
+    def test_slices_history_window(
+        self, mock_fetch_historical_weather, mock_thread, mock_connections
+    ):
+        mock_fetch_historical_weather.return_value = daily_weather(
+            *[(f"2021-05-{day}", 0.1, 70) for day in range(24, 32)]
+        )
+        snapshot = WeatherSnapshot()
+
+        self.assertAlmostEqual(snapshot.get_precipitation_in_inches(days_ago=1), 0.2)
+        self.assertAlmostEqual(snapshot.get_precipitation_in_inches(days_ago=3), 0.4)
+        self.assertAlmostEqual(snapshot.get_precipitation_in_inches(days_ago=7), 0.8)
+        mock_fetch_historical_weather.assert_called_once()
+        mock_connections.close_all.assert_called_once()
+
+    @patch("irrigate.weather.threading.Thread")
+    @patch("irrigate.models.fetch_historical_weather")
+    def test_missing_history_is_fetched_in_the_background(
+        self, mock_fetch_historical_weather, mock_thread
+    ):
+        self.store_history("2021-05-30")
+
+        precipitation = WeatherSnapshot().get_precipitation_in_inches(days_ago=3)
+        WeatherSnapshot().get_precipitation_in_inches(days_ago=3)
+
+        self.assertEqual(precipitation, 0.1)
+        mock_fetch_historical_weather.assert_not_called()
+        # the first refresh still holds the lock
+        mock_thread.assert_called_once()
+        mock_thread.return_value.start.assert_called_once()
+
+    @patch("irrigate.weather.threading.Thread")
+    def test_up_to_date_history_is_not_refreshed(self, mock_thread):
+        self.store_history(*[f"2021-05-{day}" for day in range(24, 32)])
+
+        WeatherSnapshot().get_precipitation_in_inches(days_ago=7)
+
+        mock_thread.assert_not_called()
@@ -0,0 +1,237 @@
+"""
+Spans around the stages of a scheduler pass, saved as lines of JSON.
+
+A pass starts a trace with `trace`. Inside it, `span` times a stage as a
+child of whichever span is current. The current span lives in a context
+variable, so asyncio tasks and `sync_to_async` calls carry it with them.
+Outside a trace `span` does nothing, so web requests and background
+threads aren't traced. Every database query in a trace gets a span of its
+own. Finished spans are held until the trace ends and then written out
+together, unless the trace was discarded.
+
+`manage.py show_traces` reads the spans back and draws a pass as a
+timeline.
+"""
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# queries are cut short in their span to keep the file small
+SQL_KEPT = 200
+
+_current: ContextVar[Optional["Span"]] = ContextVar("span", default=None)
+
+
+class FileExporter:
+    """
+    Appends traces to `path`, one JSON object per span per line. Once the
+    file would grow past `max_bytes` it is moved to `path`.1, that to
+    `path`.2 and so on, keeping `backups` old files.
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def export(self, spans: List["Span"]):
+        lines = "".join(
+            json.dumps(span.to_json(), default=str) + "\n" for span in spans
+        )
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # the scheduler and cron runs may share the file
+            with open(f"{self.path}.lock", "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                if self._size() + len(lines) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, "a") as span_file:
+                    span_file.write(lines)
+        except OSError as e:
+            logger.warning(f"Unable to export {len(spans)} span(s): {e}")
+
+    def _size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def _rotate(self):
+        if not os.path.exists(self.path):
+            return
+        if not self.backups:
+            os.remove(self.path)
+            return
+        for number in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{number}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{number + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+
+def get_exporter() -> FileExporter:
+    return FileExporter(
+        settings.TRACE_FILE, settings.TRACE_MAX_BYTES, settings.TRACE_BACKUPS
+    )
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    # every finished span of the trace, shared by all of its spans
+    finished: List["Span"] = field(default_factory=list, repr=False)
+    parent_id: Optional[str] = None
+    span_id: str = field(default_factory=lambda: uuid.uuid4().hex[:16])
+    # wall clock for lining spans up, monotonic for timing them
+    start: float = field(default_factory=time.time)
+    attributes: Dict[str, object] = field(default_factory=dict)
+    duration: Optional[float] = None
+    error: Optional[str] = None
+    discarded: bool = field(default=False, repr=False)
+    _started: float = field(default_factory=time.perf_counter, repr=False)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def discard(self):
+        """
+        Leave this span's trace out of the file. Only the root's counts.
+        """
+        self.discarded = True
+
+    def child(self, name: str, **attributes) -> "Span":
+        return Span(
+            name=name,
+            trace_id=self.trace_id,
+            finished=self.finished,
+            parent_id=self.span_id,
+            attributes=attributes,
+        )
+
+    def to_json(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """
+    Stands in for a span when nothing is being traced.
+    """
+
+    def set(self, **attributes):
+        pass
+
+    def discard(self):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+@contextmanager
+def _activate(span: Span):
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        span.duration = time.perf_counter() - span._started
+        _current.reset(token)
+        span.finished.append(span)
+
+
+def _query_span(execute, sql, params, many, context):
+    with span("db", sql=sql[:SQL_KEPT]):
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def trace(name: str, exporter: Optional[FileExporter] = None, **attributes):
+    """
+    Start a trace with a root span called `name`, if TRACING is on. Its
+    spans are exported in one go as it ends.
+    """
+    if not settings.TRACING:
+        yield NOOP_SPAN
+        return
+    exporter = exporter or get_exporter()
+    root = Span(name=name, trace_id=uuid.uuid4().hex, attributes=attributes)
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(_query_span))
+            yield stack.enter_context(_activate(root))
+    finally:
+        if not root.discarded:
+            exporter.export(root.finished)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time the block as a child of the current span, if there is one.
+    """
+    parent = _current.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    with _activate(parent.child(name, **attributes)) as child:
+        yield child
+
+
+def read_spans(path: Optional[str] = None) -> List[dict]:
+    """
+    Every exported span, oldest file first. Lines that don't parse, such as
+    one cut short by a crash, are skipped.
+    """
+    path = path or settings.TRACE_FILE
+    paths = [f"{path}.{number}" for number in range(settings.TRACE_BACKUPS, 0, -1)]
+    spans = []
+    for span_path in paths + [path]:
+        try:
+            with open(span_path) as span_file:
+                lines = span_file.readlines()
+        except FileNotFoundError:
+            continue
+        for line in lines:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:
+                continue
+    return spans
+
+
+def group_traces(spans: List[dict]) -> Dict[str, List[dict]]:
+    """
+    Spans by trace, each trace's spans in the order they started.
+    """
+    traces = defaultdict(list)
+    for exported in spans:
+        traces[exported["trace_id"]].append(exported)
+    for trace_spans in traces.values():
+        trace_spans.sort(key=lambda exported: exported["start"])
+    return traces
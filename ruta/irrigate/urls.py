@@ -10,4 +10,5 @@ urlpatterns = [
         name="grass_seed_mode_toggle",
     ),
     path("runs/one-off/", views.OneOffRunView.as_view(), name="one_off_run"),
+    path("metrics", views.MetricsView.as_view(), name="metrics"),
 ]
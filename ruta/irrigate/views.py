@@ -1,21 +1,38 @@
+import hmac
 from datetime import datetime, timedelta
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db.models import Exists, OuterRef
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.utils import timezone
 from django.views import generic
 
+from irrigate import metrics, profiling
 from irrigate.forms import OneOffRunForm
-from irrigate.models import Actuator, ActuatorRunLog, ScheduleTime
+from irrigate.models import Actuator, ActuatorRunLog, ScheduleTime, plan_durations
 from irrigate.schedule import GRASS_SEED_DURATION_SECONDS, GRASS_SEED_RUN_HOURS
 
+DASHBOARD_SECONDS = metrics.REGISTRY.histogram(
+    "ruta_dashboard_seconds", "Time taken to build and render the dashboard"
+)
+
 
 class DashboardView(LoginRequiredMixin, generic.ListView):
     template_name = "irrigate/dashboard.html"
     context_object_name = "runs"
     paginate_by = 25
 
+    def get(self, request, *args, **kwargs):
+        with DASHBOARD_SECONDS.time():
+            response = super().get(request, *args, **kwargs)
+            with profiling.timed("template"):
+                response.render()
+        metrics.REGISTRY.maybe_write_snapshot()
+        return response
+
     def get_queryset(self):
         return ActuatorRunLog.objects.select_related("actuator", "schedule_time")
 
@@ -24,16 +41,16 @@ class DashboardView(LoginRequiredMixin, generic.ListView):
         running_runs = ActuatorRunLog.objects.select_related(
             "actuator", "schedule_time"
         ).filter(end_datetime__isnull=True)
-        completed_schedule_ids = ActuatorRunLog.objects.filter(
-            schedule_time_id__isnull=False
-        ).values("schedule_time_id")
+        # NOT EXISTS probes the schedule_time index per one-off, where NOT IN
+        # would read every run log with a schedule time
+        has_run = ActuatorRunLog.objects.filter(schedule_time=OuterRef("pk"))
         queued_one_offs = list(
             ScheduleTime.objects.prefetch_related("actuators")
             .filter(
+                ~Exists(has_run),
                 enabled=True,
                 run_type=ScheduleTime.RunType.ONE_OFF,
             )
-            .exclude(id__in=completed_schedule_ids)
             .order_by("-id")
         )
         recurring_schedules = list(
@@ -58,23 +75,22 @@ class DashboardView(LoginRequiredMixin, generic.ListView):
                 future=True,
             )
         actuators = list(Actuator.objects.select_related("device").order_by("name"))
-        duration_summaries = {}
+        duration_summaries = plan_durations(
+            actuator
+            for schedule_time in recurring_schedules
+            if not schedule_time.duration_in_minutes
+            for actuator in schedule_time.actuators.all()
+        )
         for schedule_time in recurring_schedules:
-            schedule_time.duration_details = []
-            for actuator in schedule_time.actuators.all():
-                summary = None
-                if not schedule_time.duration_in_minutes:
-                    if actuator.id not in duration_summaries:
-                        duration_summaries[
-                            actuator.id
-                        ] = actuator.get_duration_summary()
-                    summary = duration_summaries[actuator.id]
-                schedule_time.duration_details.append(
-                    {
-                        "actuator": actuator,
-                        "summary": summary,
-                    }
-                )
+            schedule_time.duration_details = [
+                {
+                    "actuator": actuator,
+                    "summary": duration_summaries.get(actuator.id)
+                    if not schedule_time.duration_in_minutes
+                    else None,
+                }
+                for actuator in schedule_time.actuators.all()
+            ]
 
         context.update(
             {
@@ -138,6 +154,37 @@ class DashboardView(LoginRequiredMixin, generic.ListView):
         )
 
 
+class MetricsView(generic.View):
+    """
+    Every process's metrics in the Prometheus text format.
+
+    Open to staff users, and to scrapers sending METRICS_TOKEN as a bearer
+    token.
+    """
+
+    http_method_names = ["get"]
+
+    def has_access(self, request):
+        if request.user.is_authenticated and request.user.is_staff:
+            return True
+        token = settings.METRICS_TOKEN
+        authorization = request.headers.get("Authorization", "")
+        return bool(token) and hmac.compare_digest(
+            authorization.encode(), f"Bearer {token}".encode()
+        )
+
+    def get(self, request, *args, **kwargs):
+        if not self.has_access(request):
+            response = HttpResponse("Unauthorized", status=401)
+            response["WWW-Authenticate"] = "Bearer"
+            return response
+        metrics.REGISTRY.write_snapshot()
+        return HttpResponse(
+            metrics.render(metrics.collect()),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+
 class OneOffRunView(LoginRequiredMixin, generic.View):
     http_method_names = ["post"]
 
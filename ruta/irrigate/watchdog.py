@@ -0,0 +1,161 @@
+"""
+Shuts a valve off at a deadline from its own small process, so a run that
+outlives the process that started it still ends.
+
+`arm_shutoff` in irrigate.gpio starts one of these per timed run. It sleeps
+until the deadline, and if the run's token file is still there it drives the
+valve off and writes the time it did so into the token file for the run log
+to be reconciled with. Stopping the run normally deletes the token, and the
+watchdog exits without touching the valve.
+
+This module must not import Django, to keep each watchdog a bare Python
+process of a few megabytes.
+"""
+import argparse
+import fcntl
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+from functools import partial
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# relays are active low, matching irrigate.gpio
+OFF = 1
+
+RETRY_INTERVAL_IN_SECONDS = 5
+
+
+def record_fired(token: str, fired_at: float):
+    tmp = f"{token}.tmp"
+    with open(tmp, "w") as token_file:
+        token_file.write(str(fired_at))
+    os.replace(tmp, token)
+
+
+def shut_off_pin(gpio, chip: int, pin: int):
+    """
+    Claim `pin` at the off level and let it go again. Fails while another
+    process still has the pin claimed.
+    """
+    handle = gpio.gpiochip_open(chip)
+    try:
+        gpio.gpio_claim_output(handle, pin, OFF)
+        gpio.gpio_free(handle, pin)
+    finally:
+        gpio.gpiochip_close(handle)
+
+
+@contextmanager
+def expander_lock(lock_dir: Optional[str], bus: int, address: int):
+    """
+    Hold the lock on one relay expander across every process on the device.
+
+    An expander's port is read, changed and written back whole, so two
+    processes doing so at once would undo each other's channels. Without
+    `lock_dir` nothing is locked.
+    """
+    if lock_dir is None:
+        yield
+        return
+    os.makedirs(lock_dir, exist_ok=True)
+    path = os.path.join(lock_dir, f"i2c-{bus}-{address}.lock")
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def shut_off_channel(
+    gpio,
+    bus: int,
+    address: int,
+    channels: int,
+    channel: int,
+    lock_dir: Optional[str] = None,
+):
+    """
+    Turn one expander channel off, leaving the rest of the port as it is.
+    """
+    with expander_lock(lock_dir, bus, address):
+        handle = gpio.i2c_open(bus, address)
+        try:
+            _, data = gpio.i2c_read_device(handle, channels // 8)
+            port = int.from_bytes(bytes(data), "little") | (1 << channel)
+            gpio.i2c_write_device(handle, port.to_bytes(channels // 8, "little"))
+        finally:
+            gpio.i2c_close(handle)
+
+
+def run(gpio, token: str, at: float, shut_off, retry_for: float = 600) -> bool:
+    """
+    Wait until `at` then call `shut_off(gpio)` if `token` still exists.
+
+    A pin another process is writing at that moment can't be claimed, so
+    failures are retried for `retry_for` seconds. The token is
+    removed on giving up. Returns whether the valve was shut off.
+    """
+    time.sleep(max(0, at - time.time()))
+    give_up_at = time.time() + retry_for
+    while os.path.exists(token):
+        try:
+            shut_off(gpio)
+        except Exception as e:
+            if time.time() >= give_up_at:
+                logger.error(f"Giving up shutting off {token}: {e}")
+                os.remove(token)
+                return False
+            time.sleep(RETRY_INTERVAL_IN_SECONDS)
+            continue
+        record_fired(token, time.time())
+        logger.warning(f"Shut off {token} after its run outlived its process")
+        return True
+    return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--token", required=True, help="Token file for the run")
+    parser.add_argument(
+        "--at", type=float, required=True, help="Unix time to shut off at"
+    )
+    parser.add_argument("--retry-for", type=float, default=600)
+    parser.add_argument(
+        "--lock-dir", help="Where the locks shared with irrigate.gpio are kept"
+    )
+    output = parser.add_mutually_exclusive_group(required=True)
+    output.add_argument("--gpio", nargs=2, type=int, metavar=("CHIP", "PIN"))
+    output.add_argument(
+        "--i2c",
+        nargs=4,
+        type=int,
+        metavar=("BUS", "ADDRESS", "CHANNELS", "CHANNEL"),
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    import lgpio
+
+    if args.gpio:
+        chip, pin = args.gpio
+        shut_off = partial(shut_off_pin, chip=chip, pin=pin)
+    else:
+        bus, address, channels, channel = args.i2c
+        shut_off = partial(
+            shut_off_channel,
+            bus=bus,
+            address=address,
+            channels=channels,
+            channel=channel,
+            lock_dir=args.lock_dir,
+        )
+    run(lgpio, args.token, args.at, shut_off, retry_for=args.retry_for)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
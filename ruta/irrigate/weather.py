@@ -1,52 +1,422 @@
+import inspect
+import logging
+import random
 import requests
-from datetime import timedelta
+import threading
+import time
+from datetime import date, datetime, timedelta
+from functools import cached_property, wraps
+from typing import NamedTuple, Optional, Tuple
+from urllib.parse import urlencode
+from zoneinfo import ZoneInfo
 
-from django.core.cache import cache
+from django.core.cache import caches
 from django.conf import settings
+from django.db import connections, models
 from django.utils import timezone
 
+from irrigate import profiling, tracing
+from irrigate.metrics import REGISTRY
+
 BASE_URL = "http://api.weatherapi.com/v1"
 key = settings.WEATHER_API_KEY
 WHERE_I_AM = settings.DEFAULT_WEATHER_LOCATION
 REQUEST_TIMEOUT = (5, 15)
 
+logger = logging.getLogger(__name__)
 
-def cache_response(func):
-    def wrapper(*args, **kwargs):
-        kwargs_hash = hash(frozenset(kwargs.items()))
-        key = f"{func.__name__}-{args}-{kwargs_hash}-{timezone.now().date()}"
-        if cache.get(key):
-            return cache.get(key)
-        data = func(*args, **kwargs)
-        cache.set(key, data, timeout=60 * 60)
-        return data
+# widest windows any caller asks for. narrower windows are sliced out of these
+HISTORY_WINDOW_IN_DAYS = 7
+FORECAST_WINDOW_IN_DAYS = 3
 
-    return wrapper
 
+# how long forecasts stay fresh, in seconds
+FORECAST_TIMEOUT = 60 * 60
+# stale responses are kept this long to fall back on while the API is down
+STALE_TIMEOUT = 7 * 24 * 60 * 60
+# fraction of a timeout randomly shaved off so entries don't expire together
+TIMEOUT_JITTER = 0.1
+# upper bound on a background refresh, so a crashed one doesn't block the next
+REFRESH_LOCK_TIMEOUT = 60
 
-def get_current_weather(location=WHERE_I_AM):
-    return requests.get(
-        f"{BASE_URL}/current.json",
-        params={"q": location, "key": key},
-        timeout=REQUEST_TIMEOUT,
-    ).json()
+cache = caches["weather"]
+
+WEATHER_FETCH_SECONDS = REGISTRY.histogram(
+    "ruta_weather_fetch_seconds",
+    "Time taken by weather API calls, by endpoint and result",
+    ["endpoint", "result"],
+)
+WEATHER_CACHE_REQUESTS = REGISTRY.counter(
+    "ruta_weather_cache_requests_total",
+    "Cached weather lookups, by whether they were a fresh hit, stale or a miss",
+    ["endpoint", "result"],
+)
+
+
+def get_local_date(moment: Optional[datetime] = None) -> date:
+    """
+    The date at the weather location at `moment`, or now. weatherapi dates
+    days by the location's clock, not the server's.
+    """
+    return timezone.localtime(
+        moment, timezone=ZoneInfo(settings.WEATHER_TIME_ZONE)
+    ).date()
+
+
+class WeatherUnavailable(Exception):
+    """
+    Raised when weather can't be fetched and there is nothing cached.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stop calling a failing service for a while.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls
+    fail straight away for `cooldown` seconds. The next call after that is a
+    trial, and a single failure opens the circuit again. State lives in the
+    shared cache so every process backs off together.
+    """
+
+    def __init__(self, name, failure_threshold=3, cooldown=5 * 60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+    @property
+    def failures_key(self):
+        return f"circuit:{self.name}:failures"
+
+    @property
+    def open_until_key(self):
+        return f"circuit:{self.name}:open_until"
+
+    def is_open(self):
+        return cache.get(self.open_until_key, 0) > time.time()
+
+    def record_success(self):
+        if cache.get(self.failures_key):
+            cache.delete_many([self.failures_key, self.open_until_key])
+
+    def record_failure(self):
+        failures = cache.get(self.failures_key, 0) + 1
+        cache.set(self.failures_key, failures, timeout=None)
+        if failures >= self.failure_threshold:
+            logger.warning(
+                f"Opening {self.name} circuit for {self.cooldown} second(s) after {failures} failure(s)"
+            )
+            cache.set(
+                self.open_until_key, time.time() + self.cooldown, timeout=self.cooldown
+            )
+
+    def guard(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if self.is_open():
+                WEATHER_FETCH_SECONDS.labels(
+                    endpoint=func.__name__, result="circuit open"
+                ).observe(0)
+                raise WeatherUnavailable(f"{self.name} circuit is open")
+            started = time.perf_counter()
+            try:
+                with tracing.span("weather", endpoint=func.__name__):
+                    data = func(*args, **kwargs)
+            except (requests.RequestException, ValueError) as e:
+                seconds = time.perf_counter() - started
+                profiling.record("weather", seconds)
+                WEATHER_FETCH_SECONDS.labels(
+                    endpoint=func.__name__, result="error"
+                ).observe(seconds)
+                self.record_failure()
+                raise WeatherUnavailable(f"{func.__name__} failed: {e}") from e
+            seconds = time.perf_counter() - started
+            profiling.record("weather", seconds)
+            WEATHER_FETCH_SECONDS.labels(endpoint=func.__name__, result="ok").observe(
+                seconds
+            )
+            self.record_success()
+            return data
+
+        return wrapper
+
+
+breaker = CircuitBreaker("weatherapi")
+
+
+def get_cache_key(func, arguments):
+    """
+    Build a key that is the same in every process for the same call.
+    """
+    params = urlencode(sorted(arguments.items()))
+    return f"{func.__name__}:{params}"
+
+
+def _fetch_and_cache(key, timeout, func, *args, **kwargs):
+    data = func(*args, **kwargs)
+    fresh_until = time.time() + timeout * (1 - random.uniform(0, TIMEOUT_JITTER))
+    cache.set(key, (fresh_until, data), timeout=STALE_TIMEOUT)
+    return data
+
+
+def _refresh_in_background(key, refresh_func, *args, **kwargs):
+    """
+    Refresh what is stored under `key` with `refresh_func(*args, **kwargs)`
+    without making the caller wait.
+
+    Only one refresh per key runs at a time across all processes.
+    """
+    lock_key = f"{key}:refreshing"
+    if not cache.add(lock_key, True, timeout=REFRESH_LOCK_TIMEOUT):
+        return None
+
+    def refresh():
+        try:
+            refresh_func(*args, **kwargs)
+        except WeatherUnavailable as e:
+            logger.warning(f"Unable to refresh {key}, keeping stale copy: {e}")
+        finally:
+            cache.delete(lock_key)
+
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    return thread
+
+
+def cache_response(timeout, widest=None, narrow=None, usable=None):
+    """
+    Cache a weather call, serving stale data while it is refreshed.
+
+    Fresh entries are returned as is. Stale entries are returned straight
+    away and refreshed in the background. Only a call with nothing cached
+    waits on the API.
+
+    With `widest`, e.g. `{"days": 3}`, narrower calls are widened to those
+    arguments so they all share one fetch. Every call's data then goes
+    through `narrow(data, **arguments)`, which cuts the requested window
+    back out of it.
+
+    With `usable`, an entry whose data it returns False for, such as a
+    forecast that has nothing from today on, counts as nothing cached.
+    """
 
+    def decorator(func):
+        signature = inspect.signature(func)
 
-@cache_response
-def get_forecasted_weather(location=WHERE_I_AM, days=3):
-    return requests.get(
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            # bind so that relying on a default and passing it explicitly
+            # share an entry
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            fetch_arguments = arguments
+            if widest and all(arguments[name] <= widest[name] for name in widest):
+                fetch_arguments = {**arguments, **widest}
+
+            key = get_cache_key(func, fetch_arguments)
+            entry = cache.get(key)
+            if entry is not None and usable and not usable(entry[1]):
+                entry = None
+            if entry is None:
+                result = "miss"
+                data = _fetch_and_cache(key, timeout, func, **fetch_arguments)
+            else:
+                result = "hit"
+                fresh_until, data = entry
+                if fresh_until < time.time():
+                    result = "stale"
+                    _refresh_in_background(
+                        key, _fetch_and_cache, key, timeout, func, **fetch_arguments
+                    )
+            WEATHER_CACHE_REQUESTS.labels(endpoint=func.__name__, result=result).inc()
+
+            if narrow is None:
+                return data
+            # even the widest window, a cached one may have gone out of date
+            return narrow(data, **arguments)
+
+        return wrapper
+
+    return decorator
+
+
+class DailyWeather(NamedTuple):
+    """
+    The parts of a forecast or history day that watering decisions use.
+    """
+
+    date: date
+    totalprecip_in: float
+    maxtemp_f: float
+
+
+def to_daily_weather(payload) -> Tuple[DailyWeather, ...]:
+    """
+    Project a forecast or history response down to one tuple per day.
+
+    The raw responses carry hourly data, astronomy and condition text that
+    nothing reads, and would otherwise be cached and pickled in full.
+    """
+    try:
+        return tuple(
+            DailyWeather(
+                date=date.fromisoformat(day["date"]),
+                totalprecip_in=day["day"]["totalprecip_in"],
+                maxtemp_f=day["day"]["maxtemp_f"],
+            )
+            for day in payload["forecast"]["forecastday"]
+        )
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Unexpected weather response: {e!r}") from e
+
+
+def drop_past_days(days_of_weather) -> Tuple[DailyWeather, ...]:
+    today = get_local_date()
+    return tuple(day for day in days_of_weather if day.date >= today)
+
+
+def covers_today_on(days_of_weather) -> bool:
+    """
+    Whether a cached forecast still says anything about today or later.
+    """
+    return bool(drop_past_days(days_of_weather))
+
+
+def narrow_forecast(days_of_weather, location, days):
+    return drop_past_days(days_of_weather)[:days]
+
+
+@cache_response(
+    timeout=FORECAST_TIMEOUT,
+    widest={"days": FORECAST_WINDOW_IN_DAYS},
+    narrow=narrow_forecast,
+    usable=covers_today_on,
+)
+@breaker.guard
+def get_forecasted_weather(location=WHERE_I_AM, days=3) -> Tuple[DailyWeather, ...]:
+    response = requests.get(
         f"{BASE_URL}/forecast.json",
         params={"q": location, "key": key, "days": days},
         timeout=REQUEST_TIMEOUT,
-    ).json()
+    )
+    response.raise_for_status()
+    return to_daily_weather(response.json())
+
+
+def _ingest_history(location, days_ago):
+    # avoid a circular import, models need the weather client
+    from irrigate.models import WeatherDay
+
+    try:
+        WeatherDay.ingest_history(location=location, days_ago=days_ago)
+    finally:
+        # runs on a thread of its own, which opened its own connection
+        connections.close_all()
+
 
+@breaker.guard
+def fetch_historical_weather(
+    location, start_date, end_date
+) -> Tuple[DailyWeather, ...]:
+    """
+    Fetch observed weather for every day from `start_date` through `end_date`.
 
-@cache_response
-def get_historical_weather(location=WHERE_I_AM, days_ago=3):
-    now = timezone.now()
-    dt = now - timedelta(days=days_ago)
-    return requests.get(
+    Not cached: callers that want to keep history should store it instead.
+    """
+    response = requests.get(
         f"{BASE_URL}/history.json",
-        params={"q": location, "key": key, "dt": dt, "end_dt": now},
+        params={"q": location, "key": key, "dt": start_date, "end_dt": end_date},
         timeout=REQUEST_TIMEOUT,
-    ).json()
+    )
+    response.raise_for_status()
+    return to_daily_weather(response.json())
+
+
+class WeatherSnapshot:
+    """
+    Weather for a location, fetched once and shared by every duration
+    calculation in a scheduler pass.
+
+    The snapshot covers the widest history and forecast windows and slices
+    narrower windows out of them. Nothing is fetched until a value is first
+    needed, so a pass with nothing to calculate never hits the API.
+
+    History is read from the stored `WeatherDay` rows as they are. Any days
+    missing from them are fetched in the background, like a stale forecast,
+    for later snapshots to use.
+
+    If the API is unavailable the snapshot carries on with the history that is
+    already stored and no forecast, rather than failing the whole pass.
+    """
+
+    def __init__(
+        self,
+        location=WHERE_I_AM,
+        history_days=HISTORY_WINDOW_IN_DAYS,
+        forecast_days=FORECAST_WINDOW_IN_DAYS,
+    ):
+        self.location = location
+        self.history_days = history_days
+        self.forecast_days = forecast_days
+
+    @cached_property
+    def history(self):
+        # avoid a circular import, models need the weather client
+        from irrigate.models import WeatherDay
+
+        arguments = {"location": self.location, "days_ago": self.history_days}
+        if WeatherDay.get_missing_dates(**arguments):
+            key = get_cache_key(_ingest_history, arguments)
+            _refresh_in_background(key, _ingest_history, **arguments)
+        return WeatherDay.objects.filter(location=self.location)
+
+    @cached_property
+    def forecast(self):
+        try:
+            data = get_forecasted_weather(
+                location=self.location, days=self.forecast_days
+            )
+        except WeatherUnavailable as e:
+            logger.warning(f"No forecast available: {e}")
+            return ()
+        # a forecast fetched yesterday starts with yesterday
+        return drop_past_days(data)
+
+    def get_precipitation_in_inches(self, days_ago=3):
+        """
+        Rain that has fallen from `days_ago` days ago through today.
+        """
+        if days_ago > self.history_days:
+            raise ValueError(
+                f"{days_ago} days ago is outside of the {self.history_days} day history window"
+            )
+        today = get_local_date()
+        start_date = today - timedelta(days=days_ago)
+        return (
+            self.history.filter(date__range=(start_date, today)).aggregate(
+                total=models.Sum("totalprecip_in")
+            )["total"]
+            or 0
+        )
+
+    def get_forecasted_precipitation_in_inches(self, days=3, decay_factor=0.9):
+        """
+        Forecasted rain over the next `days` days, weighing later days lower.
+        """
+        if days > self.forecast_days:
+            raise ValueError(
+                f"{days} days is outside of the {self.forecast_days} day forecast window"
+            )
+        return sum(
+            day.totalprecip_in * (decay_factor**i)
+            for i, day in enumerate(self.forecast[:days])
+        )
+
+    def get_todays_high_temperature(self):
+        """
+        Today's forecasted high, or None without a forecast for today.
+        """
+        if not self.forecast or self.forecast[0].date != get_local_date():
+            return None
+        return self.forecast[0].maxtemp_f
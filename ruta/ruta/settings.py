@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "irrigate.middleware.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -136,12 +137,94 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # weather config
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
 DEFAULT_WEATHER_LOCATION = os.getenv("DEFAULT_WEATHER_LOCATION", "Ann Arbor")
+# weatherapi dates days in the location's own time zone
+WEATHER_TIME_ZONE = os.getenv("WEATHER_TIME_ZONE", "America/Detroit")
 
 # monitoring configg
 MONITORING_WEBHOOK_URL = os.getenv("MONITORING_WEBHOOK_URL")
+# bearer token for scraping /metrics. Staff users can always see it
+METRICS_TOKEN = os.getenv("RUTA_METRICS_TOKEN")
+
+# Server-Timing headers with SQL, weather and template time per request
+REQUEST_PROFILING = os.getenv("RUTA_REQUEST_PROFILING", "").lower() in {
+    "1",
+    "true",
+    "yes",
+    "on",
+}
+# profiled requests slower than this are logged with their slowest queries
+REQUEST_PROFILING_SLOW_SECONDS = float(
+    os.getenv("RUTA_REQUEST_PROFILING_SLOW_SECONDS", 1)
+)
+# save a cProfile of every request. Commands take --profile instead
+PROFILE_REQUESTS = os.getenv("RUTA_PROFILE_REQUESTS", "").lower() in {
+    "1",
+    "true",
+    "yes",
+    "on",
+}
 
 TEST = "test" in sys.argv
 
+# GPIO: "lgpio" or "simulated". Defaults to lgpio when it is installed
+GPIO_BACKEND = os.getenv("RUTA_GPIO_BACKEND")
+GPIO_SIMULATED_LATENCY_SECONDS = float(
+    os.getenv("RUTA_GPIO_SIMULATED_LATENCY_SECONDS", 0)
+)
+
+# Caches
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+#
+# Weather responses are shared through files on disk so every cron invocation
+# and gunicorn worker on the device reuses the same fetch. The scheduler cache
+# carries the schedule version from the web workers to the resident scheduler.
+
+CACHE_DIR = os.getenv("RUTA_CACHE_DIR", str(BASE_DIR / ".cache"))
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "weather": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(CACHE_DIR, "weather"),
+        "OPTIONS": {"MAX_ENTRIES": 1000},
+    },
+    "scheduler": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(CACHE_DIR, "scheduler"),
+    },
+}
+
+if TEST:
+    CACHES["weather"] = {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "weather",
+    }
+    CACHES["scheduler"] = {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "scheduler",
+    }
+
+# cProfiles saved by --profile and PROFILE_REQUESTS
+PROFILE_DIR = os.getenv("RUTA_PROFILE_DIR", os.path.join(CACHE_DIR, "profiles"))
+# older profiles are deleted as new ones are saved
+PROFILES_KEPT = int(os.getenv("RUTA_PROFILES_KEPT", 50))
+
+# spans of each scheduler pass that ran or failed, for manage.py show_traces
+TRACING = not TEST and os.getenv("RUTA_TRACING", "").lower() in {
+    "1",
+    "true",
+    "yes",
+    "on",
+}
+TRACE_FILE = os.getenv(
+    "RUTA_TRACE_FILE", os.path.join(CACHE_DIR, "traces", "spans.ndjson")
+)
+# past this size the file is moved aside to TRACE_FILE.1, and so on
+TRACE_MAX_BYTES = int(os.getenv("RUTA_TRACE_MAX_BYTES", 5 * 1024 * 1024))
+TRACE_BACKUPS = int(os.getenv("RUTA_TRACE_BACKUPS", 3))
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,